@@ -165,6 +165,71 @@ class RotoForge_Preferences(bpy.types.AddonPreferences):
         default="cuda12_9"
     ) # type: ignore
 
+    inference_backend: bpy.props.EnumProperty(
+        items=[("torch", "PyTorch", "Run the models with PyTorch, uses the GPU if the driver supports it"),
+               ("onnx", "ONNX Runtime (CPU)", "Run the models with ONNX Runtime on the CPU, usually faster than PyTorch without a GPU. Every model gets exported to ONNX once on first use")],
+        name="Inference Backend",
+        description="Library that runs the segmentation models",
+        default="torch"
+    ) # type: ignore
+
+    model_cache_size: bpy.props.IntProperty(
+        name="Loaded Models (MB)",
+        description="Memory budget for loaded models. Switching between models that fit into it doesn't reload the checkpoint, the least recently used ones get unloaded",
+        subtype='UNSIGNED',
+        default=8192,
+        min=0
+    ) # type: ignore
+
+    embedding_cache_size: bpy.props.IntProperty(
+        name="Embedding Cache (MB)",
+        description="Memory budget for cached image embeddings. Re-prompting an already encoded frame skips the image encoder",
+        subtype='UNSIGNED',
+        default=1024,
+        min=0
+    ) # type: ignore
+
+    embedding_store_size: bpy.props.IntProperty(
+        name="Embedding Disk Store (MB)",
+        description="Disk budget for embeddings saved next to the mask sequences, so re-tracking an already seen frame skips the image encoder. 0 disables the store",
+        subtype='UNSIGNED',
+        default=2048,
+        min=0
+    ) # type: ignore
+
+    frame_cache_size: bpy.props.IntProperty(
+        name="Frame Cache (MB)",
+        description="Memory budget for frames of image sequences decoded straight from disk. Re-tracking or scrubbing over already decoded frames doesn't decode them again",
+        subtype='UNSIGNED',
+        default=2048,
+        min=0
+    ) # type: ignore
+
+    cpu_threads: bpy.props.IntProperty(
+        name="CPU Threads",
+        description="Threads a model uses on the CPU. Leaving some cores to blender keeps the UI responsive. 0 uses one thread per core",
+        subtype='UNSIGNED',
+        default=0,
+        min=0
+    ) # type: ignore
+
+    cpu_interop_threads: bpy.props.IntProperty(
+        name="CPU Inter-op Threads",
+        description="Threads that run independent parts of a PyTorch model in parallel. 0 uses the PyTorch default, changes apply after a restart of blender once a model was loaded",
+        subtype='UNSIGNED',
+        default=0,
+        min=0
+    ) # type: ignore
+
+    core_scheduling: bpy.props.EnumProperty(
+        items=[("OFF", "Off", "Every instance uses CPU Threads threads"),
+               ("SHARE", "Share", "Instances of blender on this machine split the cores between them, CPU Threads is the budget of this instance (0 = even share)"),
+               ("PIN", "Share and Pin", "Like Share, and pins blender to its cores (Linux only)")],
+        name="Core Scheduling",
+        description="Coordinate the CPU cores with other blender instances running RotoForge on this machine. Can be overridden with the ROTOFORGE_CORE_SCHEDULING, ROTOFORGE_THREADS and ROTOFORGE_CPU_CORES environment variables",
+        default="OFF"
+    ) # type: ignore
+
     show_log: bpy.props.BoolProperty(
         name="Show Install Log",
         description="Show the install log in the preferences panel",
@@ -175,6 +240,18 @@ class RotoForge_Preferences(bpy.types.AddonPreferences):
         layout = self.layout
         layout.prop(self, "dependencies_driver")
         layout.prop(self, "dependencies_path")
+        
+        performance = layout.box()
+        performance.label(text="Performance")
+        performance.prop(self, "inference_backend")
+        performance.prop(self, "model_cache_size")
+        performance.prop(self, "embedding_cache_size")
+        performance.prop(self, "embedding_store_size")
+        performance.prop(self, "frame_cache_size")
+        performance.prop(self, "cpu_threads")
+        performance.prop(self, "cpu_interop_threads")
+        performance.prop(self, "core_scheduling")
+        
         row = layout.split(factor=0.7)
         
         labels = row.column()
@@ -0,0 +1,98 @@
+"""
+Synthetic plates, the in-memory mask sink and the IoU shared by the benchmark scripts.
+
+Not a benchmark itself, the scripts put the repo root on sys.path before importing it.
+"""
+
+import numpy as np
+import PIL.Image
+import PIL.ImageDraw
+
+from functions import engine
+from functions.frame_io import FrameSource, MaskSink
+
+
+
+
+def iou(mask, reference):
+    # Empty against empty counts as a match
+    union = np.count_nonzero(np.logical_or(mask, reference))
+    return np.count_nonzero(np.logical_and(mask, reference)) / union if union else 1.0
+
+
+def noise_image(rng, size, cell):
+    # Blurry colored noise so the encoder sees structure, not white noise, one random color per cell x cell pixels
+    width, height = size
+    noise = rng.integers(0, 256, (height // cell, width // cell, 3), dtype=np.uint8)
+    return np.asarray(PIL.Image.fromarray(noise).resize((width, height), PIL.Image.BICUBIC))
+
+
+def synthetic_plate(width=1280, height=720):
+    # A few flat shapes on a dark noisy plate, for the parity checks of the model variants
+    rng = np.random.default_rng(0)
+    image = PIL.Image.fromarray(rng.integers(40, 90, (height, width, 3), dtype=np.uint8))
+    draw = PIL.ImageDraw.Draw(image)
+    draw.ellipse((420, 200, 760, 560), fill=(220, 180, 60))
+    draw.rectangle((900, 100, 1150, 400), fill=(60, 140, 220))
+    return np.asarray(image)
+
+
+
+
+class MemorySink(MaskSink):
+    """Keeps the full resolution mask of every written frame"""
+
+    def __init__(self, resolution):
+        self.resolution = resolution
+        self.masks = {}
+
+    def write(self, frame, best_mask, cropping_box, blur = 0.0):
+        self.masks[frame] = engine.uncrop_mask(best_mask, cropping_box, self.resolution)
+        return self.masks[frame].astype(np.uint8) * 255
+
+
+class DriftingSource(FrameSource):
+    """
+    An ellipse drifting from left to right over a noise background, with the ground truth of every frame.
+    Subclasses change the motion with object_coords and the look of the object with paint.
+    """
+    name = 'drifting'
+    radii = (120, 90) # Half axes of the ellipse in pixels
+
+    def __init__(self, num_frames, resolution=(1280, 720), cell=16, rng=None):
+        rng = np.random.default_rng(0) if rng is None else rng
+        width, height = resolution
+        self.num_frames = num_frames
+        self._resolution = resolution
+        self.background = noise_image(rng, resolution, cell)
+        self.yy, self.xx = np.mgrid[0:height, 0:width]
+
+    @property
+    def resolution(self):
+        return self._resolution
+
+    def frames(self):
+        return list(range(self.num_frames))
+
+    def object_coords(self, frame):
+        # Coords of every pixel relative to the object center, in the object's own orientation and scale
+        center_x = 300 + 600 * frame / max(self.num_frames - 1, 1)
+        return self.xx - center_x, self.yy - 360
+
+    def _mask(self, u, v):
+        radius_x, radius_y = self.radii
+        return (u / radius_x) ** 2 + (v / radius_y) ** 2 <= 1
+
+    def ground_truth(self, frame):
+        return self._mask(*self.object_coords(frame))
+
+    def paint(self, pixels, mask, u, v):
+        # Brightens the object above the range of the background
+        pixels[mask] = (pixels[mask] // 2) + 120
+
+    def read(self, frame):
+        u, v = self.object_coords(frame)
+        mask = self._mask(u, v)
+        pixels = self.background.copy()
+        self.paint(pixels, mask, u, v)
+        return pixels
@@ -0,0 +1,54 @@
+"""
+Throughput of the batched image encoder (encoder_batch_size) on CPU.
+
+Runs outside of blender, only needs torch, numpy and segment_anything:
+    python benchmarks/bench_batched_encoder.py <path to sam_hq_vit_tiny.pth> [frames]
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from functions.embedding_cache import compute_embeddings_batch
+
+
+BATCH_SIZES = [1, 2, 4, 8]
+
+
+def main():
+    checkpoint = sys.argv[1]
+    num_frames = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+
+    import segment_anything
+    sam = segment_anything.sam_model_registry['vit_tiny'](checkpoint=checkpoint)
+    sam.to(device='cpu')
+    sam.eval()
+    predictor = segment_anything.SamPredictor(sam)
+
+    # Synthetic 720p crops, the content doesn't matter for the encoder cost
+    rng = np.random.default_rng(0)
+    frames = [rng.integers(0, 256, (720, 1280, 3), dtype=np.uint8) for _ in range(num_frames)]
+
+    print(f'torch {torch.__version__}, {torch.get_num_threads()} threads, {num_frames} frames')
+    print('batch size | sec/frame | frames/sec | speedup')
+
+    # Warm up
+    compute_embeddings_batch(predictor, frames[:1])
+
+    baseline = None
+    for batch_size in BATCH_SIZES:
+        start = time.perf_counter()
+        for i in range(0, num_frames, batch_size):
+            compute_embeddings_batch(predictor, frames[i:i + batch_size])
+        per_frame = (time.perf_counter() - start) / num_frames
+        if baseline is None:
+            baseline = per_frame
+        print(f'{batch_size:10d} | {per_frame:9.3f} | {1 / per_frame:10.2f} | {baseline / per_frame:6.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Tracking both directions from a middle frame: concurrent passes against one pass after the other.
+
+Pass overlap and mask files only, a stand-in model sleeps for a fixed time per frame (like the model,
+it doesn't hold the GIL meanwhile), needs numpy and PIL:
+    python benchmarks/bench_bidirectional.py [frames] [ms per frame]
+Also tracks with the model, needs torch and segment_anything:
+    python benchmarks/bench_bidirectional.py [frames] [ms per frame] <path to sam_hq_vit_tiny.pth>
+
+The seed frame is a third into the shot, so one half is twice as long as the other. Both runs write into
+a temporary folder, the check is that every frame was written once and the concurrent masks match.
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from functions import engine
+from functions.frame_io import DirectoryMaskSink, read_image
+from _common import DriftingSource
+
+
+RESOLUTION = (1280, 720)
+
+
+
+
+class StandInPredictor:
+    model_type = 'stand-in'
+
+    def reset_image(self):
+        pass
+
+
+def stand_in_predict(delay):
+    # The object is the brightened ellipse, anything above the background range
+    def predict(cropped_area, predictor, guide_mask, guide_strength, input_points, input_labels, input_box, input_logits, embedding_key=None, selection='AREA', previous_mask=None):
+        time.sleep(delay)
+        mask = cropped_area.min(axis=2) >= 120
+        return mask, np.zeros((256, 256), dtype=np.float32)
+    return predict
+
+
+def run(source, predictor, seed_frame, directory, both):
+    seed_mask = source.ground_truth(seed_frame)
+    seed_box = np.array(engine.calculate_bounding_box(seed_mask))
+    mask_sink = DirectoryMaskSink(directory, RESOLUTION)
+    engine.embedding_cache.clear()
+    start = time.perf_counter()
+    if both:
+        engine.track_both_directions(source, mask_sink, predictor, source.frames(), seed_frame, guide_mask = seed_mask,
+                                     input_box = seed_box, progress = None)
+    else:
+        for frames in (range(seed_frame, source.num_frames), range(seed_frame, -1, -1)):
+            engine.track_sequence(source, mask_sink, predictor, frames, guide_mask = seed_mask, input_box = seed_box, progress = None)
+    return time.perf_counter() - start
+
+
+def compare(source, predictor, label):
+    seed_frame = source.num_frames // 3
+    with tempfile.TemporaryDirectory() as sequential_dir, tempfile.TemporaryDirectory() as both_dir:
+        sequential = run(source, predictor, seed_frame, sequential_dir, both = False)
+        both = run(source, predictor, seed_frame, both_dir, both = True)
+        written = sorted(int(os.path.splitext(file)[0]) for file in os.listdir(both_dir))
+        complete = written == source.frames()
+        same = complete and all(np.array_equal(read_image(os.path.join(sequential_dir, file)), read_image(os.path.join(both_dir, file)))
+                                for file in os.listdir(both_dir))
+    longer_half = max(seed_frame, source.num_frames - 1 - seed_frame) + 1
+    print(f'{label:10s} | {sequential:14.2f} | {both:15.2f} | {sequential / both:7.2f}x | '
+          f'{longer_half / source.num_frames:11.0%} | {complete!s:16s} | {same}')
+
+
+def main():
+    num_frames = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+    delay = (float(sys.argv[2]) if len(sys.argv) > 2 else 50) / 1000
+    source = DriftingSource(num_frames, RESOLUTION)
+
+    print('model      | sequential sec | both directions | speedup | longer half | every frame once | same masks')
+    original = engine.predict_mask
+    engine.predict_mask = stand_in_predict(delay)
+    try:
+        compare(source, StandInPredictor(), 'stand-in')
+    finally:
+        engine.predict_mask = original
+
+    if len(sys.argv) > 3:
+        compare(source, engine.load_predictor('vit_tiny', sys.argv[3]), 'vit_tiny')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
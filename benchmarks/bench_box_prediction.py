@@ -0,0 +1,100 @@
+"""
+Crop area and lost tracks of the fixed search radius against the Kalman box predictor on synthetic trajectories.
+
+Runs outside of blender, only needs numpy and PIL:
+    python benchmarks/bench_box_prediction.py [runs per trajectory]
+
+The model is replaced by an ideal one that finds the object exactly, but only the part of it inside the
+predicted box, like SAM does with a box prompt that cuts the object off. A track is lost when the box misses
+the object completely, a frame is cut off when the box doesn't contain the whole object.
+"""
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from functions import engine
+from functions.motion_model import BoxKalmanFilter
+
+
+RESOLUTION = (1920, 1080)
+NUM_FRAMES = 120
+SIZE = np.array([200.0, 120.0])
+PREDICTORS = [('fixed 10', 10), ('fixed 30', 30), ('kalman', None)]
+
+
+
+
+def trajectory(kind, rng):
+    # Boxes (x0, y0, x1, y1) of the object on every frame
+    t = np.arange(NUM_FRAMES, dtype=np.float64)
+    direction = rng.normal(size=2)
+    direction /= np.linalg.norm(direction)
+    start = np.array([960.0, 540.0]) - direction * 400
+    size = np.tile(SIZE, (NUM_FRAMES, 1))
+
+    if kind == 'still':
+        centers = start + rng.normal(scale=0.5, size=(NUM_FRAMES, 2))
+    elif kind == 'slow':
+        centers = start + np.outer(t, direction) * 2
+    elif kind == 'fast':
+        centers = start + np.outer(t, direction) * 20
+    elif kind == 'accelerating':
+        centers = start + np.outer(0.1 * t ** 2, direction) * 0.6
+    elif kind == 'swinging':
+        centers = np.array([960.0, 540.0]) + np.outer(np.sin(t * 2 * np.pi / 40), direction) * 350
+    elif kind == 'zooming':
+        centers = np.tile(start + direction * 200, (NUM_FRAMES, 1))
+        size = np.outer(1.02 ** t, SIZE)
+    centers = np.clip(centers, size / 2, np.array(RESOLUTION) - size / 2)
+    return np.hstack([centers - size / 2, centers + size / 2])
+
+
+def track(boxes, search_radius):
+    # Returns (lost, cut off frames, mean crop area as a fraction of the frame)
+    width, height = RESOLUTION
+    box_predictor = BoxKalmanFilter() if search_radius is None else None
+    # The seed box of the first frame is the unpadded box of the drawn mask
+    input_box = boxes[0]
+    cut_off = 0
+    crop_areas = []
+    for true_box in boxes:
+        cropping_box = np.clip(engine.get_cropping_box(width, height, input_box), 0, [width, height, width, height])
+        crop_areas.append((cropping_box[2] - cropping_box[0]) * (cropping_box[3] - cropping_box[1]) / (width * height))
+
+        found_box = np.array([max(true_box[0], input_box[0]), max(true_box[1], input_box[1]),
+                              min(true_box[2], input_box[2]), min(true_box[3], input_box[3])])
+        if found_box[2] <= found_box[0] or found_box[3] <= found_box[1]:
+            return True, cut_off, np.mean(crop_areas)
+        if not engine.box_inside(true_box, input_box):
+            cut_off += 1
+
+        # The mask the ideal model returns, in the coords of the crop like the real one
+        mask = np.zeros((int(cropping_box[3] - cropping_box[1]), int(cropping_box[2] - cropping_box[0])), dtype=bool)
+        x0, y0, x1, y1 = (found_box - np.tile(cropping_box[:2], 2)).round().astype(int)
+        mask[max(y0, 0):y1, max(x0, 0):x1] = True
+        input_box = engine.get_next_input_box(mask, cropping_box, search_radius, box_predictor)
+        if input_box is None:
+            return True, cut_off, np.mean(crop_areas)
+    return False, cut_off, np.mean(crop_areas)
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+    print('trajectory   | predictor | lost | cut off frames | crop area')
+    for kind in ['still', 'slow', 'fast', 'accelerating', 'swinging', 'zooming']:
+        trajectories = [trajectory(kind, np.random.default_rng(seed)) for seed in range(runs)]
+        for name, search_radius in PREDICTORS:
+            results = [track(boxes, search_radius) for boxes in trajectories]
+            lost = np.mean([result[0] for result in results])
+            cut_off = np.mean([result[1] for result in results]) / NUM_FRAMES
+            crop_area = np.mean([result[2] for result in results])
+            print(f'{kind:12s} | {name:9s} | {lost:4.0%} | {cut_off:14.1%} | {crop_area:9.1%}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,119 @@
+"""
+Coarse-to-fine: how much smaller the crop of the selected model gets, and with both models the time and accuracy.
+
+Crop sizes only, an oracle model returns the object pixels of whatever it's shown, needs numpy and PIL:
+    python benchmarks/bench_coarse_to_fine.py
+Also tracks the plates with vit_l alone and with the vit_tiny coarse pass, needs torch and segment_anything:
+    python benchmarks/bench_coarse_to_fine.py <path to sam_hq_vit_tiny.pth> <path to sam_hq_vit_l.pth>
+
+The plates are a textured ellipse over a textured background, the prompt is the object box grown by
+the search radius of a few frames of motion, like a fast object that the last box doesn't fit tightly.
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from functions import engine
+from _common import iou, noise_image, MemorySink
+
+
+PLATES = {'HD': (1920, 1080), '4K': (3840, 2160)}
+SIZES = (0.05, 0.15, 0.4) # Object size as a fraction of the plate
+PROMPT_PADDING = 0.25 # Loose prompt box, padding as a fraction of the object size
+
+
+
+
+def render(resolution, size):
+    width, height = resolution
+    rng = np.random.default_rng(0)
+    yy, xx = np.mgrid[0:height, 0:width]
+    u, v = (xx - width * 0.4) / (width * size / 2), (yy - height * 0.55) / (height * size / 2)
+    mask = u ** 2 + v ** 2 <= 1
+    pixels = noise_image(rng, resolution, 24).copy()
+    pixels[mask] = (pixels[mask] // 2) + 120
+    rgba = np.full((height, width, 4), 255, dtype=np.uint8)
+    rgba[..., :3] = pixels
+    return rgba, mask
+
+
+def loose_prompt(mask):
+    box = np.array(engine.calculate_bounding_box(mask), dtype=np.float64)
+    padding = PROMPT_PADDING * np.tile(box[2:] - box[:2], 2) * np.array([-1, -1, 1, 1])
+    height, width = mask.shape
+    box = np.clip(box + padding, 0, [width, height, width, height])
+    guide_mask = np.zeros_like(mask)
+    x0, y0, x1, y1 = (int(round(value)) for value in box)
+    guide_mask[y0:y1, x0:x1] = True
+    return guide_mask, box
+
+
+def bench_oracle():
+    # The oracle marks the object by a red channel of 255 and returns those pixels inside the box,
+    # what's left is the crop the fine model gets with and without the coarse pass
+    crops = []
+
+    def predict(cropped_area, predictor, guide_mask, guide_strength, input_points, input_labels, input_box, input_logits, embedding_key=None, selection='AREA', *args, **kwargs):
+        crops.append((predictor, cropped_area.shape[:2]))
+        mask = np.zeros(cropped_area.shape[:2], dtype=bool)
+        x0, y0, x1, y1 = (int(round(value)) for value in input_box)
+        mask[y0:y1, x0:x1] = cropped_area[y0:y1, x0:x1, 0] == 255
+        return mask, np.zeros((256, 256), dtype=np.float32)
+
+    original = engine.predict_mask
+    engine.predict_mask = predict
+    print('plate | object | fine crop alone | with coarse pass | fine pixels | mask == ground truth')
+    try:
+        for name, resolution in PLATES.items():
+            for size in SIZES:
+                pixels, mask = render(resolution, size)
+                pixels[..., 0] = np.where(mask, 255, np.minimum(pixels[..., 0], 254))
+                guide_mask, box = loose_prompt(mask)
+                shapes = []
+                for coarse_predictor in (None, 'coarse'):
+                    crops.clear()
+                    sink = MemorySink(resolution)
+                    engine.track_frame(pixels, 'plate', 0, sink, 'fine', guide_mask = guide_mask, input_box = box,
+                                       coarse_predictor = coarse_predictor)
+                    shapes.append([shape for predictor, shape in crops if predictor == 'fine'][0])
+                same = np.array_equal(sink.masks[0], mask)
+                alone, coarse = (f'{shape[1]}x{shape[0]}' for shape in shapes)
+                ratio = (shapes[1][0] * shapes[1][1]) / (shapes[0][0] * shapes[0][1])
+                print(f'{name:5s} | {size:6.0%} | {alone:>15s} | {coarse:>16s} | {ratio:11.0%} | {same}')
+    finally:
+        engine.predict_mask = original
+
+
+def bench_model(tiny_checkpoint, large_checkpoint):
+    coarse_predictor = engine.load_predictor(engine.COARSE_MODEL, tiny_checkpoint)
+    predictor = engine.load_predictor('vit_l', large_checkpoint)
+    print('plate | object | pass          | sec/frame | IoU')
+    for name, resolution in PLATES.items():
+        for size in SIZES:
+            pixels, mask = render(resolution, size)
+            guide_mask, box = loose_prompt(mask)
+            for coarse in (None, coarse_predictor):
+                engine.embedding_cache.clear()
+                sink = MemorySink(resolution)
+                start = time.perf_counter()
+                engine.track_frame(pixels, 'plate', 0, sink, predictor, guide_mask = guide_mask, input_box = box,
+                                   coarse_predictor = coarse)
+                elapsed = time.perf_counter() - start
+                label = 'vit_l' if coarse is None else 'vit_tiny+vit_l'
+                print(f'{name:5s} | {size:6.0%} | {label:13s} | {elapsed:9.2f} | {iou(sink.masks[0], mask):.3f}')
+    engine.embedding_cache.clear()
+
+
+def main():
+    bench_oracle()
+    if len(sys.argv) > 2:
+        bench_model(sys.argv[1], sys.argv[2])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
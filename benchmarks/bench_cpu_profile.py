@@ -0,0 +1,83 @@
+"""
+Per-frame latency of the CPU profile (inference_mode, channels_last, thread count) against stock eager SamPredictor.
+
+Runs outside of blender, needs torch and segment_anything:
+    python benchmarks/bench_cpu_profile.py <folder with sam_hq_vit_tiny.pth/sam_hq_vit_b.pth> [threads] [runs]
+
+A frame is one full encoder + decoder pass on a 720p crop with a box prompt, like a tracking step without
+the embedding cache. threads 0 keeps the torch default.
+"""
+
+import os
+import sys
+import time
+import warnings
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from functions import engine
+
+
+MODEL_TYPES = ['vit_tiny', 'vit_b']
+
+
+
+
+def time_frames(step, runs):
+    step()
+    start = time.perf_counter()
+    for _ in range(runs):
+        step()
+    return (time.perf_counter() - start) / runs
+
+
+def main():
+    weights_dir = sys.argv[1]
+    num_threads = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    runs = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+
+    import segment_anything
+
+    rng = np.random.default_rng(0)
+    pixels = rng.integers(0, 256, (720, 1280, 3), dtype=np.uint8)
+    box = np.array([400, 200, 880, 620])
+    default_threads = torch.get_num_threads()
+
+    print(f'torch {torch.__version__}, default {default_threads} threads, profile {num_threads or default_threads} threads')
+    print('model    | eager sec/frame | profile sec/frame | speedup')
+    for model_type in MODEL_TYPES:
+        checkpoint = os.path.join(weights_dir, f'sam_hq_{model_type}.pth')
+        if not os.path.isfile(checkpoint):
+            print(f'{model_type:8s} | missing {checkpoint}')
+            continue
+
+        # Before: stock SamPredictor with no_grad and the default layout and thread count
+        torch.set_num_threads(default_threads)
+        with warnings.catch_warnings():
+            warnings.filterwarnings('ignore', category=UserWarning)
+            sam = segment_anything.sam_model_registry[model_type](checkpoint=checkpoint).to('cpu').eval()
+        eager_predictor = segment_anything.SamPredictor(sam)
+
+        def eager_step():
+            eager_predictor.set_image(pixels)
+            eager_predictor.predict(box=box, multimask_output=True)
+        eager = time_frames(eager_step, runs)
+        del eager_predictor, sam
+
+        # After: the predictor as the addon loads it
+        predictor = engine.load_predictor(model_type, checkpoint, num_threads=num_threads)
+        predictor.model.to('cpu')
+        engine.apply_cpu_profile(predictor)
+
+        def profile_step():
+            engine.predict_mask(pixels, predictor, None, 0, None, None, box, None)
+        profile = time_frames(profile_step, runs)
+
+        print(f'{model_type:8s} | {eager:15.3f} | {profile:17.3f} | {eager / profile:6.2f}x')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
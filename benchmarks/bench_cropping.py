@@ -0,0 +1,89 @@
+"""
+Time of get_cropped_image at 1080p, 4K and 8K, against the PIL based cropping it replaced.
+
+Runs outside of blender, only needs numpy and PIL:
+    python benchmarks/bench_cropping.py [runs]
+
+'inside' crops a box in the middle of the frame, 'edge' a box whose crop reaches outside of the frame
+and gets zero padded. The time includes resizing the crop to the 1024 encoder input.
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+import PIL.Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from functions.engine import get_cropped_image, get_cropping_box
+from functions.embedding_cache import resize_longest_side
+from functions.prompt_utils import fake_logits
+
+
+RESOLUTIONS = {'1080p': (1920, 1080), '4K': (3840, 2160), '8K': (7680, 4320)}
+
+
+
+
+def get_cropped_image_pil(pixels_uint8_rgba, guide_mask, input_box):
+    # The cropping before the numpy pipeline, followed by SamPredictors resize
+    width = pixels_uint8_rgba.shape[1]
+    height = pixels_uint8_rgba.shape[0]
+    img = PIL.Image.fromarray(pixels_uint8_rgba).convert('RGB')
+    mask = PIL.Image.fromarray(guide_mask)
+    cropping_box = get_cropping_box(width, height, input_box)
+    img = img.crop(cropping_box)
+    mask = mask.crop(cropping_box)
+    input_logits = fake_logits(mask)
+    pixels_uint8_rgb = np.asarray(img)
+    return np.array(PIL.Image.fromarray(pixels_uint8_rgb).resize(get_resize(pixels_uint8_rgb), PIL.Image.BILINEAR)), input_logits
+
+
+def get_resize(pixels):
+    height, width = pixels.shape[:2]
+    scale = 1024 / max(height, width)
+    return int(width * scale + 0.5), int(height * scale + 0.5)
+
+
+def get_cropped_image_numpy(pixels_uint8_rgba, guide_mask, input_box):
+    pixels_uint8_rgb, _, input_logits, _, _ = get_cropped_image(pixels_uint8_rgba, guide_mask, None, input_box, None)
+    return resize_longest_side(pixels_uint8_rgb, 1024), input_logits
+
+
+def measure(crop, pixels, guide_mask, input_box, runs):
+    crop(pixels, guide_mask, input_box)
+    start = time.perf_counter()
+    for _ in range(runs):
+        crop(pixels, guide_mask, input_box)
+    return (time.perf_counter() - start) / runs
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    rng = np.random.default_rng(0)
+
+    print('resolution | box    | PIL ms | numpy ms | speedup')
+    for name, (width, height) in RESOLUTIONS.items():
+        pixels = rng.integers(0, 256, (height, width, 4), dtype=np.uint8)
+        boxes = {
+            'inside': np.array([width * 0.3, height * 0.3, width * 0.6, height * 0.7]),
+            'edge': np.array([0, height * 0.5, width * 0.4, height]),
+        }
+        for box_name, input_box in boxes.items():
+            guide_mask = np.zeros((height, width), dtype=bool)
+            x0, y0, x1, y1 = input_box.astype(int)
+            guide_mask[y0:y1, x0:x1] = True
+
+            old_image, old_logits = get_cropped_image_pil(pixels, guide_mask, input_box)
+            new_image, new_logits = get_cropped_image_numpy(pixels, guide_mask, input_box)
+            assert np.array_equal(old_image, new_image) and np.array_equal(old_logits[0], new_logits[0])
+
+            old = measure(get_cropped_image_pil, pixels, guide_mask, input_box, runs)
+            new = measure(get_cropped_image_numpy, pixels, guide_mask, input_box, runs)
+            print(f'{name:10s} | {box_name:6s} | {old * 1000:6.1f} | {new * 1000:8.1f} | {old / new:6.2f}x')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
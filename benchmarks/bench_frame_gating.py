@@ -0,0 +1,103 @@
+"""
+Skipped frames, mask error and overhead of the frame gate on a synthetic locked-off shot.
+
+Runs outside of blender, only needs numpy and PIL:
+    python benchmarks/bench_frame_gating.py [frames]
+
+The shot is 1080p with sensor noise: the object holds still for the first third, drifts slowly in the
+second third and moves fast in the last one. The model is replaced by the ground truth mask, so the IoU
+only measures what reusing masks on skipped frames costs.
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from functions import engine
+from functions.frame_gating import FrameGate
+from _common import iou, noise_image
+
+
+RESOLUTION = (1920, 1080)
+THRESHOLDS = [0.01, 0.02, 0.05]
+SEARCH_RADIUS = 10
+
+
+
+
+def object_position(frame, num_frames):
+    # Still, slow drift (0.5 px/frame), fast motion (8 px/frame)
+    third = num_frames // 3
+    x = 600.0
+    x += 0.5 * min(max(frame - third, 0), third)
+    x += 8.0 * max(frame - 2 * third, 0)
+    return x, 500.0
+
+
+def make_shot(num_frames):
+    rng = np.random.default_rng(0)
+    width, height = RESOLUTION
+    background = noise_image(rng, RESOLUTION, 24).astype(np.int16)
+    yy, xx = np.mgrid[0:height, 0:width]
+
+    frames, masks = [], []
+    for frame in range(num_frames):
+        x, y = object_position(frame, num_frames)
+        mask = ((xx - x) / 160) ** 2 + ((yy - y) / 110) ** 2 <= 1
+        pixels = background.copy()
+        pixels[mask] = ((xx[mask] - int(x)) // 20 % 2 * 120 + 100)[:, None]
+        pixels += rng.integers(-3, 4, pixels.shape, dtype=np.int16)
+        frames.append(np.clip(pixels, 0, 255).astype(np.uint8))
+        masks.append(mask)
+    return frames, masks
+
+
+def track(frames, masks, gate):
+    # The tracking loop of engine.track_frame with the ground truth standing in for the model
+    width, height = RESOLUTION
+    search_box = engine.get_next_input_box(masks[0], None, SEARCH_RADIUS)
+    ious = []
+    skipped = []
+    gate_time = 0.0
+    for pixels, true_mask in zip(frames, masks):
+        start = time.perf_counter()
+        shift = gate.check(pixels, search_box)
+        gate_time += time.perf_counter() - start
+
+        if shift is None:
+            cropping_box = engine.get_cropping_box(width, height, search_box)
+            best_mask = engine.crop_array(true_mask, cropping_box)
+            start = time.perf_counter()
+            gate.update(pixels, best_mask, cropping_box, (None, cropping_box))
+            gate_time += time.perf_counter() - start
+        else:
+            best_mask, cropping_box, _ = gate.reuse(shift)
+
+        skipped.append(shift is not None)
+        full_mask = engine.uncrop_mask(best_mask, cropping_box, RESOLUTION)
+        ious.append(iou(full_mask, true_mask))
+        search_box = engine.get_next_input_box(best_mask, cropping_box, SEARCH_RADIUS)
+    return np.array(ious), np.array(skipped), gate_time / len(frames)
+
+
+def main():
+    num_frames = int(sys.argv[1]) if len(sys.argv) > 1 else 90
+    frames, masks = make_shot(num_frames)
+    third = num_frames // 3
+
+    print('threshold | motion | skipped | mean IoU | min IoU | still/drift/fast skipped | gate ms/frame')
+    for threshold in THRESHOLDS:
+        for shift in [False, True]:
+            gate = FrameGate(threshold, max_skip=10, shift=shift)
+            ious, skipped, gate_time = track(frames, masks, gate)
+            skipped_per_part = [np.count_nonzero(skipped[:third]), np.count_nonzero(skipped[third:2 * third]), np.count_nonzero(skipped[2 * third:])]
+            parts = '/'.join(str(count) for count in skipped_per_part)
+            print(f'{threshold:9.2f} | {"on" if shift else "off":6s} | {gate.skipped_ratio:7.0%} | {ious.mean():8.3f} | {ious.min():7.3f} | {parts:24s} | {gate_time * 1000:13.2f}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,94 @@
+"""
+Time and peak memory of the frame ingest (bpyimg_to_HWCuint8) at 1080p, 4K and 8K.
+
+Runs outside of blender, only needs numpy:
+    python benchmarks/bench_frame_ingest.py [runs]
+
+The blender image is replaced by a stand-in with the same pixels.foreach_get interface.
+'old' is the ingest before the buffer pool, 'pooled' is the current one.
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from functions.frame_io import FrameBufferPool, rgba_float_to_rgb_uint8
+
+
+RESOLUTIONS = {'1080p': (1920, 1080), '4K': (3840, 2160), '8K': (7680, 4320)}
+
+
+
+
+class FakePixels:
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    def foreach_get(self, out):
+        np.copyto(out, self.data)
+
+
+class FakeImage:
+    def __init__(self, width, height):
+        rng = np.random.default_rng(0)
+        self.size = (width, height)
+        self.pixels = FakePixels(rng.random(width * height * 4, dtype=np.float32))
+
+
+def ingest_old(source_image):
+    source_pixels = np.zeros(len(source_image.pixels), dtype=np.float32)
+    source_image.pixels.foreach_get(source_pixels)
+    width = source_image.size[0]
+    height = source_image.size[1]
+    channels = 4
+    return (np.array(source_pixels).reshape(height, width, channels)* 255).astype(np.uint8)
+
+
+def make_ingest_pooled():
+    pool = FrameBufferPool()
+
+    def ingest_pooled(source_image):
+        width, height = source_image.size
+        source_pixels = pool.get(width * height * 4)
+        source_image.pixels.foreach_get(source_pixels)
+        return rgba_float_to_rgb_uint8(source_pixels, height, width)
+    return ingest_pooled
+
+
+def measure(ingest, image, runs):
+    ingest(image) # Warm up, fills the pool
+    tracemalloc.start()
+    start = time.perf_counter()
+    for _ in range(runs):
+        ingest(image)
+    elapsed = (time.perf_counter() - start) / runs
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    print('resolution | ingest | ms/frame | peak MB per frame')
+    for name, (width, height) in RESOLUTIONS.items():
+        image = FakeImage(width, height)
+        for ingest_name, ingest in [('old', ingest_old), ('pooled', make_ingest_pooled())]:
+            elapsed, peak = measure(ingest, image, runs)
+            print(f'{name:10s} | {ingest_name:6s} | {elapsed * 1000:8.1f} | {peak / 1024**2:8.1f}')
+
+        # Same pixels apart from the dropped alpha
+        assert np.array_equal(ingest_old(image)[:, :, :3], make_ingest_pooled()(image))
+        del image
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,119 @@
+"""
+Keyframe-sparse tracking: how many frames run the model, how well the interpolated frames match and what they cost.
+
+Interpolation only, the keyframes come from the ground truth, needs numpy and PIL:
+    python benchmarks/bench_keyframes.py [frames]
+Also tracks the shot with the model on every frame and sparse, needs torch and segment_anything:
+    python benchmarks/bench_keyframes.py [frames] <path to sam_hq_vit_tiny.pth>
+
+The synthetic shot is a textured ellipse that drifts, grows and turns slowly over a textured background,
+the IoU is over the frames that were interpolated (or tracked) against the ground truth.
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+import PIL.Image
+import PIL.ImageFilter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from functions import engine
+from functions.keyframes import KeyframeScheduler
+from _common import iou, noise_image, MemorySink, DriftingSource
+
+
+RESOLUTION = (1920, 1080)
+SETTINGS = [('EVERY', 1), ('INTERVAL', 4), ('INTERVAL', 8), ('ADAPTIVE', 8), ('ADAPTIVE', 16)]
+
+
+
+
+class TurningSource(DriftingSource):
+    radii = (200, 120)
+
+    def __init__(self, num_frames):
+        rng = np.random.default_rng(0)
+        super().__init__(num_frames, RESOLUTION, 24, rng)
+        self.texture = noise_image(rng, (480, 480), 20)
+
+    def object_coords(self, frame):
+        # Object coords of every pixel, drifts 3 px/frame, grows 0.3 %/frame and turns 0.3 degrees/frame
+        scale = 1.003 ** frame
+        angle = np.radians(0.3 * frame)
+        dx, dy = self.xx - (600 + 3 * frame), self.yy - (540 + np.sin(frame / 15) * 40)
+        u = (dx * np.cos(angle) + dy * np.sin(angle)) / scale
+        v = (-dx * np.sin(angle) + dy * np.cos(angle)) / scale
+        return u, v
+
+    def paint(self, pixels, mask, u, v):
+        # The texture moves, scales and turns with the object
+        pixels[mask] = self.texture[np.clip(v[mask] + 240, 0, 479).astype(int), np.clip(u[mask] + 240, 0, 479).astype(int)]
+
+
+def oracle_logits(mask):
+    # Smooth logits of the long side square from the top left of the mask box, like the decoder puts out
+    box = engine.calculate_bounding_box(mask)
+    cropping_box = engine.get_cropping_box(*RESOLUTION, np.array(box))
+    cropped = engine.crop_array(mask, cropping_box)
+    side = max(cropped.shape)
+    square = np.zeros((side, side), dtype=np.uint8)
+    square[:cropped.shape[0], :cropped.shape[1]] = cropped * 255
+    small = PIL.Image.fromarray(square).resize((256, 256), PIL.Image.BILINEAR).filter(PIL.ImageFilter.GaussianBlur(2))
+    return (np.asarray(small, dtype=np.float32) / 255 - 0.5) * 40, cropping_box
+
+
+def interpolate(source, mode, interval):
+    # The keyframe loop of engine.track_keyframes with the ground truth as the model
+    keyframes = KeyframeScheduler(mode, interval)
+    masks = {}
+    fill_time = 0.0
+    frame = 0
+    while frame is not None:
+        mask = source.ground_truth(frame)
+        masks[frame] = mask
+        start = time.perf_counter()
+        for filled_frame, filled_mask, cropping_box in keyframes.add(frame, mask, oracle_logits(mask)):
+            masks[filled_frame] = engine.uncrop_mask(filled_mask, cropping_box, RESOLUTION)
+        fill_time += time.perf_counter() - start
+        frame = keyframes.next_frame(source.num_frames - 1) if keyframes.enabled else (frame + 1 if frame + 1 < source.num_frames else None)
+    ious = np.array([iou(masks[frame], source.ground_truth(frame)) for frame in source.frames()])
+    if not keyframes.enabled:
+        return source.num_frames, ious, None
+    return keyframes.model_frames, ious, fill_time / max(keyframes.filled_frames, 1)
+
+
+def track(source, checkpoint):
+    predictor = engine.load_predictor('vit_tiny', checkpoint)
+    seed_mask = source.ground_truth(0)
+    seed_box = np.array(engine.calculate_bounding_box(seed_mask))
+    print('mode     | interval | sec/frame | mean IoU | min IoU')
+    for mode, interval in SETTINGS:
+        engine.embedding_cache.clear()
+        mask_sink = MemorySink(RESOLUTION)
+        start = time.perf_counter()
+        engine.track_sequence(source, mask_sink, predictor, source.frames(), guide_mask = seed_mask, input_box = seed_box,
+                              progress = None, mask_prompt = 'LOGITS', keyframes = KeyframeScheduler(mode, interval))
+        elapsed = (time.perf_counter() - start) / source.num_frames
+        ious = np.array([iou(mask_sink.masks[frame], source.ground_truth(frame)) if frame in mask_sink.masks else 0.0 for frame in source.frames()])
+        print(f'{mode:8s} | {interval:8d} | {elapsed:9.3f} | {ious.mean():8.3f} | {ious.min():7.3f}')
+
+
+def main():
+    num_frames = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+    source = TurningSource(num_frames)
+
+    print('mode     | interval | model frames | mean IoU | min IoU | ms/filled frame')
+    for mode, interval in SETTINGS:
+        model_frames, ious, fill_time = interpolate(source, mode, interval)
+        fill_info = '-' if fill_time is None else f'{fill_time * 1000:.1f}'
+        print(f'{mode:8s} | {interval:8d} | {model_frames:5d}/{num_frames:<6d} | {ious.mean():8.3f} | {ious.min():7.3f} | {fill_info:>15s}')
+
+    if len(sys.argv) > 2:
+        track(source, sys.argv[2])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
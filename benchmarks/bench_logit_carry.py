@@ -0,0 +1,101 @@
+"""
+Mask prompt of tracked frames: resizing the previous mask (GUIDE_MASK) against carrying the previous low res logits (LOGITS).
+
+Prompt preparation only, needs numpy and PIL:
+    python benchmarks/bench_logit_carry.py
+Time and drift on a synthetic moving object, also needs torch and segment_anything:
+    python benchmarks/bench_logit_carry.py <path to sam_hq_vit_tiny.pth> [frames]
+
+The synthetic plate is a textured ellipse moving and turning over a textured background, the drift is
+the IoU of the tracked masks with the ground truth over the sequence.
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+import PIL.Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from functions import engine
+from functions.prompt_utils import fake_logits, carry_logits
+from _common import iou, MemorySink, DriftingSource
+
+
+CROP_SIZES = {'720p crop': (1280, 720), '4K crop': (3840, 2160)}
+RESOLUTION = (1280, 720)
+
+
+
+
+class SyntheticSource(DriftingSource):
+    name = 'synthetic'
+    radii = (140, 80)
+
+    def object_coords(self, frame):
+        t = frame / max(self.num_frames - 1, 1)
+        center_x = 300 + 680 * t
+        center_y = 360 + 120 * np.sin(t * 2 * np.pi)
+        angle = t * np.pi
+        dx, dy = self.xx - center_x, self.yy - center_y
+        u = dx * np.cos(angle) + dy * np.sin(angle)
+        v = -dx * np.sin(angle) + dy * np.cos(angle)
+        return u, v
+
+    def paint(self, pixels, mask, u, v):
+        stripes = ((self.xx + self.yy) // 12 % 2).astype(bool)
+        pixels[mask & stripes] = (230, 60, 40)
+        pixels[mask & ~stripes] = (250, 200, 60)
+
+
+def time_runs(step, runs):
+    step()
+    start = time.perf_counter()
+    for _ in range(runs):
+        step()
+    return (time.perf_counter() - start) / runs
+
+
+def bench_prompt(runs=20):
+    rng = np.random.default_rng(0)
+    logits = rng.standard_normal((256, 256)).astype(np.float32)
+    print('crop       | mask prompt | ms/frame')
+    for name, (width, height) in CROP_SIZES.items():
+        guide_mask = rng.random((height, width)) > 0.5
+        from_box = (100, 100, 100 + width, 100 + height)
+        to_box = (110, 105, 110 + width, 105 + height)
+        elapsed = time_runs(lambda: fake_logits(PIL.Image.fromarray(guide_mask)), runs)
+        print(f'{name:10s} | {"GUIDE_MASK":11s} | {elapsed * 1000:8.2f}')
+        elapsed = time_runs(lambda: carry_logits(logits, from_box, to_box), runs)
+        print(f'{name:10s} | {"LOGITS":11s} | {elapsed * 1000:8.2f}')
+
+
+def bench_tracking(checkpoint, num_frames):
+    frame_source = SyntheticSource(num_frames, RESOLUTION)
+    predictor = engine.load_predictor('vit_tiny', checkpoint)
+    seed_mask = frame_source.ground_truth(0)
+    seed_box = np.array(engine.calculate_bounding_box(seed_mask))
+
+    print('mask prompt | sec/frame | mean IoU | last IoU')
+    for mask_prompt in engine.MASK_PROMPTS:
+        engine.embedding_cache.clear()
+        mask_sink = MemorySink(RESOLUTION)
+        start = time.perf_counter()
+        engine.track_sequence(frame_source, mask_sink, predictor, frame_source.frames(),
+                              guide_mask = seed_mask, input_box = seed_box, progress = None, mask_prompt = mask_prompt)
+        elapsed = (time.perf_counter() - start) / num_frames
+        ious = [iou(mask_sink.masks[frame], frame_source.ground_truth(frame)) if frame in mask_sink.masks else 0.0
+                for frame in frame_source.frames()]
+        print(f'{mask_prompt:11s} | {elapsed:9.3f} | {np.mean(ious):8.3f} | {ious[-1]:8.3f}')
+
+
+def main():
+    bench_prompt()
+    if len(sys.argv) > 1:
+        bench_tracking(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 30)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,86 @@
+"""
+Time of picking one of the decoder's candidate masks, the old per-mask loop against the vectorized selection.
+
+Runs outside of blender, only needs numpy:
+    python benchmarks/bench_mask_selection.py [runs]
+
+The candidates are 3 random boolean masks at 720p and 4K crops, like the multimask output of the decoder.
+The second table times the pixel counts per candidate, row_counts against the numpy reductions with an axis.
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from functions.mask_selection import SELECTION_STRATEGIES, select_mask, row_counts
+
+
+RESOLUTIONS = {'720p': (1280, 720), '4K': (3840, 2160)}
+
+
+
+
+def select_loop(masks, scores, logits, guide_mask, guide_strength, cropped_area):
+    # The selection before the vectorized pass
+    best_score = float('-inf')
+    best_mask = None
+    best_logits = None
+    sum_guide_mask = np.sum(guide_mask)
+    for i, score in enumerate(scores):
+        score += -abs(sum_guide_mask - np.sum(masks[i])) / cropped_area * guide_strength
+        if score > best_score:
+            best_score = score
+            best_mask = masks[i]
+            best_logits = logits[i]
+    return best_mask, best_logits
+
+
+def time_runs(step, runs):
+    step()
+    start = time.perf_counter()
+    for _ in range(runs):
+        step()
+    return (time.perf_counter() - start) / runs
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    rng = np.random.default_rng(0)
+
+    print('resolution | selection    | ms/frame')
+    for name, (width, height) in RESOLUTIONS.items():
+        masks = rng.random((3, height, width)) > np.array([0.3, 0.5, 0.7])[:, None, None]
+        scores = rng.random(3).astype(np.float32)
+        logits = rng.standard_normal((3, 256, 256)).astype(np.float32)
+        guide_mask = rng.random((height, width)) > 0.5
+        previous_mask = rng.random((height, width)) > 0.5
+        cropped_area = height * width
+
+        elapsed = time_runs(lambda: select_loop(masks, scores, logits, guide_mask, 10, cropped_area), runs)
+        print(f'{name:10s} | {"loop":12s} | {elapsed * 1000:8.2f}')
+        for selection in SELECTION_STRATEGIES:
+            elapsed = time_runs(lambda: select_mask(masks, scores, logits, selection, guide_mask, 10, cropped_area, previous_mask), runs)
+            print(f'{name:10s} | {selection:12s} | {elapsed * 1000:8.2f}')
+
+        # The AREA strategy picks the same mask as the loop
+        assert np.array_equal(select_mask(masks, scores, logits, 'AREA', guide_mask, 10, cropped_area)[0], select_loop(masks, scores, logits, guide_mask, 10, cropped_area)[0])
+
+    print()
+    print('resolution | row counts             | ms/frame')
+    for name, (width, height) in RESOLUTIONS.items():
+        flat_masks = (rng.random((3, height, width)) > 0.5).reshape(3, -1)
+        counters = {'row_counts': row_counts,
+                    'count_nonzero(axis=1)': lambda masks: np.count_nonzero(masks, axis=1),
+                    'sum(axis=1)': lambda masks: masks.sum(axis=1, dtype=np.int64)}
+        for label, count in counters.items():
+            assert np.array_equal(count(flat_masks), row_counts(flat_masks))
+            elapsed = time_runs(lambda: count(flat_masks), runs)
+            print(f'{name:10s} | {label:22s} | {elapsed * 1000:8.2f}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,109 @@
+"""
+Parity and latency of the ONNX Runtime backend against the torch backend on CPU.
+
+Runs outside of blender, needs torch, segment_anything and onnxruntime:
+    python benchmarks/bench_onnx_backend.py <path to sam_hq_<model>.pth> [model type] [image] [runs]
+
+Without an image a synthetic plate with a few shapes is used. The masks of both backends are compared
+for a box, a point and a box + mask prompt, the script fails with exit code 1 if an IoU drops below MIN_IOU.
+"""
+
+import os
+import sys
+import time
+import tempfile
+
+import numpy as np
+import PIL.Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from functions import engine
+from functions.embedding_cache import compute_embedding, apply_embedding
+from _common import iou, synthetic_plate
+
+
+MIN_IOU = 0.95
+
+
+
+
+def best_mask(predictor, **prompt):
+    masks, scores, logits = predictor.predict(multimask_output=True, **prompt)
+    best = int(np.argmax(scores))
+    return masks[best], logits[best]
+
+
+def time_encoder(predictor, pixels, runs):
+    compute_embedding(predictor, pixels)
+    start = time.perf_counter()
+    for _ in range(runs):
+        compute_embedding(predictor, pixels)
+    return (time.perf_counter() - start) / runs
+
+
+def time_decoder(predictor, runs, **prompt):
+    predictor.predict(multimask_output=True, **prompt)
+    start = time.perf_counter()
+    for _ in range(runs):
+        predictor.predict(multimask_output=True, **prompt)
+    return (time.perf_counter() - start) / runs
+
+
+def main():
+    checkpoint = sys.argv[1]
+    model_type = sys.argv[2] if len(sys.argv) > 2 else 'vit_tiny'
+    pixels = np.asarray(PIL.Image.open(sys.argv[3]).convert('RGB')) if len(sys.argv) > 3 else synthetic_plate()
+    runs = int(sys.argv[4]) if len(sys.argv) > 4 else 5
+
+    import torch
+    torch_predictor = engine.load_predictor(model_type, checkpoint)
+    # Compare on the same device, the onnx backend is CPU only
+    torch_predictor.model.to('cpu')
+
+    with tempfile.TemporaryDirectory() as onnx_dir:
+        export_start = time.perf_counter()
+        onnx_predictor = engine.load_predictor(model_type, checkpoint, backend='onnx', onnx_dir=onnx_dir)
+        print(f'Export + session setup: {time.perf_counter() - export_start:.1f} sec')
+
+        for predictor in [torch_predictor, onnx_predictor]:
+            apply_embedding(predictor, compute_embedding(predictor, pixels))
+
+        height, width = pixels.shape[:2]
+        box = np.array([width * 0.3, height * 0.25, width * 0.6, height * 0.8])
+        prompts = {
+            'box': {'box': box},
+            'point': {'point_coords': np.array([[width * 0.45, height * 0.5]]), 'point_labels': np.array([1])},
+        }
+
+        print(f'{model_type}, torch {torch.__version__} with {torch.get_num_threads()} threads')
+        print('prompt         | IoU torch vs onnx')
+        failed = False
+        for name, prompt in prompts.items():
+            torch_mask, torch_logits = best_mask(torch_predictor, **prompt)
+            onnx_mask, _ = best_mask(onnx_predictor, **prompt)
+            score = iou(torch_mask, onnx_mask)
+            failed |= score < MIN_IOU
+            print(f'{name:14s} | {score:.4f}')
+
+        # Refine with the torch logits as mask prompt, like tracking does from frame to frame
+        prompt = {'box': box, 'mask_input': torch_logits[None]}
+        score = iou(best_mask(torch_predictor, **prompt)[0], best_mask(onnx_predictor, **prompt)[0])
+        failed |= score < MIN_IOU
+        print(f'{"box + logits":14s} | {score:.4f}')
+
+        print()
+        print('backend | encoder sec | decoder ms')
+        for name, predictor in [('torch', torch_predictor), ('onnx', onnx_predictor)]:
+            encoder = time_encoder(predictor, pixels, runs)
+            apply_embedding(predictor, compute_embedding(predictor, pixels))
+            decoder = time_decoder(predictor, runs * 4, box=box)
+            print(f'{name:7s} | {encoder:11.3f} | {decoder * 1000:10.1f}')
+
+    if failed:
+        print(f'Parity check failed, IoU below {MIN_IOU}')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,109 @@
+"""
+Per-frame cost and drift of the block flow propagation (PROPAGATE) on synthetic translating and scaling shapes.
+
+Propagation only, needs numpy and PIL:
+    python benchmarks/bench_optical_flow.py [frames]
+Also times a full SAM pass on the same crop, needs torch and segment_anything:
+    python benchmarks/bench_optical_flow.py [frames] <path to sam_hq_vit_tiny.pth>
+
+Every shape starts from its ground truth mask and is propagated with the flow only, the IoU with the
+ground truth shows how fast the mask drifts without the model.
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from functions import engine
+from functions.optical_flow import MaskPropagator
+from _common import iou, noise_image
+
+
+RESOLUTION = (1920, 1080)
+SEARCH_RADIUS = 10
+MOTIONS = {
+    'translate slow': lambda t: (700 + 2 * t, 500 + 1 * t, 1.0),
+    'translate fast': lambda t: (500 + 12 * t, 450 + 5 * t, 1.0),
+    'scale up': lambda t: (900, 540, 1.01 ** t),
+    'scale + move': lambda t: (700 + 6 * t, 540 - 2 * t, 0.995 ** t),
+}
+
+
+
+
+class Shot:
+    def __init__(self):
+        rng = np.random.default_rng(0)
+        width, height = RESOLUTION
+        self.background = noise_image(rng, RESOLUTION, 24)
+        self.texture = noise_image(rng, (480, 480), 20)
+        self.yy, self.xx = np.mgrid[0:height, 0:width]
+
+    def render(self, center_x, center_y, scale):
+        # Textured ellipse, the texture moves and scales with it
+        u = (self.xx - center_x) / scale
+        v = (self.yy - center_y) / scale
+        mask = (u / 160) ** 2 + (v / 100) ** 2 <= 1
+        pixels = self.background.copy()
+        pixels[mask] = self.texture[np.clip(v[mask] + 240, 0, 479).astype(int), np.clip(u[mask] + 240, 0, 479).astype(int)]
+        return pixels, mask
+
+
+def propagate(shot, motion, num_frames):
+    # Returns the IoU per frame and the propagation time per frame
+    propagator = MaskPropagator('PROPAGATE')
+    pixels, mask = shot.render(*motion(0))
+    propagator.update(pixels, mask, None)
+    input_box = engine.get_next_input_box(mask, None, SEARCH_RADIUS)
+
+    ious = []
+    elapsed = 0.0
+    for t in range(1, num_frames):
+        pixels, true_mask = shot.render(*motion(t))
+        start = time.perf_counter()
+        mask, _ = propagator.propagate(pixels, input_box)
+        propagator.accept(pixels)
+        elapsed += time.perf_counter() - start
+        ious.append(iou(mask, true_mask))
+        input_box = engine.get_next_input_box(mask, None, SEARCH_RADIUS)
+        if input_box is None:
+            ious += [0.0] * (num_frames - 1 - len(ious))
+            break
+    return np.array(ious), elapsed / (num_frames - 1)
+
+
+def time_sam_pass(checkpoint, shot):
+    predictor = engine.load_predictor('vit_tiny', checkpoint)
+    pixels, mask = shot.render(*MOTIONS['translate slow'](0))
+    input_box = np.array(engine.calculate_bounding_box(mask))
+    pixels_uint8_rgb, cropping_box, input_logits, input_box, _ = engine.get_cropped_image(pixels, mask, None, input_box, None)
+    guide_mask = engine.crop_array(mask, cropping_box)
+
+    def sam_pass():
+        engine.predict_mask(pixels_uint8_rgb, predictor, guide_mask, 10, None, None, input_box, input_logits)
+    sam_pass()
+    start = time.perf_counter()
+    for _ in range(3):
+        sam_pass()
+    return (time.perf_counter() - start) / 3
+
+
+def main():
+    num_frames = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    shot = Shot()
+
+    print(f'motion         | ms/frame | IoU frame 1 | IoU frame 10 | IoU frame {num_frames - 1}')
+    for name, motion in MOTIONS.items():
+        ious, elapsed = propagate(shot, motion, num_frames)
+        print(f'{name:14s} | {elapsed * 1000:8.1f} | {ious[0]:11.3f} | {ious[min(9, len(ious) - 1)]:12.3f} | {ious[-1]:.3f}')
+
+    if len(sys.argv) > 2:
+        print(f'full SAM pass (vit_tiny, encoder + decoder): {time_sam_pass(sys.argv[2], shot) * 1000:.1f} ms/frame')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,102 @@
+"""
+Accuracy and latency of the INT8 quantized encoder (<model>_int8) against the fp32 model on CPU.
+
+Runs outside of blender, needs torch and segment_anything:
+    python benchmarks/bench_quantization.py <path to sam_hq_<model>.pth> [model type] [image] [runs]
+
+Without an image a synthetic plate with a few shapes is used. The first run quantizes the model and
+writes sam_hq_<model>_int8.pth next to the checkpoint. The masks of both models are compared for a box,
+a point and a box + mask prompt, the script fails with exit code 1 if an IoU drops below MIN_IOU.
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+import PIL.Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from functions import engine
+from functions.embedding_cache import compute_embedding, apply_embedding
+from functions.model_registry import predictor_nbytes
+from functions.quantization import QUANTIZED_SUFFIX
+from _common import iou, synthetic_plate
+
+
+MIN_IOU = 0.9
+
+
+
+
+def best_mask(predictor, **prompt):
+    masks, scores, logits = predictor.predict(multimask_output=True, **prompt)
+    best = int(np.argmax(scores))
+    return masks[best], logits[best]
+
+
+def time_encoder(predictor, pixels, runs):
+    compute_embedding(predictor, pixels)
+    start = time.perf_counter()
+    for _ in range(runs):
+        compute_embedding(predictor, pixels)
+    return (time.perf_counter() - start) / runs
+
+
+def main():
+    checkpoint = sys.argv[1]
+    model_type = sys.argv[2] if len(sys.argv) > 2 else 'vit_tiny'
+    pixels = np.asarray(PIL.Image.open(sys.argv[3]).convert('RGB')) if len(sys.argv) > 3 else synthetic_plate()
+    runs = int(sys.argv[4]) if len(sys.argv) > 4 else 5
+
+    import torch
+    fp32_predictor = engine.load_predictor(model_type, checkpoint)
+    # Compare on the same device, the quantized model is CPU only
+    fp32_predictor.model.to('cpu')
+
+    load_start = time.perf_counter()
+    int8_predictor = engine.load_predictor(model_type + QUANTIZED_SUFFIX, checkpoint)
+    print(f'Quantize/load INT8 model: {time.perf_counter() - load_start:.1f} sec')
+
+    for predictor in [fp32_predictor, int8_predictor]:
+        apply_embedding(predictor, compute_embedding(predictor, pixels))
+
+    height, width = pixels.shape[:2]
+    box = np.array([width * 0.3, height * 0.25, width * 0.6, height * 0.8])
+    prompts = {
+        'box': {'box': box},
+        'point': {'point_coords': np.array([[width * 0.45, height * 0.5]]), 'point_labels': np.array([1])},
+    }
+
+    print(f'{model_type}, torch {torch.__version__} with {torch.get_num_threads()} threads')
+    print('prompt         | IoU fp32 vs int8')
+    failed = False
+    for name, prompt in prompts.items():
+        fp32_mask, fp32_logits = best_mask(fp32_predictor, **prompt)
+        int8_mask, _ = best_mask(int8_predictor, **prompt)
+        score = iou(fp32_mask, int8_mask)
+        failed |= score < MIN_IOU
+        print(f'{name:14s} | {score:.4f}')
+
+    # Refine with the fp32 logits as mask prompt, like tracking does from frame to frame
+    prompt = {'box': box, 'mask_input': fp32_logits[None]}
+    score = iou(best_mask(fp32_predictor, **prompt)[0], best_mask(int8_predictor, **prompt)[0])
+    failed |= score < MIN_IOU
+    print(f'{"box + logits":14s} | {score:.4f}')
+
+    print()
+    print('model | encoder sec | size MB | speedup')
+    fp32_time = None
+    for name, predictor in [('fp32', fp32_predictor), ('int8', int8_predictor)]:
+        encoder = time_encoder(predictor, pixels, runs)
+        fp32_time = fp32_time or encoder
+        print(f'{name:5s} | {encoder:11.3f} | {predictor_nbytes(predictor) / 1024**2:7.1f} | {fp32_time / encoder:6.2f}x')
+
+    if failed:
+        print(f'Accuracy check failed, IoU below {MIN_IOU}')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,141 @@
+"""
+Time of the addon register() with stubbed blender modules.
+
+Blender calls register() on every launch, so nothing heavy (torch, segment_anything, shader compilation)
+is allowed to happen in there. Runs outside of blender with plain python:
+    python benchmarks/bench_register.py [runs]
+
+Fails with exit code 1 if register() pulls in one of the heavy modules.
+"""
+
+import os
+import sys
+import time
+import types
+import importlib.util
+
+
+ADDON_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ADDON_PACKAGE = 'rotoforge_bench'
+
+# Modules that must only be imported on first use
+HEAVY_MODULES = ['torch', 'torchvision', 'segment_anything', 'onnxruntime']
+
+
+
+
+class _Anything:
+    """Stands in for every blender object, any attribute access or call returns another stub"""
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __getattr__(self, name):
+        return _Anything()
+
+    def __call__(self, *args, **kwargs):
+        return _Anything()
+
+    def __iter__(self):
+        return iter(())
+
+    def __bool__(self):
+        return False
+
+
+class _StubType(type):
+    # bpy.types.SpaceImageEditor.draw_handler_add(...) and friends
+    def __getattr__(cls, name):
+        return _Anything()
+
+
+class _TypesModule(types.ModuleType):
+    # Every bpy.types.* is a real class, so the addon can subclass it
+    def __getattr__(self, name):
+        cls = _StubType(name, (), {})
+        setattr(self, name, cls)
+        return cls
+
+
+class _StubModule(types.ModuleType):
+    def __getattr__(self, name):
+        return _Anything()
+
+
+def install_blender_stubs():
+    bpy = _StubModule('bpy')
+    bpy.types = _TypesModule('bpy.types')
+    bpy.props = _StubModule('bpy.props')
+    bpy.utils = _StubModule('bpy.utils')
+    bpy.utils.register_class = lambda cls: None
+    bpy.utils.unregister_class = lambda cls: None
+
+    bpy.app = _StubModule('bpy.app')
+    bpy.app.tempdir = os.path.join(os.path.abspath(os.sep), 'tmp')
+    bpy.app.online_access = False
+    bpy.app.handlers = _StubModule('bpy.app.handlers')
+    bpy.app.handlers.persistent = lambda func: func
+    for handler in ['load_pre', 'load_post', 'load_post_fail', 'save_pre', 'save_post',
+                    'depsgraph_update_pre', 'depsgraph_update_post', 'frame_change_pre', 'frame_change_post']:
+        setattr(bpy.app.handlers, handler, [])
+
+    gpu_extras = _StubModule('gpu_extras')
+    gpu_extras.batch = _StubModule('gpu_extras.batch')
+
+    for name, module in [('bpy', bpy), ('bpy.types', bpy.types), ('bpy.props', bpy.props),
+                         ('bpy.utils', bpy.utils), ('bpy.app', bpy.app), ('bpy.app.handlers', bpy.app.handlers),
+                         ('gpu', _StubModule('gpu')), ('gpu_extras', gpu_extras), ('gpu_extras.batch', gpu_extras.batch),
+                         ('mathutils', _StubModule('mathutils'))]:
+        sys.modules[name] = module
+
+
+def unload_addon():
+    for name in list(sys.modules):
+        if name == ADDON_PACKAGE or name.startswith(ADDON_PACKAGE + '.'):
+            del sys.modules[name]
+
+
+def import_addon():
+    spec = importlib.util.spec_from_file_location(ADDON_PACKAGE, os.path.join(ADDON_DIR, '__init__.py'),
+                                                  submodule_search_locations=[ADDON_DIR])
+    addon = importlib.util.module_from_spec(spec)
+    sys.modules[ADDON_PACKAGE] = addon
+    spec.loader.exec_module(addon)
+    return addon
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    install_blender_stubs()
+
+    # The first run is the cold one blender sees on launch, the others show the pure python overhead
+    timings = []
+    for _ in range(runs):
+        unload_addon()
+        start = time.perf_counter()
+        addon = import_addon()
+        addon.register()
+        timings.append(time.perf_counter() - start)
+        addon.unregister()
+
+    print(f'register() cold: {timings[0] * 1000:.1f} ms')
+    if runs > 1:
+        warm = sorted(timings[1:])
+        print(f'register() warm: {warm[len(warm) // 2] * 1000:.1f} ms (median of {runs - 1})')
+
+    # The addon reports import errors in register() instead of raising, so check that everything got registered
+    missing = [module for module in addon.FUNCTION_MODULES if f'{ADDON_PACKAGE}.functions.{module}' not in sys.modules]
+    if missing:
+        print(f'Modules that failed to import: {", ".join(missing)}')
+        return 1
+
+    heavy = [module for module in HEAVY_MODULES if module in sys.modules]
+    if heavy:
+        print(f'register() imported heavy modules: {", ".join(heavy)}')
+        return 1
+    print('No heavy modules imported')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,136 @@
+"""
+Tiled inference on 4K/8K plates: tiles encoded per frame, blend overhead, and with a model time and edge quality.
+
+Tile layout and blending only, an oracle decoder returns the ground truth of each tile, needs numpy and PIL:
+    python benchmarks/bench_tiling.py
+Also compares a single downscaled pass with the tiled one, needs torch and segment_anything:
+    python benchmarks/bench_tiling.py <path to sam_hq_vit_tiny.pth>
+
+The plate is a textured ellipse with a wavy edge over a textured background, the edge IoU only counts the
+pixels within a few pixels of the true edge, which is where the downscaled pass loses detail.
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from functions import engine
+from functions.tiling import tile_boxes, tile_prompt
+from _common import iou, noise_image
+
+
+PLATES = {'4K': (3840, 2160), '8K': (7680, 4320)}
+COVERAGES = (0.3, 0.6, 0.9) # Object size as a fraction of the plate
+EDGE_WIDTH = 4 # Pixels
+
+
+
+
+def render(resolution, coverage):
+    width, height = resolution
+    rng = np.random.default_rng(0)
+    yy, xx = np.mgrid[0:height, 0:width]
+    u, v = (xx - width / 2) / (width * coverage / 2), (yy - height / 2) / (height * coverage / 2)
+    angle = np.arctan2(v, u)
+    mask = u ** 2 + v ** 2 <= (1 + 0.03 * np.sin(angle * 40)) ** 2
+    pixels = noise_image(rng, resolution, 32).copy()
+    pixels[mask] = (pixels[mask] // 2) + 120
+    return pixels, mask
+
+
+def edge_iou(mask, reference):
+    # IoU on the band around the true edge
+    edge = np.zeros_like(reference)
+    for shift in range(-EDGE_WIDTH, EDGE_WIDTH + 1):
+        edge |= reference ^ np.roll(reference, shift, axis=0)
+        edge |= reference ^ np.roll(reference, shift, axis=1)
+    union = np.count_nonzero((mask | reference) & edge)
+    return np.count_nonzero(mask & reference & edge) / union if union else 1.0
+
+
+class OracleEmbedding:
+    def __init__(self, pixels):
+        self.pixels = pixels
+        self.nbytes = 0
+
+
+def bench_oracle():
+    # Replaces the encoder and decoder, what's left is the tile layout, prompt clipping and blending.
+    # The object pixels are marked with a red channel of 255, the decoder returns them inside the box
+    def encode(predictor, crops):
+        return [OracleEmbedding(crop) for crop in crops]
+
+    def apply(predictor, embedding):
+        predictor.embedding = embedding
+
+    def decode(predictor, cropped_area, guide_mask, guide_strength, input_points, input_labels, input_box, input_logits, selection='AREA', previous_mask=None):
+        mask = np.zeros(predictor.embedding.pixels.shape[:2], dtype=bool)
+        x0, y0, x1, y1 = (int(round(value)) for value in input_box)
+        mask[y0:y1, x0:x1] = predictor.embedding.pixels[y0:y1, x0:x1, 0] == 255
+        return mask, np.zeros((256, 256), dtype=np.float32)
+
+    originals = engine.compute_embeddings_batch, engine.apply_embedding, engine.decode_mask
+    engine.compute_embeddings_batch, engine.apply_embedding, engine.decode_mask = encode, apply, decode
+
+    class OraclePredictor:
+        model_type = 'oracle'
+
+    print('plate | object | tiles | encoded | blend ms | mask == ground truth')
+    try:
+        for name, resolution in PLATES.items():
+            for coverage in COVERAGES:
+                pixels, mask = render(resolution, coverage)
+                marked = pixels.copy()
+                marked[..., 0] = np.where(mask, 255, np.minimum(pixels[..., 0], 254))
+                input_box = np.array(engine.calculate_bounding_box(mask))
+                crop, cropping_box, input_logits, crop_box, _ = engine.get_cropped_image(marked, mask, None, input_box, None)
+                guide_mask = engine.crop_array(mask, cropping_box)
+                tiles = tile_boxes(crop.shape[1], crop.shape[0])
+                encoded = sum(tile_prompt(tile, crop_box, None, None, guide_mask) is not None for tile in tiles)
+
+                engine.embedding_cache.clear()
+                start = time.perf_counter()
+                tiled_mask, _ = engine.predict_mask_tiled(crop, OraclePredictor(), guide_mask, 10, None, None, crop_box, input_logits,
+                                                          'plate', 0, cropping_box)
+                elapsed = time.perf_counter() - start
+                same = np.array_equal(engine.uncrop_mask(tiled_mask, cropping_box, resolution), mask)
+                print(f'{name:5s} | {coverage:6.0%} | {len(tiles):5d} | {encoded:7d} | {elapsed * 1000:8.0f} | {same}')
+    finally:
+        engine.compute_embeddings_batch, engine.apply_embedding, engine.decode_mask = originals
+        engine.embedding_cache.clear()
+
+
+def bench_model(checkpoint):
+    predictor = engine.load_predictor('vit_tiny', checkpoint)
+    print('plate | object | pass   | sec/frame | IoU   | edge IoU')
+    for name, resolution in PLATES.items():
+        for coverage in COVERAGES:
+            pixels, mask = render(resolution, coverage)
+            input_box = np.array(engine.calculate_bounding_box(mask))
+            crop, cropping_box, input_logits, crop_box, _ = engine.get_cropped_image(pixels, mask, None, input_box, None)
+            guide_mask = engine.crop_array(mask, cropping_box)
+            for tiled in (False, True):
+                engine.embedding_cache.clear()
+                start = time.perf_counter()
+                if tiled:
+                    best_mask, _ = engine.predict_mask_tiled(crop, predictor, guide_mask, 10, None, None, crop_box, input_logits, 'plate', 0, cropping_box)
+                else:
+                    best_mask, _ = engine.predict_mask(crop, predictor, guide_mask, 10, None, None, crop_box, input_logits)
+                elapsed = time.perf_counter() - start
+                full_mask = engine.uncrop_mask(best_mask, cropping_box, resolution)
+                print(f'{name:5s} | {coverage:6.0%} | {"tiled" if tiled else "single":6s} | {elapsed:9.2f} | {iou(full_mask, mask):.3f} | {edge_iou(full_mask, mask):.3f}')
+    engine.embedding_cache.clear()
+
+
+def main():
+    bench_oracle()
+    if len(sys.argv) > 1:
+        bench_model(sys.argv[1])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
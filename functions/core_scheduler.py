@@ -0,0 +1,282 @@
+import os
+import sys
+import json
+import time
+import tempfile
+import threading
+import contextlib
+
+
+# Splits the CPU cores of a host between concurrent RotoForge processes (blender instances, CLI runs), bpy-free.
+# Every process holds a lock on its own slot file while it lives, the slots are read under a shared
+# scheduler lock, so every process computes the same partition and takes its own slice of it.
+# Threads of torch are a per process setting, so all predictors of a process share its cores.
+# Pinning only touches the threads RotoForge started: its workers claim themselves, the native pools of
+# torch and onnxruntime are claimed by diffing the thread list around loading and inference (see claim_new_threads).
+
+LOCK_DIR_ENV = 'ROTOFORGE_CORE_LOCK_DIR'
+CORES_ENV = 'ROTOFORGE_CPU_CORES' # Explicit core set like 0-15,32-47, skips the coordination
+THREADS_ENV = 'ROTOFORGE_THREADS' # Thread budget of this process
+MODE_ENV = 'ROTOFORGE_CORE_SCHEDULING' # OFF, SHARE or PIN
+
+MODES = ('OFF', 'SHARE', 'PIN')
+
+
+
+
+def parse_core_list(text):
+    # '0-3,8,10-11' -> [0, 1, 2, 3, 8, 10, 11]
+    cores = set()
+    for part in text.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            cores.update(range(int(first), int(last) + 1))
+        else:
+            cores.add(int(part))
+    return sorted(cores)
+
+
+def get_host_cores():
+    # The cores before pinning, a pinned thread would only see its own slice
+    if _original_affinity is not None:
+        return sorted(_original_affinity)
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def list_threads():
+    # Thread ids of this process, empty where they can't be listed
+    if not sys.platform.startswith('linux'):
+        return frozenset()
+    try:
+        return frozenset(int(tid) for tid in os.listdir('/proc/self/task'))
+    except OSError:
+        return frozenset()
+
+
+_original_affinity = None # Affinity before the first pin, unpin_process restores it
+_pinned_cores = None # Cores of the owned threads while pinned
+_owned_threads = set() # Thread ids RotoForge started, the only ones pinning touches
+_owned_lock = threading.Lock()
+
+
+def _set_affinity(tids, cores):
+    for tid in tids:
+        try:
+            os.sched_setaffinity(tid, cores)
+        except OSError:
+            # The thread ended meanwhile
+            pass
+
+
+def claim_threads(tids):
+    # Marks threads as RotoForge's, they follow the current pinning right away
+    if not sys.platform.startswith('linux') or not tids:
+        return
+    with _owned_lock:
+        # Ended threads are dropped so their ids can't be mistaken for new blender threads later
+        _owned_threads.intersection_update(list_threads())
+        _owned_threads.update(tids)
+        if _pinned_cores is not None:
+            _set_affinity(tids, _pinned_cores)
+
+
+def claim_current_thread():
+    # Called first thing in RotoForge's worker threads (also as initializer of its thread pools)
+    claim_threads({threading.get_native_id()})
+
+
+@contextlib.contextmanager
+def claim_new_threads():
+    # Threads started while the block runs belong to RotoForge: torch and onnxruntime start their pools on first use.
+    # A blender thread starting in the same moment would be claimed too, the blocks are kept to model work for that
+    before = list_threads()
+    try:
+        yield
+    finally:
+        claim_threads(list_threads() - before)
+
+
+def pin_process(cores):
+    # Only linux can set the affinity of threads other than the calling one, blender's threads keep their cores
+    global _original_affinity, _pinned_cores
+    if not sys.platform.startswith('linux'):
+        return False
+    with _owned_lock:
+        if _original_affinity is None:
+            _original_affinity = os.sched_getaffinity(0)
+        _owned_threads.intersection_update(list_threads())
+        try:
+            for tid in _owned_threads:
+                os.sched_setaffinity(tid, cores)
+        except (OSError, ValueError) as e:
+            print(f'Pinning to cores {cores} failed: {e}')
+            return False
+        _pinned_cores = cores
+    return True
+
+
+def unpin_process():
+    # Gives the pinned threads their original cores back
+    global _original_affinity, _pinned_cores
+    with _owned_lock:
+        if _original_affinity is None:
+            return
+        _set_affinity(_owned_threads & list_threads(), _original_affinity)
+        _original_affinity = None
+        _pinned_cores = None
+
+
+
+
+def partition(slots, host_cores):
+    # slots: [(slot name, budget)] in claim order, budget 0 means an even share of what the fixed budgets leave.
+    # Returns {slot name: [cores]}, slices wrap around if the budgets oversubscribe the host
+    total = len(host_cores)
+    fixed = sum(budget for _, budget in slots if budget > 0)
+    flexible = sum(1 for _, budget in slots if budget <= 0)
+    share = max(1, (total - fixed) // flexible) if flexible else 0
+
+    assignment = {}
+    start = 0
+    for name, budget in slots:
+        count = min(budget if budget > 0 else share, total)
+        assignment[name] = [host_cores[(start + i) % total] for i in range(count)]
+        start += count
+    return assignment
+
+
+
+
+class CoreScheduler:
+    """Claims a share of the host cores for this process, coordinated through lock files"""
+
+    def __init__(self, lock_dir=None):
+        self.lock_dir = lock_dir or os.environ.get(LOCK_DIR_ENV) or os.path.join(tempfile.gettempdir(), 'rotoforge_cores')
+        self.slot_name = f'{time.time_ns()}_{os.getpid()}'
+        self.budget = 0
+        self._slot_lock = None
+
+    def _slot_path(self, name, ext):
+        return os.path.join(self.lock_dir, f'{name}.{ext}')
+
+    def _claim_slot(self, budget):
+        from filelock import FileLock
+
+        if self._slot_lock is None:
+            os.makedirs(self.lock_dir, exist_ok=True)
+            self._slot_lock = FileLock(self._slot_path(self.slot_name, 'lock'))
+            self._slot_lock.acquire()
+        if budget != self.budget or not os.path.isfile(self._slot_path(self.slot_name, 'json')):
+            with open(self._slot_path(self.slot_name, 'json'), 'w') as file:
+                json.dump({'pid': os.getpid(), 'budget': budget}, file)
+        self.budget = budget
+
+    def _live_slots(self):
+        # Slots whose lock can be taken belong to processes that are gone, those get cleaned up
+        from filelock import FileLock, Timeout
+
+        slots = []
+        for file_name in sorted(os.listdir(self.lock_dir)):
+            name, ext = os.path.splitext(file_name)
+            if ext != '.json':
+                continue
+            if name != self.slot_name:
+                lock = FileLock(self._slot_path(name, 'lock'))
+                try:
+                    lock.acquire(timeout=0)
+                except Timeout:
+                    pass
+                else:
+                    try:
+                        os.remove(self._slot_path(name, 'json'))
+                    except OSError:
+                        pass
+                    lock.release()
+                    try:
+                        os.remove(self._slot_path(name, 'lock'))
+                    except OSError:
+                        pass
+                    continue
+            try:
+                with open(self._slot_path(name, 'json')) as file:
+                    budget = int(json.load(file).get('budget', 0))
+            except (OSError, ValueError):
+                continue
+            # Slot names start with the claim time, so sorting by name keeps the claim order
+            slots.append((name, budget))
+        return slots
+
+    def acquire(self, budget=0):
+        # Returns the cores of this process, recomputed on every call so the shares follow instances coming and going
+        from filelock import FileLock
+
+        os.makedirs(self.lock_dir, exist_ok=True)
+        with FileLock(os.path.join(self.lock_dir, 'scheduler.lock')):
+            self._claim_slot(budget)
+            slots = self._live_slots()
+        return partition(slots, get_host_cores())[self.slot_name]
+
+    def release(self):
+        unpin_process()
+        if self._slot_lock is None:
+            return
+        try:
+            os.remove(self._slot_path(self.slot_name, 'json'))
+        except OSError:
+            pass
+        self._slot_lock.release()
+        try:
+            os.remove(self._slot_path(self.slot_name, 'lock'))
+        except OSError:
+            pass
+        self._slot_lock = None
+
+
+
+
+core_scheduler = CoreScheduler()
+
+
+def get_scheduling(mode='OFF', budget=0):
+    # The environment overrides the preferences, so farm setups can configure headless instances
+    mode = os.environ.get(MODE_ENV, mode).upper()
+    budget = int(os.environ.get(THREADS_ENV, budget) or 0)
+    if mode not in MODES:
+        print(f'Unknown core scheduling mode {mode}, using OFF')
+        mode = 'OFF'
+    return mode, budget
+
+
+def schedule_cores(mode='OFF', budget=0):
+    # Returns the thread count for this process (0 = library default) and pins RotoForge's threads to its cores
+    # with PIN, SHARE only sets the thread budget. OFF gives back the slot and the original affinity
+    mode, budget = get_scheduling(mode, budget)
+    if mode == 'OFF':
+        core_scheduler.release()
+        return budget
+
+    cores_text = os.environ.get(CORES_ENV)
+    if cores_text:
+        cores = parse_core_list(cores_text)
+        if mode == 'PIN':
+            pin_process(cores)
+        else:
+            unpin_process()
+        return len(cores)
+
+    try:
+        cores = core_scheduler.acquire(budget)
+    except Exception as e:
+        # The lock dir might not be writable, fall back to the plain budget
+        print(f'Core scheduling failed: {e}')
+        return budget
+    if mode == 'PIN':
+        pin_process(cores)
+    else:
+        unpin_process()
+    return len(cores)
@@ -0,0 +1,51 @@
+import sys
+import contextlib
+
+
+# CPU execution profile for the torch backend, bpy-free.
+# inference_mode is used on every device, channels_last and the thread counts only matter for models on the CPU.
+
+_default_num_threads = None
+
+
+
+
+def inference_mode():
+    # Cheaper than no_grad, skips the version counters and view tracking of autograd
+    # Without torch loaded (ONNX backend) there is nothing to switch off
+    if 'torch' not in sys.modules:
+        return contextlib.nullcontext()
+    import torch
+    return torch.inference_mode()
+
+
+def set_num_threads(num_threads=0, num_interop_threads=0):
+    # 0 keeps the torch default (one thread per physical core), which competes with blenders own threads
+    global _default_num_threads
+    import torch
+
+    if _default_num_threads is None:
+        _default_num_threads = torch.get_num_threads()
+    num_threads = num_threads if num_threads > 0 else _default_num_threads
+    if torch.get_num_threads() != num_threads:
+        torch.set_num_threads(num_threads)
+
+    # The inter-op pool can only be sized before torch runs its first parallel work
+    if num_interop_threads > 0 and torch.get_num_interop_threads() != num_interop_threads:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError:
+            print(f'Inter-op threads stay at {torch.get_num_interop_threads()}, the change applies after a restart')
+
+
+def apply_cpu_profile(predictor):
+    # channels_last lets oneDNN run the convs of the encoder (patch embedding, neck) without reordering,
+    # on the GPU the default layout is faster
+    import torch
+
+    if getattr(predictor, 'backend', 'torch') != 'torch' or predictor.device.type != 'cpu':
+        predictor.channels_last = False
+        return predictor
+    predictor.model.to(memory_format=torch.channels_last)
+    predictor.channels_last = True
+    return predictor
@@ -5,13 +5,21 @@ import os
 import shutil
 
 from packaging.version import Version
-import numpy as np
-import PIL.Image
-import PIL.ImageFilter
 
 from .constants import EXTENSION_NAME, CURRENT_VERSION
+from .frame_io import DirectoryMaskSink
+from . import embedding_cache
+from .embedding_store import mirror_store
 
 
+# Mask sequence folder -> background job writing into it (generate_masks.BothDirectionsTracking)
+running_jobs = {}
+
+def is_tracking(mask):
+    # True while a background job writes into a layer of the mask, other tracking on the mask has to wait
+    prefix = f"{mask.name}/MaskLayers/"
+    return any(job.running for used_mask, job in running_jobs.items() if used_mask.startswith(prefix))
+
 def get_rotoforge_dir(folder = ''):
     return os.path.join(bpy.app.tempdir, 'RotoForge', folder)
 
@@ -20,32 +28,20 @@ def get_image_filepath_in_dir(dir):
     return os.path.join(dir, frame)
 
 
-def save_sequential_mask(source_image, used_mask, best_mask, cropping_box, blur = 0.0):
-    
-    frame = str(bpy.context.scene.frame_current)
-    width, height = source_image.size
-    
+def get_maskseq_sink(source_image, used_mask):
     # The img seq will be saved in a folder named after the mask in the RotoForge/masksequences dir
+    # The sink doesn't touch bpy when writing, so worker threads can use it
     folder = used_mask 
     img_seq_dir = os.path.join(get_rotoforge_dir('masksequences'), folder)
-    image_path = os.path.join(img_seq_dir, frame + '.png')
-        
-    # Convert Binary Mask to image data
-    best_mask = PIL.Image.fromarray(best_mask)
-    best_mask = best_mask.convert(mode='RGBA')
-    best_mask = best_mask.filter(PIL.ImageFilter.BoxBlur(radius=blur))
-    # Paste the cropped mask in a black image with the original res at the original position if cropping was used
-    if cropping_box is not None:
-        empty_mask = PIL.Image.new('RGBA', (width, height), 'black')
-        empty_mask.paste(best_mask, (int(cropping_box[0]), int(cropping_box[1] + 1)))
-        best_mask = empty_mask
-    # Save the image
-    flipped_mask = best_mask.transpose(PIL.Image.FLIP_TOP_BOTTOM)
-    if not os.path.isdir(img_seq_dir):
-        os.makedirs(img_seq_dir)
-    flipped_mask.save(image_path)
-    best_mask = best_mask.convert(mode='L')
-    return np.asarray(best_mask)
+    return DirectoryMaskSink(img_seq_dir, tuple(source_image.size), flip=True)
+
+def save_sequential_mask(source_image, used_mask, best_mask, cropping_box, blur = 0.0, frame = None):
+    
+    if frame is None:
+        frame = bpy.context.scene.frame_current
+    
+    mask_sink = get_maskseq_sink(source_image, used_mask)
+    return mask_sink.write(frame, best_mask, cropping_box, blur)
 
 def save_singular_mask(source_image, used_mask, best_mask, cropping_box, blur = 0.0):
     # The img will be saved in a folder named after the mask in the RotoForge/masksequences dir
@@ -231,6 +227,13 @@ def sync_mask_update(origin):
 
 
 
+def update_warm_up(self, context):
+    # Starts loading the layers model in the background as soon as it's going to be needed
+    if self.is_rflayer:
+        from .setup_ui import warm_up_predictor
+        warm_up_predictor(context, self.used_model)
+
+
 # This is all the controls that should be part of a layer, but can't be since a MaskLayer is a struct and not an ID
 # So now instead this is bound to a collection property in bpy.types.Mask, which has an entry for each Layer in the mask
 # With that same structure the details can be streamed from there
@@ -243,7 +246,8 @@ class MaskGenControls(bpy.types.PropertyGroup):
     
     is_rflayer :  bpy.props.BoolProperty(
         name = "Activate RotoForge",
-        default = False
+        default = False,
+        update = update_warm_up
     ) # type: ignore
     
     used_model : bpy.props.EnumProperty(
@@ -253,8 +257,13 @@ class MaskGenControls(bpy.types.PropertyGroup):
             ("vit_b", "Base", "Use the base HQ-Sam model that comes with SAM (fast with bad quality)"),
             ("vit_l", "Large", "Use the large HQ-Sam model that comes with SAM (slow with medium quality)"),
             ("vit_h", "Huge", "Use the huge HQ-Sam model that comes with SAM (very slow with best quality)"),
+            ("vit_tiny_int8", "Light INT8", "Light model with INT8 quantized encoder for CPU inference (faster on the CPU, slightly rougher edges)"),
+            ("vit_b_int8", "Base INT8", "Base model with INT8 quantized encoder for CPU inference (faster on the CPU, slightly rougher edges)"),
+            ("vit_l_int8", "Large INT8", "Large model with INT8 quantized encoder for CPU inference (faster on the CPU, slightly rougher edges)"),
+            ("vit_h_int8", "Huge INT8", "Huge model with INT8 quantized encoder for CPU inference (faster on the CPU, slightly rougher edges)"),
         ],
-        default= 'vit_tiny'
+        default= 'vit_tiny',
+        update = update_warm_up
     ) # type: ignore
     
     guide_strength : bpy.props.FloatProperty(
@@ -262,6 +271,28 @@ class MaskGenControls(bpy.types.PropertyGroup):
         default = 10
     ) # type: ignore
     
+    mask_selection : bpy.props.EnumProperty(
+        name = "Mask Selection",
+        description = "How one of the masks the model proposes gets picked",
+        items = [
+            ("AREA", "Guide Area", "Prefer the mask with the area closest to the guide mask"),
+            ("GUIDE_IOU", "Guide Overlap", "Prefer the mask that overlaps the guide mask the most"),
+            ("PREVIOUS_IOU", "Previous Frame Overlap", "Prefer the mask that overlaps the mask of the previous frame the most while tracking"),
+            ("SINGLE", "Single Mask", "Let the model output a single mask (fastest)"),
+        ],
+        default = 'AREA'
+    ) # type: ignore
+    
+    mask_prompt : bpy.props.EnumProperty(
+        name = "Mask Prompt",
+        description = "What the mask prompt of the next frame is built from while tracking",
+        items = [
+            ("GUIDE_MASK", "Previous Mask", "Resize the mask of the previous frame into a mask prompt"),
+            ("LOGITS", "Previous Logits", "Reuse the raw model output of the previous frame, faster and keeps the object more stable"),
+        ],
+        default = 'GUIDE_MASK'
+    ) # type: ignore
+    
     feather_radius : bpy.props.FloatProperty(
         name = "Feather Radius",
         default = 0.2,
@@ -278,6 +309,105 @@ class MaskGenControls(bpy.types.PropertyGroup):
         default = 10
     ) # type: ignore
     
+    flow_mode : bpy.props.EnumProperty(
+        name = "Optical Flow",
+        description = "Move the mask of the previous frame to the current one with optical flow while tracking",
+        items = [
+            ("NONE", "Off", "Run the model on every frame with the previous mask as prompt"),
+            ("PROMPT", "Prompt", "Prompt the model with the moved mask, follows moving objects more closely"),
+            ("PROPAGATE", "Propagate", "Use the moved mask without running the model, very fast but drifts over time"),
+        ],
+        default = 'NONE'
+    ) # type: ignore
+    
+    box_prediction : bpy.props.EnumProperty(
+        name = "Box Prediction",
+        description = "How the search box of the next frame is predicted while tracking",
+        items = [
+            ("FIXED", "Search Radius", "Pad the box of the current mask by the search radius"),
+            ("KALMAN", "Motion Model", "Predict the box from the motion of the object and pad it by how uncertain the prediction is. Follows fast objects and keeps the box tight on steady ones, the search radius is not used"),
+        ],
+        default = 'FIXED'
+    ) # type: ignore
+    
+    skip_threshold : bpy.props.FloatProperty(
+        name = "Skip Threshold",
+        description = "Reuse the last mask instead of running the model while the search area changed less than this since the last computed frame (mean pixel difference). 0 runs the model on every frame",
+        default = 0.0,
+        min = 0.0,
+        soft_max = 0.1,
+        max = 1.0,
+        precision = 3
+    ) # type: ignore
+    
+    skip_max_frames : bpy.props.IntProperty(
+        name = "Max Skipped Frames",
+        description = "Run the model at least every this many frames, even if nothing changed. 0 means no limit",
+        default = 10,
+        min = 0
+    ) # type: ignore
+    
+    skip_follow_motion : bpy.props.BoolProperty(
+        name = "Follow Motion",
+        description = "Move the reused mask along with the estimated motion of the search area",
+        default = True
+    ) # type: ignore
+    
+    keyframe_mode : bpy.props.EnumProperty(
+        name = "Keyframes",
+        description = "Which frames the model runs on while tracking, the frames in between are interpolated",
+        items = [
+            ("EVERY", "Every Frame", "Run the model on every frame"),
+            ("INTERVAL", "Interval", "Run the model on every Nth frame and interpolate the frames in between"),
+            ("ADAPTIVE", "Adaptive", "Run the model up to every Nth frame, more often the faster the object moves"),
+        ],
+        default = 'EVERY'
+    ) # type: ignore
+    
+    keyframe_interval : bpy.props.IntProperty(
+        name = "Keyframe Interval",
+        description = "Frames from one keyframe to the next (at most, in adaptive mode). Keyframes that don't agree get a keyframe in between",
+        default = 4,
+        min = 2,
+        soft_max = 16
+    ) # type: ignore
+    
+    keyframe_motion : bpy.props.FloatProperty(
+        name = "Keyframe Motion",
+        description = "How far the object may move between two keyframes in adaptive mode, fraction of its size",
+        default = 0.1,
+        min = 0.01,
+        max = 1.0,
+        precision = 2
+    ) # type: ignore
+    
+    prefetch : bpy.props.BoolProperty(
+        name = "Prefetch Next Frame",
+        description = "Load and encode the next frame in the background while the current mask is saved",
+        default = True
+    ) # type: ignore
+    
+    coarse_pass : bpy.props.BoolProperty(
+        name = "Coarse Pass",
+        description = "Find the object with vit_tiny on the whole downscaled frame first, the selected model then only encodes a tight crop around it. Needs vit_tiny to be installed",
+        default = False
+    ) # type: ignore
+    
+    tiled_inference : bpy.props.BoolProperty(
+        name = "Tiled Inference",
+        description = "Encode large crops (4K/8K plates, objects covering most of the frame) as overlapping tiles at native resolution instead of downscaling them. Slower, but keeps the edge detail",
+        default = False
+    ) # type: ignore
+    
+    encoder_batch_size : bpy.props.IntProperty(
+        name = "Encoder Batch Size",
+        description = "Number of upcoming frames that are encoded together in one pass while tracking. 1 encodes frame by frame",
+        default = 1,
+        min = 1,
+        soft_max = 8,
+        max = 32
+    ) # type: ignore
+    
     @classmethod 
     def register(cls):
         bpy.types.Mask.rotoforge_maskgencontrols = bpy.props.CollectionProperty(type=cls)
@@ -303,6 +433,9 @@ def prepare_new_project(origin):
     if os.path.isdir(tmp_path):
         shutil.rmtree(tmp_path)
     os.makedirs(tmp_path)
+    # The embedding store keeps its folder, its index has to be rebuilt from what load_project copies in
+    if embedding_cache.embedding_store is not None:
+        embedding_cache.embedding_store.reset_index()
     
     # Loads the pre_update_masks
     global pre_update_masks
@@ -345,9 +478,30 @@ def save_project(origin):
     local_path = bpy.path.abspath('//RotoForge')
     # Copies all files from tmp to local
     if os.path.isdir(tmp_path):
-        if os.path.isdir(local_path):
-            shutil.rmtree(local_path, ignore_errors=True)
-        shutil.copytree(tmp_path, local_path, dirs_exist_ok=True)
+        # Background jobs stop between two masks until the copy is done, so no half written frame gets saved
+        jobs = [job for job in running_jobs.values() if job.running]
+        for job in jobs:
+            job.pause()
+        try:
+            copy_project(tmp_path, local_path)
+        finally:
+            for job in jobs:
+                job.resume()
+
+def copy_project(tmp_path, local_path):
+    # The embeddings can be GBs, they are mirrored entry by entry instead of copied on every save
+    if os.path.isdir(local_path):
+        for name in os.listdir(local_path):
+            if name == 'embeddings':
+                continue
+            path = os.path.join(local_path, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+    shutil.copytree(tmp_path, local_path, dirs_exist_ok=True,
+                    ignore=lambda directory, names: ['embeddings'] if directory == tmp_path else [])
+    mirror_store(os.path.join(tmp_path, 'embeddings'), os.path.join(local_path, 'embeddings'))
 
 
 
@@ -0,0 +1,241 @@
+import threading
+from collections import OrderedDict
+import hashlib
+
+import numpy as np
+import PIL.Image
+
+from .core_scheduler import claim_new_threads
+
+
+# This module is bpy-free on purpose, it only needs numpy, PIL and (lazily) torch
+# Embeddings are torch tensors for the torch backend and numpy arrays for the ONNX backend (see onnx_backend.py)
+
+
+
+
+class ImageEmbedding:
+    """Holds everything SamPredictor.set_image computes for one image"""
+    __slots__ = ('features', 'interm_features', 'original_size', 'input_size')
+
+    def __init__(self, features, interm_features, original_size, input_size):
+        self.features = features
+        # The HQ decoder only reads the first interm embedding (early ViT feature),
+        # so the other ones are dropped to keep the memory footprint down
+        self.interm_features = list(interm_features[:1])
+        self.original_size = tuple(original_size)
+        self.input_size = tuple(input_size)
+
+    @property
+    def nbytes(self):
+        total = 0
+        for tensor in [self.features, *self.interm_features]:
+            if isinstance(tensor, np.ndarray):
+                total += tensor.nbytes
+            else:
+                total += tensor.element_size() * tensor.nelement()
+        return total
+
+
+def to_numpy(tensor):
+    if isinstance(tensor, np.ndarray):
+        return tensor
+    return tensor.detach().cpu().numpy()
+
+
+def get_preprocess_shape(old_h, old_w, long_side_length):
+    # Same as ResizeLongestSide.get_preprocess_shape
+    scale = long_side_length * 1.0 / max(old_h, old_w)
+    return int(old_h * scale + 0.5), int(old_w * scale + 0.5)
+
+
+def resize_longest_side(pixels_uint8_rgb, long_side_length):
+    # Same result as ResizeLongestSide.apply_image, but resamples the (possibly strided) crop view in one
+    # PIL resize without the torchvision round trip
+    height, width = pixels_uint8_rgb.shape[:2]
+    new_h, new_w = get_preprocess_shape(height, width, long_side_length)
+    image = PIL.Image.fromarray(np.ascontiguousarray(pixels_uint8_rgb))
+    if (new_w, new_h) != image.size:
+        image = image.resize((new_w, new_h), PIL.Image.BILINEAR)
+    return np.array(image)
+
+
+def prepare_image(predictor, pixels_uint8_rgb):
+    # Resizes the image to the encoder resolution, returns a 1x3xHxW tensor
+    import torch
+
+    image = pixels_uint8_rgb
+    if predictor.model.image_format != 'RGB':
+        image = image[..., ::-1]
+
+    input_image = resize_longest_side(image, predictor.transform.target_length)
+    input_image_torch = torch.as_tensor(input_image, device=predictor.device)
+    return input_image_torch.permute(2, 0, 1).contiguous()[None, :, :, :]
+
+
+def compute_embedding(predictor, pixels_uint8_rgb):
+    # Does the same as predictor.set_image, but returns the result instead of storing it in the predictor
+    return compute_embeddings_batch(predictor, [pixels_uint8_rgb])[0]
+
+
+def compute_embeddings_batch(predictor, pixels_uint8_rgb_list):
+    # Encodes several images in one forward pass of the image encoder
+    # The pools torch or onnxruntime start on first use are RotoForge's threads (see core_scheduler.py)
+    with claim_new_threads():
+        return _encode_batch(predictor, pixels_uint8_rgb_list)
+
+
+def _encode_batch(predictor, pixels_uint8_rgb_list):
+    if getattr(predictor, 'backend', 'torch') != 'torch':
+        return predictor.compute_embeddings(pixels_uint8_rgb_list)
+
+    import torch
+
+    input_images = [prepare_image(predictor, pixels_uint8_rgb) for pixels_uint8_rgb in pixels_uint8_rgb_list]
+
+    with torch.inference_mode():
+        # preprocess pads every image to the square encoder input, so they can be stacked
+        batch = torch.cat([predictor.model.preprocess(input_image) for input_image in input_images], dim=0)
+        if getattr(predictor, 'channels_last', False):
+            batch = batch.contiguous(memory_format=torch.channels_last)
+        features, interm_features = predictor.model.image_encoder(batch)
+
+    embeddings = []
+    for i, (pixels_uint8_rgb, input_image) in enumerate(zip(pixels_uint8_rgb_list, input_images)):
+        # Clone the slices of a batch, otherwise every cached entry would keep the whole batch alive
+        if len(input_images) > 1:
+            image_features = features[i:i+1].clone()
+            image_interm_features = [interm[i:i+1].clone() for interm in interm_features[:1]]
+        else:
+            image_features = features
+            image_interm_features = interm_features[:1]
+        embeddings.append(ImageEmbedding(image_features,
+                                         image_interm_features,
+                                         pixels_uint8_rgb.shape[:2],
+                                         input_image.shape[-2:]))
+    return embeddings
+
+
+def apply_embedding(predictor, embedding):
+    # Loads a precomputed embedding into the predictor so predictor.predict can be used right away
+    predictor.reset_image()
+    predictor.original_size = embedding.original_size
+    predictor.input_size = embedding.input_size
+    predictor.features = embedding.features
+    predictor.interm_features = embedding.interm_features
+    predictor.is_image_set = True
+
+
+def image_fingerprint(pixels_uint8_rgb, stride=16):
+    # Cheap checksum of a strided subsample, catches repainted or reloaded images without hashing every pixel
+    sample = np.ascontiguousarray(pixels_uint8_rgb[::stride, ::stride])
+    return hashlib.blake2b(sample.tobytes(), digest_size=8).hexdigest()
+
+
+def content_hash(pixels_uint8_rgb):
+    # Identifies the cropped pixels independently of the image name, frame or crop position
+    pixels = np.ascontiguousarray(pixels_uint8_rgb)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str(pixels.shape).encode())
+    digest.update(pixels.tobytes())
+    return digest.hexdigest()
+
+
+
+
+class EmbeddingCache:
+    """Memory bounded LRU of image embeddings"""
+
+    def __init__(self, max_bytes=1024 * 1024**2):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            embedding = self._entries.get(key)
+            if embedding is not None:
+                self._entries.move_to_end(key)
+            return embedding
+
+    def put(self, key, embedding):
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._entries.pop(key).nbytes
+
+            # Don't bother caching embeddings that would evict everything else
+            if embedding.nbytes > self.max_bytes:
+                return
+
+            self._entries[key] = embedding
+            self._size += embedding.nbytes
+            self._evict()
+
+    def set_max_bytes(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def remove_model(self, model_type):
+        # Keys are (source, frame, cropping box, model type, fingerprint)
+        with self._lock:
+            for key in [key for key in self._entries if key[3] == model_type]:
+                self._size -= self._entries.pop(key).nbytes
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._entries:
+            _, embedding = self._entries.popitem(last=False)
+            self._size -= embedding.nbytes
+
+    @property
+    def size(self):
+        return self._size
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+
+embedding_cache = EmbeddingCache()
+embedding_store = None # Optional EmbeddingStore (see embedding_store.py), set by the UI
+
+
+def set_embedding_store(store):
+    global embedding_store
+    embedding_store = store
+
+
+def get_embedding(predictor, pixels_uint8_rgb, key):
+    # Memory cache -> disk store -> image encoder
+    embedding = embedding_cache.get(key)
+    if embedding is not None:
+        return embedding
+
+    model_type = getattr(predictor, 'model_type', None)
+    store = embedding_store
+    if store is not None:
+        disk_key = content_hash(pixels_uint8_rgb)
+        embedding = store.load(model_type, disk_key, device=predictor.device)
+
+    if embedding is None:
+        embedding = compute_embedding(predictor, pixels_uint8_rgb)
+        if store is not None:
+            store.save(model_type, disk_key, embedding)
+
+    embedding_cache.put(key, embedding)
+    return embedding
+
+
+def set_image_cached(predictor, pixels_uint8_rgb, key):
+    # Looks up the embedding for the key and only runs the image encoder on a miss
+    embedding = get_embedding(predictor, pixels_uint8_rgb, key)
+    apply_embedding(predictor, embedding)
+    return embedding
@@ -0,0 +1,187 @@
+import os
+import json
+import shutil
+import threading
+
+import numpy as np
+
+from .embedding_cache import ImageEmbedding, to_numpy
+
+
+# On-disk counterpart of the EmbeddingCache, so encoder results survive restarts of blender
+# Every entry is a folder with memory-mapped .npy files:
+#   <root>/<model_type>/<content_hash>/features.npy
+#   <root>/<model_type>/<content_hash>/interm.npy
+#   <root>/<model_type>/<content_hash>/meta.json
+# The mtime of meta.json is used as the last access time for the LRU eviction
+
+FEATURES_FILE = 'features.npy'
+INTERM_FILE = 'interm.npy'
+META_FILE = 'meta.json'
+TMP_SUFFIX = '.tmp'
+
+
+
+class EmbeddingStore:
+    """Disk bounded LRU of image embeddings"""
+
+    def __init__(self, root, max_bytes=1024 * 1024**2):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._index = None # entry dir -> (last access, size in bytes), built on first use
+
+    def _entry_dir(self, model_type, key):
+        return os.path.join(self.root, str(model_type), key)
+
+    def _index_entry(self, entry_dir):
+        meta_path = os.path.join(entry_dir, META_FILE)
+        size = sum(os.path.getsize(os.path.join(entry_dir, file)) for file in os.listdir(entry_dir))
+        self._index[entry_dir] = (os.path.getmtime(meta_path), size)
+
+    def _build_index(self):
+        self._index = {}
+        if not os.path.isdir(self.root):
+            return
+        for model_type in os.listdir(self.root):
+            model_dir = os.path.join(self.root, model_type)
+            if not os.path.isdir(model_dir):
+                continue
+            for key in os.listdir(model_dir):
+                entry_dir = os.path.join(model_dir, key)
+                if key.endswith(TMP_SUFFIX) or not os.path.isfile(os.path.join(entry_dir, META_FILE)):
+                    # Leftover of an interrupted write, a temp folder can be complete but was never moved in place
+                    shutil.rmtree(entry_dir, ignore_errors=True)
+                    continue
+                self._index_entry(entry_dir)
+
+    def _ensure_index(self):
+        if self._index is None:
+            self._build_index()
+
+    def load(self, model_type, key, device='cpu'):
+        # device None returns the numpy arrays instead of torch tensors (ONNX backend)
+        with self._lock:
+            self._ensure_index()
+            entry_dir = self._entry_dir(model_type, key)
+            if entry_dir not in self._index:
+                return None
+
+            try:
+                with open(os.path.join(entry_dir, META_FILE), 'r', encoding='utf-8') as file:
+                    meta = json.load(file)
+                # Copy-on-write maps keep the pages on disk until torch actually reads them
+                features = np.load(os.path.join(entry_dir, FEATURES_FILE), mmap_mode='c')
+                interm = np.load(os.path.join(entry_dir, INTERM_FILE), mmap_mode='c')
+            except (OSError, ValueError):
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                del self._index[entry_dir]
+                return None
+
+            # Mark as recently used
+            os.utime(os.path.join(entry_dir, META_FILE))
+            self._index[entry_dir] = (os.path.getmtime(os.path.join(entry_dir, META_FILE)), self._index[entry_dir][1])
+
+        if device is not None:
+            import torch
+            features = torch.from_numpy(features).to(device)
+            interm = torch.from_numpy(interm).to(device)
+        return ImageEmbedding(features, [interm], meta['original_size'], meta['input_size'])
+
+    def save(self, model_type, key, embedding):
+        if self.max_bytes <= 0:
+            return
+
+        features = to_numpy(embedding.features)
+        interm = to_numpy(embedding.interm_features[0])
+        if features.nbytes + interm.nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            self._ensure_index()
+            entry_dir = self._entry_dir(model_type, key)
+            if entry_dir in self._index:
+                return
+
+            # Write into a temp folder first so a crash never leaves a half written entry behind
+            tmp_dir = entry_dir + TMP_SUFFIX
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            os.makedirs(tmp_dir)
+            np.save(os.path.join(tmp_dir, FEATURES_FILE), features)
+            np.save(os.path.join(tmp_dir, INTERM_FILE), interm)
+            with open(os.path.join(tmp_dir, META_FILE), 'w', encoding='utf-8') as file:
+                json.dump({'original_size': list(embedding.original_size),
+                           'input_size': list(embedding.input_size)}, file)
+            try:
+                os.replace(tmp_dir, entry_dir)
+            except OSError:
+                # Another process (or blender instance) stored the same embedding meanwhile, keep theirs
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                if not os.path.isfile(os.path.join(entry_dir, META_FILE)):
+                    return
+
+            self._index_entry(entry_dir)
+            self._evict()
+
+    def reset_index(self):
+        # The folder was replaced behind the store's back (another project got loaded), rebuilt on next use
+        with self._lock:
+            self._index = None
+
+    def set_max_bytes(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            if self._index is not None:
+                self._evict()
+
+    def clear(self):
+        with self._lock:
+            shutil.rmtree(self.root, ignore_errors=True)
+            self._index = {}
+
+    def _evict(self):
+        total = sum(size for _, size in self._index.values())
+        for entry_dir, (_, size) in sorted(self._index.items(), key=lambda item: item[1][0]):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            del self._index[entry_dir]
+            total -= size
+
+    @property
+    def size(self):
+        with self._lock:
+            self._ensure_index()
+            return sum(size for _, size in self._index.values())
+
+
+
+def mirror_store(src_root, dst_root):
+    # Makes dst_root hold the same entries as src_root. Entries never change once written (the key is the
+    # content hash), so only new ones get copied and evicted ones removed, unchanged entries cost nothing
+    src_entries = set()
+    if os.path.isdir(src_root):
+        for model_type in os.listdir(src_root):
+            model_dir = os.path.join(src_root, model_type)
+            if not os.path.isdir(model_dir):
+                continue
+            for key in os.listdir(model_dir):
+                if not key.endswith(TMP_SUFFIX) and os.path.isfile(os.path.join(model_dir, key, META_FILE)):
+                    src_entries.add((model_type, key))
+
+    if os.path.isdir(dst_root):
+        for model_type in os.listdir(dst_root):
+            model_dir = os.path.join(dst_root, model_type)
+            if not os.path.isdir(model_dir):
+                continue
+            for key in os.listdir(model_dir):
+                if (model_type, key) not in src_entries:
+                    shutil.rmtree(os.path.join(model_dir, key), ignore_errors=True)
+
+    for model_type, key in src_entries:
+        dst_dir = os.path.join(dst_root, model_type, key)
+        if not os.path.isdir(dst_dir):
+            # Copied under the temp name first, like EmbeddingStore.save, so an interrupted save leaves no broken entry
+            shutil.rmtree(dst_dir + TMP_SUFFIX, ignore_errors=True)
+            shutil.copytree(os.path.join(src_root, model_type, key), dst_dir + TMP_SUFFIX)
+            os.replace(dst_dir + TMP_SUFFIX, dst_dir)
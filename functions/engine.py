@@ -0,0 +1,861 @@
+import sys
+import copy
+import threading
+import warnings
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+import numpy as np
+import PIL.Image
+
+from .prompt_utils import fake_logits, carry_logits, calculate_bounding_box
+from .embedding_cache import set_image_cached, image_fingerprint, embedding_cache, compute_embeddings_batch, compute_embedding, apply_embedding, resize_longest_side
+from .quantization import split_model_type, load_quantized_sam
+from .cpu_profile import inference_mode, set_num_threads, apply_cpu_profile
+from .mask_selection import select_mask
+from .tiling import TILE_SIZE, TILE_BATCH, needs_tiling, tile_boxes, tile_prompt, TileBlend
+from .prefetch import EncoderPrefetcher
+from .frame_io import crop_rectangle
+from .core_scheduler import claim_new_threads, claim_current_thread
+
+
+# The numeric tracking pipeline, without any bpy dependency.
+# Frames come from a FrameSource and masks go to a MaskSink (see frame_io.py),
+# so the same code runs in the blender operators and in the headless CLI (rotoforge_cli.py)
+
+
+
+
+def empty_device_cache():
+    # torch is imported lazily everywhere, importing it takes seconds and would slow down blender startup
+    # Without torch loaded (ONNX backend) there is no device cache to empty
+    if 'torch' not in sys.modules:
+        return
+    import torch
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def load_predictor(model_type, sam_checkpoint, backend='torch', onnx_dir=None, num_threads=0, num_interop_threads=0):
+    # Thread counts of 0 keep the library defaults
+    # The pools torch or onnxruntime start meanwhile are RotoForge's threads (see core_scheduler.py)
+    with claim_new_threads():
+        if backend == 'onnx':
+            from .onnx_backend import load_onnx_predictor
+            return load_onnx_predictor(model_type, sam_checkpoint, onnx_dir, num_threads=num_threads)
+
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", category=UserWarning)
+            import torch
+            import torchvision # Needed since submodules use it.
+            import segment_anything
+
+            # Empty the memory cache before to clean up any mess that's been handed over
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+            # Debug info
+            print("PyTorch version: ", torch.__version__)
+
+            set_num_threads(num_threads, num_interop_threads)
+
+            # Quantized models only run on the CPU
+            base_model_type, quantized = split_model_type(model_type)
+            if torch.cuda.is_available() and not quantized:
+                print("Using CUDA accelleration")
+                device = "cuda"
+            else:
+                print("Using CPU")
+                device = "cpu"
+
+            # Fetch predictor
+            print('loading predictor')
+
+            if quantized:
+                sam = load_quantized_sam(base_model_type, sam_checkpoint)
+            else:
+                sam = segment_anything.sam_model_registry[model_type](checkpoint=sam_checkpoint)
+            sam.to(device=device)
+
+            predictor = segment_anything.SamPredictor(sam)
+            predictor.model_type = model_type
+            apply_cpu_profile(predictor)
+
+            print('loaded predictor')
+
+            # Empty the memory cache after using SAM because Meta forgot
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+        return predictor
+
+
+
+
+CROPPING_RADIUS = 0.05
+
+# What the mask prompt of a tracked frame is built from:
+# GUIDE_MASK:  the mask of the previous frame, squared and resized to the low res logits with PIL
+# LOGITS:      the low res logits of the previous frame, re-aligned to the new crop
+MASK_PROMPTS = ('GUIDE_MASK', 'LOGITS')
+
+def get_cropping_box(width, height, input_box):
+    cropping_radius = CROPPING_RADIUS
+    return input_box + np.array([-width*cropping_radius, -height*cropping_radius, width*cropping_radius, height*cropping_radius])
+
+
+def crop_array(array, cropping_box):
+    # Crops like PIL.Image.crop: the box gets rounded and the parts outside of the array are zero padded.
+    # A box inside the array returns a view, no pixels are copied
+    x0, y0, x1, y1 = crop_rectangle(cropping_box)
+    height, width = array.shape[:2]
+    if x0 >= 0 and y0 >= 0 and x1 <= width and y1 <= height:
+        return array[y0:y1, x0:x1]
+
+    cropped = np.zeros((max(y1 - y0, 0), max(x1 - x0, 0)) + array.shape[2:], dtype=array.dtype)
+    inner_x0, inner_y0, inner_x1, inner_y1 = max(x0, 0), max(y0, 0), min(x1, width), min(y1, height)
+    if inner_x1 > inner_x0 and inner_y1 > inner_y0:
+        cropped[inner_y0 - y0:inner_y1 - y0, inner_x0 - x0:inner_x1 - x0] = array[inner_y0:inner_y1, inner_x0:inner_x1]
+    return cropped
+
+
+def uncrop_mask(mask, cropping_box, resolution):
+    # Puts a mask predicted on a crop back into an empty full frame mask, the inverse of crop_array
+    if cropping_box is None:
+        return mask
+    width, height = resolution
+    x0, y0, x1, y1 = crop_rectangle(cropping_box)
+    full_mask = np.zeros((height, width), dtype=mask.dtype)
+    inner_x0, inner_y0, inner_x1, inner_y1 = max(x0, 0), max(y0, 0), min(x1, width), min(y1, height)
+    if inner_x1 > inner_x0 and inner_y1 > inner_y0:
+        full_mask[inner_y0:inner_y1, inner_x0:inner_x1] = mask[inner_y0 - y0:inner_y1 - y0, inner_x0 - x0:inner_x1 - x0]
+    return full_mask
+
+
+def rgb_view(pixels_uint8):
+    # Drops the alpha of RGBA frames without copying
+    return pixels_uint8[:, :, :3]
+
+
+def get_union_cropping_box(width, height, input_boxes, max_coverage=0.8):
+    # One crop that contains the crops of all boxes, None (= full frame) if they don't fit into a reasonable crop
+    if len(input_boxes) == 0 or any(input_box is None for input_box in input_boxes):
+        return None
+    cropping_boxes = np.array([get_cropping_box(width, height, input_box) for input_box in input_boxes])
+    union_box = np.array([cropping_boxes[:, 0].min(), cropping_boxes[:, 1].min(), cropping_boxes[:, 2].max(), cropping_boxes[:, 3].max()])
+    union_box = np.clip(union_box, 0, [width, height, width, height])
+    if (union_box[2] - union_box[0]) * (union_box[3] - union_box[1]) > max_coverage * width * height:
+        return None
+    return union_box
+
+
+def get_batch_cropping_box(width, height, input_box, search_radius, batch_size):
+    # A crop that leaves room for the object to move search_radius pixels per frame over the whole batch
+    margin = search_radius * (batch_size - 1)
+    cropping_box = get_cropping_box(width, height, input_box) + np.array([-margin, -margin, margin, margin])
+    return np.clip(cropping_box, 0, [width, height, width, height])
+
+
+def box_inside(inner_box, outer_box):
+    return (inner_box[0] >= outer_box[0] and inner_box[1] >= outer_box[1] and
+            inner_box[2] <= outer_box[2] and inner_box[3] <= outer_box[3])
+
+
+def get_next_input_box(best_mask, cropping_box, search_radius, box_predictor=None):
+    # Pads the bounding box of the mask by the search radius and moves it back into full frame coords.
+    # With a box_predictor (see motion_model.py) the box is its prediction padded by its uncertainty instead
+    next_input_box = calculate_bounding_box(best_mask)
+    if next_input_box is None:
+        return None
+    if box_predictor is not None:
+        mask_box = np.array(next_input_box, dtype=np.float64)
+        if cropping_box is not None:
+            mask_box += np.array([cropping_box[0], cropping_box[1], cropping_box[0], cropping_box[1]])
+        box_predictor.update(mask_box)
+        return box_predictor.predict_box()
+    next_input_box = np.array([next_input_box[0] - search_radius, next_input_box[1] - search_radius, next_input_box[2] + search_radius, next_input_box[3] + search_radius])
+    if cropping_box is not None:
+        next_input_box = np.array([next_input_box[0] + cropping_box[0], next_input_box[1] + cropping_box[1], next_input_box[2] + cropping_box[0], next_input_box[3] + cropping_box[1]])
+    return next_input_box
+
+
+
+def get_cropped_image(pixels_uint8_rgba, guide_mask, input_points, input_box, input_logits, cropping_box=None):
+    # Determine the dimensions of the image
+    width = pixels_uint8_rgba.shape[1]
+    height = pixels_uint8_rgba.shape[0]
+
+    # Works on views of the frame, only crops that reach outside of the frame get copied (padded)
+    pixels_uint8_rgb = rgb_view(pixels_uint8_rgba)
+
+    # Crop to box if box is supported
+    if input_box is not None:
+        if cropping_box is None:
+            cropping_box = get_cropping_box(width, height, input_box)
+        pixels_uint8_rgb = crop_array(pixels_uint8_rgb, cropping_box)
+        if input_points is not None:
+            input_points = input_points - [cropping_box[0], cropping_box[1]]
+        input_box = np.array([input_box[0] - cropping_box[0], input_box[1] - cropping_box[1], input_box[2] - cropping_box[0], input_box[3] - cropping_box[1]])
+
+        if input_logits is not None:
+            input_logits = np.array([input_logits])
+        else:
+            input_logits = fake_logits(PIL.Image.fromarray(crop_array(guide_mask, cropping_box)))
+    else:
+        input_logits = None
+        cropping_box = None
+
+    return pixels_uint8_rgb, cropping_box, input_logits, input_box, input_points
+
+
+
+
+
+
+def get_embedding_key(source_name, frame, cropping_box, predictor, pixels_uint8_rgb):
+    # Identifies an encoder result: same image, frame, crop and model means the same embedding
+    if cropping_box is not None:
+        cropping_box = crop_rectangle(cropping_box)
+    return (source_name, frame, cropping_box, getattr(predictor, 'model_type', None), image_fingerprint(pixels_uint8_rgb))
+
+
+
+def predict_mask(pixels_uint8_rgb, predictor, guide_mask, guide_strength, input_points, input_labels, input_box, input_logits, embedding_key=None, selection='AREA', previous_mask=None):
+    # Generate mask, guide_mask and previous_mask have to be in the coords of pixels_uint8_rgb (see mask_selection.py)
+    if embedding_key is not None:
+        set_image_cached(predictor, pixels_uint8_rgb, embedding_key)
+    else:
+        # Same as predictor.set_image, but runs with the cpu profile of the predictor
+        apply_embedding(predictor, compute_embedding(predictor, pixels_uint8_rgb))
+    cropped_area = pixels_uint8_rgb.shape[0] * pixels_uint8_rgb.shape[1]
+    return decode_mask(predictor, cropped_area, guide_mask, guide_strength, input_points, input_labels, input_box, input_logits, selection, previous_mask)
+
+
+
+def predict_mask_tiled(pixels_uint8_rgb, predictor, guide_mask, guide_strength, input_points, input_labels, input_box, input_logits, source_name, frame, cropping_box, selection='AREA', previous_mask=None, tile_size=TILE_SIZE):
+    # Same as predict_mask, but encodes the crop as overlapping tiles at native resolution (see tiling.py).
+    # The prompt is in the coords of pixels_uint8_rgb, input_logits cover the square of its long side
+    height, width = pixels_uint8_rgb.shape[:2]
+    crop_x, crop_y = (0, 0) if cropping_box is None else crop_rectangle(cropping_box)[:2]
+    tiles = []
+    for tile in tile_boxes(width, height, tile_size):
+        prompt = tile_prompt(tile, input_box, input_points, input_labels, guide_mask)
+        if prompt is not None:
+            tiles.append((tile, prompt))
+
+    blend = TileBlend(width, height)
+    for start in range(0, len(tiles), TILE_BATCH):
+        chunk = tiles[start:start + TILE_BATCH]
+
+        # Encode the tiles of the chunk that aren't cached in one pass, only the embeddings of one chunk are kept here
+        crops = [crop_array(pixels_uint8_rgb, tile) for tile, _ in chunk]
+        keys = [get_embedding_key(source_name, frame, (x0 + crop_x, y0 + crop_y, x1 + crop_x, y1 + crop_y), predictor, crop)
+                for ((x0, y0, x1, y1), _), crop in zip(chunk, crops)]
+        embeddings = [embedding_cache.get(key) for key in keys]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            for i, embedding in zip(missing, compute_embeddings_batch(predictor, [crops[i] for i in missing])):
+                embeddings[i] = embedding
+                embedding_cache.put(keys[i], embedding)
+
+        for (tile, (box, points, labels)), crop, embedding in zip(chunk, crops, embeddings):
+            apply_embedding(predictor, embedding)
+            tile_logits = None if input_logits is None else carry_logits(input_logits[0], (0, 0, width, height), tile)[None]
+            tile_guide = None if guide_mask is None else crop_array(guide_mask, tile)
+            tile_previous = None if previous_mask is None else crop_array(previous_mask, tile)
+            mask, logits = decode_mask(predictor, crop.shape[0] * crop.shape[1], tile_guide, guide_strength, points, labels, box, tile_logits, selection, tile_previous)
+            blend.add(tile, mask, logits)
+    return blend.result()
+
+
+
+COARSE_MODEL = 'vit_tiny' # Cheapest model, localizes the object for the selected one
+COARSE_SIZE = 1024 # Long side of the downscaled frame the coarse model sees, the encoder input size
+COARSE_MARGIN = 0.1 # Padding of the fine crop around the coarse box, fraction of the box size
+COARSE_PADDING = 2 # Coarse pixels the box is grown by, covers the edge lost to the downscale
+
+def localize_coarse(pixels_uint8_rgba, coarse_predictor, guide_mask, guide_strength, input_points, input_labels, input_box, source_name=None, frame=None, selection='AREA'):
+    # Runs the cheap model on the downscaled full frame, returns (box, cropping box) of what it found in frame coords
+    # for the fine model, or None if it found nothing. The box is padded by COARSE_PADDING, the crop by COARSE_MARGIN
+    height, width = pixels_uint8_rgba.shape[:2]
+    small = rgb_view(pixels_uint8_rgba)
+    if max(width, height) > COARSE_SIZE:
+        small = resize_longest_side(small, COARSE_SIZE)
+    small_height, small_width = small.shape[:2]
+    scale = np.array([small_width / width, small_height / height])
+
+    points = None if input_points is None else np.asarray(input_points) * scale
+    box = None if input_box is None else np.asarray(input_box, dtype=np.float64) * np.tile(scale, 2)
+    small_guide, logits = None, None
+    if guide_mask is not None:
+        small_guide = PIL.Image.fromarray(np.asarray(guide_mask) > 0).resize((small_width, small_height), PIL.Image.NEAREST)
+        logits = fake_logits(small_guide) if box is not None else None
+        small_guide = np.asarray(small_guide)
+
+    embedding_key = get_embedding_key(source_name, frame, None, coarse_predictor, small)
+    coarse_mask, _ = predict_mask(small, coarse_predictor, small_guide, guide_strength, points, input_labels, box, logits, embedding_key, selection)
+    coarse_box = calculate_bounding_box(coarse_mask)
+    if coarse_box is None:
+        return None
+
+    padding = COARSE_PADDING / scale
+    coarse_box = np.array(coarse_box, dtype=np.float64) / np.tile(scale, 2) + np.concatenate([-padding, padding])
+    margin = COARSE_MARGIN * np.tile(coarse_box[2:] - coarse_box[:2], 2) * np.array([-1, -1, 1, 1])
+    cropping_box = np.clip(coarse_box + margin, 0, [width, height, width, height])
+    return coarse_box, cropping_box
+
+
+
+def decode_mask(predictor, cropped_area, guide_mask, guide_strength, input_points, input_labels, input_box, input_logits, selection='AREA', previous_mask=None):
+    # Runs only the prompt encoder and mask decoder on the image that is currently set in the predictor
+    # The ONNX decoder is exported with multimask output only, SINGLE then takes the best scored one
+    multimask_output = selection != 'SINGLE' or getattr(predictor, 'backend', 'torch') != 'torch'
+    with inference_mode(), claim_new_threads():
+        masks, scores, logits = predictor.predict(
+            point_coords=input_points,
+            point_labels=input_labels,
+            box=input_box,
+            mask_input=input_logits,
+            multimask_output=multimask_output,
+        )
+    # Empty the memory cache after using SAM because Meta forgot
+    empty_device_cache()
+    return select_mask(masks, scores, logits, selection, guide_mask, guide_strength, cropped_area, previous_mask)
+
+
+
+
+
+
+
+def prefetch_frame(
+    pixels_uint8_rgba,
+    source_name,
+    frame,
+    guide_mask,
+    input_box,
+    predictor,
+    prefetcher,
+    gate = None
+):
+    # Crops an upcoming frame with the predicted box and starts encoding it in the background
+    if input_box is None:
+        return
+    # Frames the gate is going to skip don't need an embedding
+    if gate is not None and gate.check(pixels_uint8_rgba, input_box) is not None:
+        return
+    pixels_uint8_rgb, cropping_box, _, _, _ = get_cropped_image(pixels_uint8_rgba, guide_mask, None, input_box, None)
+    embedding_key = get_embedding_key(source_name, frame, cropping_box, predictor, pixels_uint8_rgb)
+    prefetcher.submit(predictor, pixels_uint8_rgb, embedding_key)
+
+
+
+def encode_frame_batch(
+    source_name,
+    frames,
+    pixels_uint8_rgba_list,
+    cropping_box,
+    predictor
+):
+    # Encodes the same crop of several frames in one batched forward pass and puts the results into the embedding cache,
+    # the frames are then decoded one after another by track_frame with the same cropping_box
+    crops = []
+    keys = []
+    for frame, pixels_uint8_rgba in zip(frames, pixels_uint8_rgba_list):
+        pixels_uint8_rgb = crop_array(rgb_view(pixels_uint8_rgba), cropping_box)
+        embedding_key = get_embedding_key(source_name, frame, cropping_box, predictor, pixels_uint8_rgb)
+        if embedding_key not in embedding_cache:
+            crops.append(pixels_uint8_rgb)
+            keys.append(embedding_key)
+
+    if crops == []:
+        return
+
+    embeddings = compute_embeddings_batch(predictor, crops)
+    for embedding_key, embedding in zip(keys, embeddings):
+        embedding_cache.put(embedding_key, embedding)
+
+
+
+
+
+
+
+def track_frame(
+    pixels_uint8_rgba,
+    source_name,
+    frame,
+    mask_sink,
+    predictor,
+    guide_mask = None,
+    guide_strength = 10,
+    blur_radius = 0.2,
+    search_radius = 10,
+    input_points = None,
+    input_labels = None,
+    input_box = None,
+    input_logits = None,
+    prefetcher = None,
+    prefetch_next = None,
+    cropping_box = None,
+    selection = 'AREA',
+    previous_mask = None,
+    mask_prompt = 'GUIDE_MASK',
+    previous_logits = None,
+    gate = None,
+    box_predictor = None,
+    propagator = None,
+    tiled = False,
+    coarse_predictor = None
+):
+    # guide_mask and previous_mask are full frame masks, the returned mask is one as well,
+    # so it can be used as guide (and previous mask) of the next frame.
+    # The returned logits are (low res logits, crop box they belong to), pass them as previous_logits of the next frame
+    height, width = pixels_uint8_rgba.shape[:2]
+
+    # Reuse the last inferred mask if the search box barely changed (see frame_gating.py), new prompt points always run the model
+    if gate is not None and input_points is None:
+        shift = gate.check(pixels_uint8_rgba, input_box)
+        if shift is not None:
+            best_mask, cropping_box, low_res_logits = gate.reuse(shift)
+            next_input_box = get_next_input_box(best_mask, cropping_box, search_radius, box_predictor)
+            overlay_l = mask_sink.write(frame, best_mask, cropping_box, blur_radius)
+            full_mask = uncrop_mask(best_mask, cropping_box, (width, height))
+            if propagator is not None:
+                propagator.update(pixels_uint8_rgba, full_mask, low_res_logits)
+            return full_mask, next_input_box, overlay_l, low_res_logits
+
+    # Move the last mask to this frame with block flow (see optical_flow.py), either as the result or as the prompt of the model
+    if propagator is not None and input_points is None:
+        propagated = propagator.propagate(pixels_uint8_rgba, input_box)
+        if propagated is not None and propagator.mode == 'PROPAGATE':
+            moved_mask, moved_logits = propagated
+            if cropping_box is None:
+                cropping_box = get_cropping_box(width, height, input_box)
+            best_mask = crop_array(moved_mask, cropping_box)
+            next_input_box = get_next_input_box(best_mask, cropping_box, search_radius, box_predictor)
+            overlay_l = mask_sink.write(frame, best_mask, cropping_box, blur_radius)
+            propagator.accept(pixels_uint8_rgba)
+            return moved_mask, next_input_box, overlay_l, moved_logits
+        if propagated is not None:
+            moved_mask, moved_logits = propagated
+            moved_box = get_next_input_box(moved_mask, None, search_radius)
+            if moved_box is not None:
+                guide_mask = moved_mask
+                input_box = moved_box
+                previous_logits = moved_logits if moved_logits is not None else previous_logits
+
+    # Find the object with the cheap model on the whole frame first, the model then only encodes a tight crop around it
+    if coarse_predictor is not None and cropping_box is None:
+        coarse = localize_coarse(pixels_uint8_rgba, coarse_predictor, guide_mask, guide_strength, input_points, input_labels, input_box, source_name, frame, selection)
+        if coarse is not None:
+            input_box, cropping_box = coarse
+
+    if mask_prompt == 'LOGITS' and previous_logits is not None and input_logits is None and input_box is not None:
+        if cropping_box is None:
+            cropping_box = get_cropping_box(width, height, input_box)
+        input_logits = carry_logits(previous_logits[0], previous_logits[1], cropping_box)
+
+    #Process the frame
+    pixels_uint8_rgb, cropping_box, input_logits, input_box, input_points = get_cropped_image(pixels_uint8_rgba, guide_mask, input_points, input_box, input_logits, cropping_box)
+    embedding_key = get_embedding_key(source_name, frame, cropping_box, predictor, pixels_uint8_rgb)
+
+    if prefetcher is not None:
+        prefetcher.wait(embedding_key)
+
+    if cropping_box is not None:
+        guide_mask = None if guide_mask is None else crop_array(guide_mask, cropping_box)
+        previous_mask = None if previous_mask is None else crop_array(previous_mask, cropping_box)
+    if tiled and input_box is not None and needs_tiling(pixels_uint8_rgb.shape[1], pixels_uint8_rgb.shape[0]):
+        best_mask, best_logits = predict_mask_tiled(pixels_uint8_rgb, predictor, guide_mask, guide_strength, input_points, input_labels, input_box, input_logits, source_name, frame, cropping_box, selection, previous_mask)
+    else:
+        best_mask, best_logits = predict_mask(pixels_uint8_rgb, predictor, guide_mask, guide_strength, input_points, input_labels, input_box, input_logits, embedding_key, selection, previous_mask)
+
+    logits_box = cropping_box if cropping_box is not None else (0, 0, width, height)
+    if gate is not None:
+        gate.update(pixels_uint8_rgba, best_mask, cropping_box, (best_logits, logits_box))
+
+    #Set input data for next frame
+    next_input_box = get_next_input_box(best_mask, cropping_box, search_radius, box_predictor)
+    full_mask = uncrop_mask(best_mask, cropping_box, (width, height))
+    if propagator is not None:
+        propagator.update(pixels_uint8_rgba, full_mask, (best_logits, logits_box))
+
+    # Let the caller start on the next frame before the mask is saved, propagated frames don't need the encoder
+    # and tiled or coarse frames encode their own crops
+    if prefetch_next is not None and not tiled and coarse_predictor is None and (propagator is None or propagator.mode != 'PROPAGATE'):
+        prefetch_next(full_mask, next_input_box)
+
+    overlay_l = mask_sink.write(frame, best_mask, cropping_box, blur_radius)
+
+    return full_mask, next_input_box, overlay_l, (best_logits, logits_box)
+
+
+
+
+
+
+
+def track_frame_shared(
+    pixels_uint8_rgba,
+    source_name,
+    frame,
+    layers,
+    mask_sinks,
+    predictor
+):
+    # Tracks several layers on the same frame with a single encoder pass.
+    # Each entry of layers is a dict holding the tracking state of one layer, it gets updated in place:
+    # guide_mask, guide_strength, blur_radius, search_radius, input_points, input_labels, input_box
+    # and optionally selection, mask_prompt, gate, box_predictor
+    height, width = pixels_uint8_rgba.shape[:2]
+
+    # Layers whose gate decides to reuse their last inferred mask don't need the model on this frame
+    shifts = []
+    for layer in layers:
+        gate = layer.get('gate')
+        shifts.append(gate.check(pixels_uint8_rgba, layer['input_box']) if gate is not None and layer['input_points'] is None else None)
+    inferred_layers = [layer for layer, shift in zip(layers, shifts) if shift is None]
+
+    # Encode the union of the crops of all inferred layers once
+    cropping_box = get_union_cropping_box(width, height, [layer['input_box'] for layer in inferred_layers])
+    pixels_uint8_rgb = rgb_view(pixels_uint8_rgba)
+    if cropping_box is not None:
+        pixels_uint8_rgb = crop_array(pixels_uint8_rgb, cropping_box)
+        offset = np.array(cropping_box[:2])
+    else:
+        offset = np.zeros(2)
+
+    if inferred_layers != []:
+        embedding_key = get_embedding_key(source_name, frame, cropping_box, predictor, pixels_uint8_rgb)
+        set_image_cached(predictor, pixels_uint8_rgb, embedding_key)
+    cropped_area = pixels_uint8_rgb.shape[0] * pixels_uint8_rgb.shape[1]
+    logits_box = cropping_box if cropping_box is not None else (0, 0, width, height)
+
+    # Decode every layer with its own prompts
+    overlays = []
+    for layer, mask_sink, shift in zip(layers, mask_sinks, shifts):
+        if shift is not None:
+            best_mask, layer_cropping_box, low_res_logits = layer['gate'].reuse(shift)
+        else:
+            guide_mask = layer['guide_mask']
+            input_box = layer['input_box']
+            input_points = layer['input_points']
+            input_logits = None
+
+            if input_box is not None:
+                input_box = input_box - np.tile(offset, 2)
+            previous_mask = layer.get('previous_mask')
+            if cropping_box is not None:
+                guide_mask = None if guide_mask is None else crop_array(guide_mask, cropping_box)
+                previous_mask = None if previous_mask is None else crop_array(previous_mask, cropping_box)
+            if input_box is not None and layer.get('mask_prompt') == 'LOGITS' and layer.get('logits') is not None:
+                input_logits = carry_logits(layer['logits'][0], layer['logits'][1], logits_box)[None]
+            elif input_box is not None and guide_mask is not None:
+                input_logits = fake_logits(PIL.Image.fromarray(guide_mask))
+            if input_points is not None:
+                input_points = input_points - offset
+
+            best_mask, best_logits = decode_mask(predictor, cropped_area, guide_mask, layer['guide_strength'], input_points, layer['input_labels'], input_box, input_logits,
+                                                 layer.get('selection', 'AREA'), previous_mask)
+            layer_cropping_box = cropping_box
+            low_res_logits = (best_logits, logits_box)
+            if layer.get('gate') is not None:
+                layer['gate'].update(pixels_uint8_rgba, best_mask, cropping_box, low_res_logits)
+
+        #Set input data for next frame
+        next_input_box = get_next_input_box(best_mask, layer_cropping_box, layer['search_radius'], layer.get('box_predictor'))
+
+        overlay_l = mask_sink.write(frame, best_mask, layer_cropping_box, layer['blur_radius'])
+
+        # The guide is kept in full frame coords since the shared crop changes between frames
+        layer['guide_mask'] = overlay_l > 127
+        layer['previous_mask'] = uncrop_mask(best_mask, layer_cropping_box, (width, height))
+        layer['logits'] = low_res_logits
+        layer['input_box'] = next_input_box
+        layer['input_points'] = None
+        layer['input_labels'] = None
+        overlays.append(overlay_l)
+
+    return overlays
+
+
+
+
+
+
+
+def track_sequence(
+    frame_source,
+    mask_sink,
+    predictor,
+    frames,
+    guide_mask = None,
+    guide_strength = 10,
+    blur_radius = 0.2,
+    search_radius = 10,
+    input_points = None,
+    input_labels = None,
+    input_box = None,
+    prefetcher = None,
+    progress = print,
+    selection = 'AREA',
+    mask_prompt = 'GUIDE_MASK',
+    gate = None,
+    box_predictor = None,
+    propagator = None,
+    keyframes = None,
+    tiled = False,
+    coarse_predictor = None,
+    stop = None,
+    previous_mask = None,
+    previous_logits = None
+):
+    # Headless tracking loop: tracks the frames in the given order, starting from the seed box/mask on the first one.
+    # stop is an optional threading.Event, the loop ends before the next frame once it's set.
+    # previous_mask and previous_logits continue from an already tracked neighbor of the first frame
+    frames = list(frames)
+    if keyframes is not None and keyframes.enabled:
+        return track_keyframes(frame_source, mask_sink, predictor, frames, keyframes, guide_mask, guide_strength, blur_radius,
+                               search_radius, input_points, input_labels, input_box, progress, selection, mask_prompt, tiled, coarse_predictor, stop,
+                               previous_logits)
+    next_pixels = {} # frame -> pixels that were already loaded by the prefetch stage
+
+    for i, frame in enumerate(frames):
+        if stop is not None and stop.is_set():
+            break
+        pixels_uint8_rgba = next_pixels.pop(frame, None)
+        if pixels_uint8_rgba is None:
+            pixels_uint8_rgba = frame_source.read(frame)
+
+        prefetch_next = None
+        if prefetcher is not None and not tiled and coarse_predictor is None and i + 1 < len(frames):
+            next_frame = frames[i + 1]
+            def prefetch_next(best_mask, next_input_box):
+                next_pixels[next_frame] = frame_source.read(next_frame)
+                prefetch_frame(next_pixels[next_frame], frame_source.name, next_frame, best_mask, next_input_box, predictor, prefetcher, gate)
+
+        guide_mask, input_box, _, previous_logits = track_frame(pixels_uint8_rgba = pixels_uint8_rgba,
+                                                  source_name = frame_source.name,
+                                                  frame = frame,
+                                                  mask_sink = mask_sink,
+                                                  predictor = predictor,
+                                                  guide_mask = guide_mask,
+                                                  guide_strength = guide_strength,
+                                                  blur_radius = blur_radius,
+                                                  search_radius = search_radius,
+                                                  input_points = input_points,
+                                                  input_labels = input_labels,
+                                                  input_box = input_box,
+                                                  prefetcher = prefetcher,
+                                                  prefetch_next = prefetch_next,
+                                                  selection = selection,
+                                                  previous_mask = previous_mask,
+                                                  mask_prompt = mask_prompt,
+                                                  previous_logits = previous_logits,
+                                                  gate = gate,
+                                                  box_predictor = box_predictor,
+                                                  propagator = propagator,
+                                                  tiled = tiled,
+                                                  coarse_predictor = coarse_predictor)
+        previous_mask = guide_mask
+        input_points = None
+        input_labels = None
+
+        if progress is not None:
+            progress(f'Tracked frame {frame} ({i + 1}/{len(frames)})')
+
+        if input_box is None:
+            if progress is not None:
+                progress(f'Lost the object on frame {frame}, stopping')
+            break
+
+    if gate is not None and gate.enabled and progress is not None:
+        progress(gate.summary())
+
+
+
+def track_keyframes(
+    frame_source,
+    mask_sink,
+    predictor,
+    frames,
+    keyframes,
+    guide_mask = None,
+    guide_strength = 10,
+    blur_radius = 0.2,
+    search_radius = 10,
+    input_points = None,
+    input_labels = None,
+    input_box = None,
+    progress = print,
+    selection = 'AREA',
+    mask_prompt = 'GUIDE_MASK',
+    tiled = False,
+    coarse_predictor = None,
+    stop = None,
+    previous_logits = None
+):
+    # Sparse tracking loop: the model runs on the frames keyframes picks (see keyframes.py), the frames in between
+    # are interpolated. The scheduler works on positions in frames, so gaps in the frame numbers don't matter.
+    # Gate, box prediction and flow need consecutive frames, they aren't used here
+    keyframes.reset()
+    keyframes.start()
+    position = 0
+    while position is not None:
+        if stop is not None and stop.is_set():
+            break
+        frame = frames[position]
+        full_mask, _, _, logits = track_frame(pixels_uint8_rgba = frame_source.read(frame),
+                                              source_name = frame_source.name,
+                                              frame = frame,
+                                              mask_sink = mask_sink,
+                                              predictor = predictor,
+                                              guide_mask = guide_mask,
+                                              guide_strength = guide_strength,
+                                              blur_radius = blur_radius,
+                                              search_radius = search_radius,
+                                              input_points = input_points,
+                                              input_labels = input_labels,
+                                              input_box = input_box,
+                                              selection = selection,
+                                              previous_mask = guide_mask,
+                                              mask_prompt = mask_prompt,
+                                              previous_logits = previous_logits,
+                                              tiled = tiled,
+                                              coarse_predictor = coarse_predictor)
+        input_points = None
+        input_labels = None
+        for filled_position, best_mask, cropping_box in keyframes.add(position, full_mask, logits):
+            mask_sink.write(frames[filled_position], best_mask, cropping_box, blur_radius)
+
+        if progress is not None:
+            progress(f'Tracked frame {frame} ({keyframes.model_frames + keyframes.filled_frames}/{len(frames)})')
+
+        position = keyframes.next_frame(len(frames) - 1)
+        if position is not None:
+            guide_mask, input_box, previous_logits = keyframes.prompt(position, search_radius)
+        elif keyframes.last is not None and keyframes.last.box is None and progress is not None:
+            progress(f'Lost the object on frame {frames[keyframes.last.frame]}, stopping')
+
+    if progress is not None:
+        progress(keyframes.summary())
+
+
+
+def predictor_view(predictor):
+    # Shallow copy that shares the loaded model (or ONNX sessions) but has its own image state, the encoder and
+    # decoder don't change the model, so threads that each use their own view can run them at the same time
+    if predictor is None:
+        return None
+    view = copy.copy(predictor)
+    view.reset_image()
+    return view
+
+
+def track_both_directions(
+    frame_source,
+    mask_sink,
+    predictor,
+    frames,
+    frame,
+    guide_mask = None,
+    guide_strength = 10,
+    blur_radius = 0.2,
+    search_radius = 10,
+    input_points = None,
+    input_labels = None,
+    input_box = None,
+    prefetch = False,
+    progress = print,
+    selection = 'AREA',
+    mask_prompt = 'GUIDE_MASK',
+    gate = None,
+    box_predictor = None,
+    propagator = None,
+    keyframes = None,
+    tiled = False,
+    coarse_predictor = None,
+    stop = None,
+    backward_source = None
+):
+    # Tracks frame from the prompt, then the frames after it forwards and the ones before it backwards in two threads.
+    # Both passes continue from the mask and logits of frame like the next frame of a single pass would, write
+    # different frames to the same sink and use their own view of the predictor and their own copy of gate,
+    # box_predictor, propagator (as they are after frame) and keyframes. backward_source replaces
+    # frame_source for the backward pass, e.g. a second CachedFrameSource so each pass reads ahead in its direction
+    frames = sorted(frames)
+    if keyframes is not None and keyframes.enabled:
+        # Like track_keyframes, the sparse passes don't use them
+        gate, box_predictor, propagator = None, None, None
+    full_mask, input_box, _, logits = track_frame(pixels_uint8_rgba = frame_source.read(frame),
+                                             source_name = frame_source.name,
+                                             frame = frame,
+                                             mask_sink = mask_sink,
+                                             predictor = predictor,
+                                             guide_mask = guide_mask,
+                                             guide_strength = guide_strength,
+                                             blur_radius = blur_radius,
+                                             search_radius = search_radius,
+                                             input_points = input_points,
+                                             input_labels = input_labels,
+                                             input_box = input_box,
+                                             selection = selection,
+                                             mask_prompt = mask_prompt,
+                                             gate = gate,
+                                             box_predictor = box_predictor,
+                                             propagator = propagator,
+                                             tiled = tiled,
+                                             coarse_predictor = coarse_predictor)
+    if progress is not None:
+        progress(f'Tracked frame {frame}')
+    if input_box is None:
+        if progress is not None:
+            progress(f'Lost the object on frame {frame}, stopping')
+        return
+
+    stop = stop if stop is not None else threading.Event()
+    passes = [('Forward', frame_source, [f for f in frames if f > frame]),
+              ('Backward', backward_source or frame_source, [f for f in reversed(frames) if f < frame])]
+    prefetchers = []
+
+    def run(name, source, pass_frames):
+        prefetcher = None
+        if prefetch:
+            prefetcher = EncoderPrefetcher()
+            prefetchers.append(prefetcher)
+        pass_progress = None if progress is None else lambda message: progress(f'{name}: {message}')
+        track_sequence(frame_source = source,
+                       mask_sink = mask_sink,
+                       predictor = predictor_view(predictor),
+                       frames = pass_frames,
+                       guide_mask = full_mask,
+                       guide_strength = guide_strength,
+                       blur_radius = blur_radius,
+                       search_radius = search_radius,
+                       input_box = input_box,
+                       prefetcher = prefetcher,
+                       progress = pass_progress,
+                       selection = selection,
+                       mask_prompt = mask_prompt,
+                       gate = copy.deepcopy(gate),
+                       box_predictor = copy.deepcopy(box_predictor),
+                       propagator = copy.deepcopy(propagator),
+                       keyframes = copy.deepcopy(keyframes),
+                       tiled = tiled,
+                       coarse_predictor = predictor_view(coarse_predictor),
+                       stop = stop,
+                       previous_mask = full_mask,
+                       previous_logits = logits)
+
+    executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='RotoForgeTrack', initializer=claim_current_thread)
+    try:
+        futures = [executor.submit(run, *tracking_pass) for tracking_pass in passes if tracking_pass[2]]
+        done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+        if any(future.exception() is not None for future in done):
+            # The other pass stops at its next frame instead of running on alone
+            stop.set()
+        for future in futures:
+            future.result()
+    finally:
+        executor.shutdown(wait=True)
+        for prefetcher in prefetchers:
+            prefetcher.shutdown()
@@ -0,0 +1,158 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .frame_io import FrameSource
+from .core_scheduler import claim_current_thread
+
+
+# Decoded frames of image sequences on disk, bpy-free.
+# Re-tracking forwards/backwards and scrubbing over already decoded frames doesn't decode them again,
+# and the frames ahead of the tracking direction are decoded in worker threads (PIL and OpenEXR release the GIL)
+
+
+
+
+class DecodedFrameCache:
+    """Memory bounded LRU of decoded uint8 frames"""
+
+    def __init__(self, max_bytes=2048 * 1024**2):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            pixels = self._entries.get(key)
+            if pixels is not None:
+                self._entries.move_to_end(key)
+            return pixels
+
+    def put(self, key, pixels):
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._entries.pop(key).nbytes
+
+            # Don't bother caching frames that would evict everything else
+            if pixels.nbytes > self.max_bytes:
+                return
+
+            self._entries[key] = pixels
+            self._size += pixels.nbytes
+            self._evict()
+
+    def set_max_bytes(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._entries:
+            _, pixels = self._entries.popitem(last=False)
+            self._size -= pixels.nbytes
+
+    @property
+    def size(self):
+        return self._size
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+
+frame_cache = DecodedFrameCache()
+
+
+
+
+class CachedFrameSource(FrameSource):
+    """
+    Wraps an ImageSequenceSource, keeps the decoded frames in a DecodedFrameCache and decodes the next
+    read_ahead frames in the direction of the last read in worker threads.
+    Frames are read-only arrays shared with the cache.
+    """
+
+    def __init__(self, frame_source, cache=None, read_ahead=4, workers=2, flip=False):
+        self.frame_source = frame_source
+        self.name = frame_source.name
+        self.cache = cache if cache is not None else frame_cache
+        self.read_ahead = read_ahead
+        # Blender images are stored bottom up, with flip the frames match the pixels of the blender image
+        self.flip = flip
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='RotoForgeDecode',
+                                             initializer=claim_current_thread) if read_ahead > 0 else None
+        self._pending = {} # cache key -> future
+        self._lock = threading.Lock()
+        self._last_frame = None
+
+    @property
+    def resolution(self):
+        return self.frame_source.resolution
+
+    def frames(self):
+        return self.frame_source.frames()
+
+    def _key(self, frame):
+        # The mtime catches frames that got re-rendered or painted over on disk
+        filepath = self.frame_source.filepath(frame)
+        return (filepath, os.stat(filepath).st_mtime_ns, self.flip)
+
+    def _decode(self, frame, key):
+        pixels = self.frame_source.read(frame)
+        if self.flip:
+            pixels = np.flipud(pixels)
+        pixels = np.ascontiguousarray(pixels)
+        pixels.flags.writeable = False
+        self.cache.put(key, pixels)
+        return pixels
+
+    def _decode_pending(self, frame, key):
+        try:
+            return self._decode(frame, key)
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+    def prefetch(self, frames):
+        # Starts decoding the frames that aren't cached or being decoded yet
+        if self._executor is None:
+            return
+        for frame in frames:
+            try:
+                key = self._key(frame)
+            except (KeyError, OSError):
+                continue
+            with self._lock:
+                if key in self.cache or key in self._pending:
+                    continue
+                self._pending[key] = self._executor.submit(self._decode_pending, frame, key)
+
+    def read(self, frame):
+        key = self._key(frame)
+        pixels = self.cache.get(key)
+        if pixels is None:
+            with self._lock:
+                future = self._pending.get(key)
+            pixels = future.result() if future is not None else self._decode(frame, key)
+
+        if self.read_ahead > 0:
+            step = -1 if self._last_frame is not None and frame < self._last_frame else 1
+            self.prefetch([frame + step * i for i in range(1, self.read_ahead + 1)])
+        self._last_frame = frame
+        return pixels
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,147 @@
+import numpy as np
+
+
+# Skips the model on frames where the tracked region barely changed since the last inferred frame, bpy-free.
+# The change is the mean absolute difference of a subsampled gray version of the search box, optionally after
+# moving the last inferred frame by the translation estimated with phase correlation. Skipped frames reuse the
+# mask (and low res logits) of the last inferred frame, moved by that translation.
+
+GATE_STEP = 4 # Pixel stride of the subsampled gray images
+MAX_SHIFT = 0.25 # Translations beyond this fraction of the search box count as a change
+
+
+
+
+def gray_frame(pixels_uint8, step=GATE_STEP):
+    # Mean of RGB on every step-th pixel
+    return pixels_uint8[::step, ::step, :3].mean(axis=2, dtype=np.float32)
+
+
+def gray_region(pixels_uint8, region, step=GATE_STEP):
+    # Same grid as gray_frame, region is (x0, y0, x1, y1) in cells of the subsampled image
+    x0, y0, x1, y1 = region
+    return pixels_uint8[y0 * step:y1 * step:step, x0 * step:x1 * step:step, :3].mean(axis=2, dtype=np.float32)
+
+
+def estimate_shift(reference, current, reference_weights=None):
+    # Translation (dx, dy) in cells that moves reference onto current, phase correlation.
+    # reference_weights (0-1) limit the reference to a part of it, like the tracked object
+    reference = reference - reference.mean()
+    if reference_weights is not None:
+        reference = reference * reference_weights
+    reference_spectrum = np.fft.rfft2(reference)
+    current_spectrum = np.fft.rfft2(current - current.mean())
+    cross_power = current_spectrum * np.conj(reference_spectrum)
+    cross_power /= np.abs(cross_power) + 1e-6
+    correlation = np.fft.irfft2(cross_power, s=reference.shape)
+    dy, dx = np.unravel_index(np.argmax(correlation), correlation.shape)
+    height, width = reference.shape
+    if dy > height // 2:
+        dy -= height
+    if dx > width // 2:
+        dx -= width
+    return int(dx), int(dy)
+
+
+def shifted_difference(reference, current, dx, dy):
+    # Mean absolute difference (0-1) of the overlap of current and reference moved by (dx, dy)
+    height, width = reference.shape
+    if abs(dx) >= width or abs(dy) >= height:
+        return 1.0
+    moved = reference[max(-dy, 0):height - max(dy, 0), max(-dx, 0):width - max(dx, 0)]
+    overlap = current[max(dy, 0):height - max(-dy, 0), max(dx, 0):width - max(-dx, 0)]
+    return float(np.mean(np.abs(overlap - moved))) / 255
+
+
+
+
+class FrameGate:
+    """
+    Decides per frame if the model has to run. threshold is the mean absolute difference (0-1) below which
+    a frame is skipped, 0 disables the gate. At most max_skip frames in a row are skipped (0 = no limit),
+    with shift the reused mask follows the estimated translation.
+    """
+
+    def __init__(self, threshold=0.0, max_skip=10, shift=True, step=GATE_STEP):
+        self.threshold = threshold
+        self.max_skip = max_skip
+        self.shift = shift
+        self.step = step
+        self.frames = 0
+        self.skipped = 0
+        self.reset()
+
+    def reset(self):
+        # Forgets the last inferred frame, the next frame runs the model
+        self._reference = None
+        self._result = None
+        self._skip_run = 0
+
+    @property
+    def enabled(self):
+        return self.threshold > 0
+
+    def _region(self, search_box):
+        # Search box in cells of the subsampled reference, clipped to it
+        height, width = self._reference.shape
+        x0, y0, x1, y1 = (int(value) // self.step for value in search_box)
+        return max(x0, 0), max(y0, 0), min(x1, width), min(y1, height)
+
+    def check(self, pixels_uint8, search_box):
+        # Returns the translation (dx, dy) in frame pixels to reuse the last inferred result with, or None to run the model
+        if not self.enabled or self._reference is None or search_box is None:
+            return None
+        if self.max_skip > 0 and self._skip_run >= self.max_skip:
+            return None
+        if pixels_uint8.shape[:2] != self._resolution:
+            return None
+
+        x0, y0, x1, y1 = region = self._region(search_box)
+        if x1 - x0 < 2 or y1 - y0 < 2:
+            return None
+        reference = self._reference[y0:y1, x0:x1]
+        current = gray_region(pixels_uint8, region, self.step)
+
+        dx, dy = 0, 0
+        if self.shift:
+            dx, dy = estimate_shift(reference, current)
+            if abs(dx) > (x1 - x0) * MAX_SHIFT or abs(dy) > (y1 - y0) * MAX_SHIFT:
+                return None
+        if shifted_difference(reference, current, dx, dy) >= self.threshold:
+            return None
+        return dx * self.step, dy * self.step
+
+    def update(self, pixels_uint8, best_mask, cropping_box, logits):
+        # Keeps the inferred frame as the reference, best_mask and logits in the coords of cropping_box (None = full frame)
+        self.record(False)
+        if not self.enabled:
+            return
+        self._reference = gray_frame(pixels_uint8, self.step)
+        self._resolution = pixels_uint8.shape[:2]
+        self._result = (best_mask, cropping_box, logits)
+        self._skip_run = 0
+
+    def reuse(self, shift):
+        # The mask of the last inferred frame with its crop box moved by shift, and the moved low res logits
+        self.record(True)
+        self._skip_run += 1
+        best_mask, cropping_box, (logits, logits_box) = self._result
+        dx, dy = shift
+        if dx == 0 and dy == 0:
+            return best_mask, cropping_box, (logits, logits_box)
+        offset = np.array([dx, dy, dx, dy])
+        if cropping_box is None:
+            height, width = self._resolution
+            cropping_box = (0, 0, width, height)
+        return best_mask, np.asarray(cropping_box) + offset, (logits, np.asarray(logits_box) + offset)
+
+    def record(self, skipped):
+        self.frames += 1
+        self.skipped += int(skipped)
+
+    @property
+    def skipped_ratio(self):
+        return self.skipped / self.frames if self.frames else 0.0
+
+    def summary(self):
+        return f'Skipped {self.skipped}/{self.frames} frames ({self.skipped_ratio:.0%}) with the frame gate'
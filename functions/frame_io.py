@@ -0,0 +1,204 @@
+import os
+import re
+from collections import OrderedDict
+
+import numpy as np
+import PIL.Image
+import PIL.ImageFilter
+
+
+# Frame sources and mask sinks for the tracking pipeline in engine.py
+# Nothing in here depends on bpy, the blender specific ones live in generate_masks.py
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tif', '.tiff', '.bmp', '.exr')
+
+
+
+
+class FrameSource:
+    """Provides the frames of a plate as HWC uint8 arrays (RGB or RGBA)"""
+    name = ''
+
+    @property
+    def resolution(self):
+        raise NotImplementedError
+
+    def frames(self):
+        raise NotImplementedError
+
+    def read(self, frame):
+        raise NotImplementedError
+
+
+class MaskSink:
+    """Receives the tracked masks, returns the full resolution mask as L uint8 for the overlay"""
+
+    def write(self, frame, best_mask, cropping_box, blur = 0.0):
+        raise NotImplementedError
+
+
+
+
+class FrameBufferPool:
+    """Reusable float32 staging buffers for the frame ingest, kept for the most recently used resolutions"""
+
+    def __init__(self, max_bytes=1024 * 1024**2):
+        self.max_bytes = max_bytes
+        self._buffers = OrderedDict() # size -> flat float32 array
+
+    def get(self, size):
+        # The buffer of the latest resolution always stays, even if it alone exceeds the budget
+        buffer = self._buffers.get(size)
+        if buffer is None:
+            buffer = np.empty(size, dtype=np.float32)
+            self._buffers[size] = buffer
+        self._buffers.move_to_end(size)
+        while len(self._buffers) > 1 and sum(buffer.nbytes for buffer in self._buffers.values()) > self.max_bytes:
+            self._buffers.popitem(last=False)
+        return buffer
+
+    def clear(self):
+        self._buffers.clear()
+
+
+def rgba_float_to_rgb_uint8(rgba_float, height, width):
+    # Converts a flat RGBA float buffer into a new HWC RGB uint8 array, the buffer is used as scratch space,
+    # so the only full frame allocation is the result and the alpha plane is never copied.
+    # Scaling the whole buffer (alpha included) is faster than working on the strided RGB view
+    np.clip(rgba_float, 0.0, 1.0, out=rgba_float)
+    np.multiply(rgba_float, 255, out=rgba_float)
+    pixels_uint8_rgb = np.empty((height, width, 3), dtype=np.uint8)
+    np.copyto(pixels_uint8_rgb, rgba_float.reshape(height, width, 4)[:, :, :3], casting='unsafe')
+    return pixels_uint8_rgb
+
+
+def read_exr(path):
+    try:
+        import OpenEXR
+        import Imath
+    except ImportError:
+        raise ImportError('Reading .exr files needs the OpenEXR python package')
+
+    exr_file = OpenEXR.InputFile(path)
+    header = exr_file.header()
+    data_window = header['dataWindow']
+    width = data_window.max.x - data_window.min.x + 1
+    height = data_window.max.y - data_window.min.y + 1
+
+    pixel_type = Imath.PixelType(Imath.PixelType.FLOAT)
+    channels = [np.frombuffer(exr_file.channel(channel, pixel_type), dtype=np.float32) for channel in 'RGB']
+    pixels = np.stack(channels, axis=-1).reshape(height, width, 3)
+
+    # Same as the blender ingest: scene linear values straight to 0-255
+    return (np.clip(pixels, 0.0, 1.0) * 255).astype(np.uint8)
+
+
+def read_image(path):
+    if path.lower().endswith('.exr'):
+        return read_exr(path)
+    with PIL.Image.open(path) as img:
+        return np.asarray(img.convert('RGB'))
+
+
+def crop_rectangle(cropping_box):
+    # The pixel rectangle of a cropping box, rounded like PIL.Image.crop. Cropping and pasting back both use it,
+    # so masks land exactly where their crop was taken
+    return tuple(int(round(value)) for value in cropping_box)
+
+
+def compose_mask(best_mask, cropping_box, resolution, blur = 0.0):
+    # Blurs the mask and pastes it into a black image with the original res at the original position if cropping was used
+    width, height = resolution
+    best_mask = PIL.Image.fromarray(best_mask)
+    best_mask = best_mask.convert(mode='RGBA')
+    best_mask = best_mask.filter(PIL.ImageFilter.BoxBlur(radius=blur))
+    if cropping_box is not None:
+        empty_mask = PIL.Image.new('RGBA', (width, height), 'black')
+        empty_mask.paste(best_mask, crop_rectangle(cropping_box)[:2])
+        best_mask = empty_mask
+    return best_mask
+
+
+
+
+class ImageSequenceSource(FrameSource):
+    """
+    Reads an image sequence from disk.
+    The path is either a folder or a pattern where the frame number is marked with # (plate.####.png) or %04d.
+    """
+
+    def __init__(self, path):
+        self.name = path
+        self._files = {} # frame -> filepath
+
+        if os.path.isdir(path):
+            directory = path
+            files = [file for file in os.listdir(directory) if file.lower().endswith(IMAGE_EXTENSIONS)]
+            pattern = None
+        else:
+            directory, filename = os.path.split(path)
+            files = os.listdir(directory or '.')
+            filename = re.sub(r'%0?(\d*)d', lambda m: '#' * int(m.group(1) or 1), filename)
+            match = re.match(r'^(.*?)(#+)([^#]*)$', filename)
+            if match is None:
+                raise ValueError(f'Mark the frame number in {path} with # or %04d, or pass the folder')
+            prefix, hashes, suffix = match.groups()
+            pattern = re.compile(re.escape(prefix) + r'(\d{%d,})' % len(hashes) + re.escape(suffix) + '$')
+
+        for file in files:
+            if pattern is not None:
+                match = pattern.match(file)
+                if match is None:
+                    continue
+                frame = int(match.group(1))
+            else:
+                # The last number in the filename is the frame number
+                numbers = re.findall(r'\d+', os.path.splitext(file)[0])
+                if not numbers:
+                    continue
+                frame = int(numbers[-1])
+            self._files[frame] = os.path.join(directory, file)
+
+        if not self._files:
+            raise FileNotFoundError(f'No image sequence found at {path}')
+
+        self._resolution = None
+
+    @property
+    def resolution(self):
+        if self._resolution is None:
+            height, width = self.read(self.frames()[0]).shape[:2]
+            self._resolution = (width, height)
+        return self._resolution
+
+    def frames(self):
+        return sorted(self._files.keys())
+
+    def filepath(self, frame):
+        return self._files[frame]
+
+    def read(self, frame):
+        return read_image(self._files[frame])
+
+
+class DirectoryMaskSink(MaskSink):
+    """Saves every mask as <frame>.png into a folder"""
+
+    def __init__(self, directory, resolution, flip = False):
+        self.directory = directory
+        self.resolution = resolution
+        # Blender images are stored bottom up, so masks computed on their pixels need to be flipped before saving
+        self.flip = flip
+
+    def write(self, frame, best_mask, cropping_box, blur = 0.0):
+        best_mask = compose_mask(best_mask, cropping_box, self.resolution, blur)
+
+        # Save the image
+        saved_mask = best_mask
+        if self.flip:
+            saved_mask = best_mask.transpose(PIL.Image.FLIP_TOP_BOTTOM)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, exist_ok=True)
+        saved_mask.save(os.path.join(self.directory, str(frame) + '.png'))
+        best_mask = best_mask.convert(mode='L')
+        return np.asarray(best_mask)
@@ -1,141 +1,161 @@
 import bpy
+import os
+import re
+import threading
+from types import SimpleNamespace
 
-import warnings
 import numpy as np
-import PIL.Image
-import torch
-import torchvision # Needed since submodules use it.
 
-from .prompt_utils import fake_logits, calculate_bounding_box
-from .data_manager import save_sequential_mask, save_singular_mask
+from .data_manager import save_sequential_mask, save_singular_mask, get_maskseq_sink
 from .dependency_manager import get_install_folder
+from .frame_io import FrameSource, MaskSink, FrameBufferPool, rgba_float_to_rgb_uint8, ImageSequenceSource, IMAGE_EXTENSIONS
+from .frame_cache import CachedFrameSource
+from .quantization import split_model_type
+from . import engine
+from .engine import COARSE_MODEL, get_cropped_image, predict_mask, predict_mask_tiled, localize_coarse, get_embedding_key, box_inside, get_batch_cropping_box, crop_array
+from .tiling import needs_tiling
+from .core_scheduler import claim_current_thread
 
 
+# Blender adapters around the bpy-free pipeline in engine.py
 
 
-def get_predictor(model_type):
-    with warnings.catch_warnings():
-        warnings.filterwarnings("ignore", category=UserWarning)
-        import segment_anything
 
-        # Empty the memory cache before to clean up any mess that's been handed over
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
 
-        # Debug info
-        print("PyTorch version: ", torch.__version__)
+def get_checkpoint_path(model_type):
+    # Quantized models are built from the checkpoint of their fp32 model
+    base_model_type, _ = split_model_type(model_type)
+    return f"{get_install_folder('sam_hq_weights')}/sam_hq_{base_model_type}.pth"
 
-        if torch.cuda.is_available():
-            print("Using CUDA accelleration")
-            device = "cuda"
-        else:
-            print("Using CPU")
-            device = "cpu"
+def get_onnx_dir():
+    return get_install_folder('sam_hq_onnx')
 
-        # Fetch predictor
-        print('loading predictor')
-        sam_checkpoint = f"{get_install_folder('sam_hq_weights')}/sam_hq_{model_type}.pth"
+def get_predictor(model_type, sam_checkpoint=None, backend='torch', onnx_dir=None, num_threads=0, num_interop_threads=0):
+    # The paths can be resolved up front, reading the addon prefs isn't safe from a worker thread
+    if sam_checkpoint is None:
+        sam_checkpoint = get_checkpoint_path(model_type)
+    if backend == 'onnx' and onnx_dir is None:
+        onnx_dir = get_onnx_dir()
+    return engine.load_predictor(model_type, sam_checkpoint, backend=backend, onnx_dir=onnx_dir,
+                                 num_threads=num_threads, num_interop_threads=num_interop_threads)
 
-        sam = segment_anything.sam_model_registry[model_type](checkpoint=sam_checkpoint)
-        sam.to(device=device)
 
-        predictor = segment_anything.SamPredictor(sam)
 
-        print('loaded predictor')
 
-        # Empty the memory cache after using SAM because Meta forgot
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-    
-    return predictor
+# Only used from the main thread, bpy image access isn't thread safe anyway
+frame_buffer_pool = FrameBufferPool()
 
+def bpyimg_to_HWCuint8(source_image):
+    # Get the image pixel data into a reused float buffer, converts it to HWC RGB uint8 (the alpha is dropped)
+    width = source_image.size[0]
+    height = source_image.size[1]
+    source_pixels = frame_buffer_pool.get(width * height * 4)
+    source_image.pixels.foreach_get(source_pixels)
+    return rgba_float_to_rgb_uint8(source_pixels, height, width)
+
+
+
+
+# Image sequences that are decoded straight from disk, by their frame pattern
+disk_frame_sources = {}
+
+def get_image_file_frame(image_user, frame):
+    # Same as BKE_image_user_frame_get: the number of the file blender shows on a scene frame
+    length = image_user.frame_duration
+    if length == 0:
+        return 0
+    file_frame = frame - image_user.frame_start + 1
+    if image_user.use_cyclic:
+        file_frame = file_frame % length
+        if file_frame == 0:
+            file_frame = length
+    file_frame = min(max(file_frame, 0), length)
+    return file_frame + image_user.frame_offset
 
+def get_disk_frame_source(source_image):
+    # None if blender has to load the frames: packed images, and float images other than exr since
+    # blender converts those (16 bit png, tiff) to linear
+    if source_image.source != 'SEQUENCE' or source_image.packed_file is not None:
+        return None
+    filepath = bpy.path.abspath(source_image.filepath)
+    extension = os.path.splitext(filepath)[1].lower()
+    if extension not in IMAGE_EXTENSIONS or (source_image.is_float and extension != '.exr'):
+        return None
 
+    # plate.0001.png -> plate.####.png, blender uses the last number of the filename as frame number
+    directory, filename = os.path.split(filepath)
+    match = re.match(r'^(.*?)(\d+)(\D*)$', filename)
+    if match is None:
+        return None
+    pattern = os.path.join(directory, match.group(1) + '#' * len(match.group(2)) + match.group(3))
 
-def bpyimg_to_HWCuint8(source_image):
-    # Get the image pixel data as a numpy array:
-    source_pixels = np.zeros(len(source_image.pixels), dtype=np.float32)
-    source_image.pixels.foreach_get(source_pixels)
+    frame_source = disk_frame_sources.get(pattern)
+    if frame_source is None:
+        try:
+            frame_source = CachedFrameSource(ImageSequenceSource(pattern), flip=True)
+        except (ValueError, OSError):
+            return None
+        disk_frame_sources[pattern] = frame_source
+    return frame_source
 
-    # Determine the dimensions of the image
-    width = source_image.size[0]
-    height = source_image.size[1]
+def read_sequence_frame(source_image, image_user, frame):
+    # Decodes the frame of a sequence from disk without switching blender to it, None if that's not possible
+    frame_source = get_disk_frame_source(source_image)
+    if frame_source is None:
+        return None
+    try:
+        pixels_uint8_rgb = frame_source.read(get_image_file_frame(image_user, frame))
+    except (KeyError, OSError, ImportError) as e:
+        print(f'Reading frame {frame} from disk failed, loading it through blender: {e}')
+        return None
+    if pixels_uint8_rgb.shape[:2] != (source_image.size[1], source_image.size[0]):
+        return None
+    return pixels_uint8_rgb
 
-    # Reshape the pixel data into HWC uint8 format
-    channels = 4
-    pixels_HWC_uint8 = (np.array(source_pixels).reshape(height, width, channels)* 255).astype(np.uint8)
-    return pixels_HWC_uint8
+def free_disk_frame_sources():
+    for frame_source in disk_frame_sources.values():
+        frame_source.shutdown()
+    disk_frame_sources.clear()
 
 
+class SceneFrameSource(FrameSource):
+    """
+    Frames of a sequence on disk by scene frame, for worker threads. The frame mapping of the image user is
+    copied on creation since bpy data can't be read from other threads, the read ahead state is its own
+    """
+
+    def __init__(self, source_image, image_user):
+        disk_source = get_disk_frame_source(source_image)
+        self.name = source_image.name
+        self._resolution = tuple(source_image.size)
+        self._image_user = SimpleNamespace(frame_duration = image_user.frame_duration,
+                                           frame_start = image_user.frame_start,
+                                           frame_offset = image_user.frame_offset,
+                                           use_cyclic = image_user.use_cyclic)
+        self._frame_source = CachedFrameSource(disk_source.frame_source, cache=disk_source.cache, read_ahead=disk_source.read_ahead, flip=True)
+
+    @property
+    def resolution(self):
+        return self._resolution
+
+    def read(self, frame):
+        return self._frame_source.read(get_image_file_frame(self._image_user, frame))
+
+    def shutdown(self):
+        self._frame_source.shutdown()
+
+
+
+class BlenderMaskSink(MaskSink):
+    """Saves masks into the RotoForge masksequences folder of a mask layer"""
+
+    def __init__(self, source_image, used_mask):
+        self.source_image = source_image
+        self.used_mask = used_mask
+
+    def write(self, frame, best_mask, cropping_box, blur = 0.0):
+        return save_sequential_mask(self.source_image, self.used_mask, best_mask, cropping_box, blur, frame)
 
-def get_cropped_image(pixels_uint8_rgba, guide_mask, input_points, input_box, input_logits):
-    # Determine the dimensions of the image
-    cropping_radius = 0.05
-    width = pixels_uint8_rgba.shape[1]
-    height = pixels_uint8_rgba.shape[0]
-    
-    # Load data into PIL
-    img = PIL.Image.fromarray(pixels_uint8_rgba)
-    img = img.convert('RGB')
-    
-    # Crop to box if box is supported
-    if input_box is not None:
-        mask = PIL.Image.fromarray(guide_mask)
-        cropping_box = input_box + np.array([-width*cropping_radius, -height*cropping_radius, width*cropping_radius, height*cropping_radius])
-        img = img.crop(cropping_box)
-        mask = mask.crop(cropping_box)
-        if input_points is not None:
-            input_points = input_points - [cropping_box[0], cropping_box[1]]
-        input_box = np.array([width*cropping_radius, height*cropping_radius, input_box[2]-input_box[0] + width*cropping_radius, input_box[3]-input_box[1] + height*cropping_radius])
-        
-        if input_logits is not None:
-            input_logits = np.array([input_logits])
-        else:
-            input_logits = fake_logits(mask)
-    else:
-        input_logits = None
-        cropping_box = None
-        
-    
-    pixels_uint8_rgb = np.asarray(img)
-
-    return pixels_uint8_rgb, cropping_box, input_logits, input_box, input_points
-
-
-
-
-
-
-def predict_mask(pixels_uint8_rgb, predictor, guide_mask, guide_strength, input_points, input_labels, input_box, input_logits):
-    # Generate mask
-    predictor.set_image(pixels_uint8_rgb)
-    masks, scores, logits = predictor.predict(
-        point_coords=input_points,
-        point_labels=input_labels,
-        box=input_box,
-        mask_input=input_logits,
-        multimask_output=True,
-    )
-    # Empty the memory cache after using SAM because Meta forgot
-    if torch.cuda.is_available():
-        torch.cuda.empty_cache()
-    # Initialize variables outside the loop
-    best_score = float('-inf')
-    cropped_area = len(pixels_uint8_rgb.flatten())/3
-    best_mask = None
-    best_logits = None
-    # Calculate sums outside the loop if they don't change
-    if guide_mask is not None:
-        sum_guide_mask = np.sum(guide_mask)
-    for i, score in enumerate(scores):
-        if guide_mask is not None:
-            score += -abs(sum_guide_mask - np.sum(masks[i])) / cropped_area * guide_strength
-        if score > best_score:
-            best_score = score
-            best_mask = masks[i]
-            best_logits = logits[i]
-    
-    return best_mask, best_logits
 
 
 
@@ -212,17 +232,33 @@ def generate_mask(
     input_labels = None,
     input_box = None,
     debug_logits = False,
+    selection = 'AREA',
+    tiled = False,
+    coarse_predictor = None
 ):
 
     
 
     print('loading image')
     pixels_uint8_rgba = bpyimg_to_HWCuint8(source_image)
-    pixels_uint8_rgb, cropping_box, input_logits, input_box, input_points = get_cropped_image(pixels_uint8_rgba, guide_mask, input_points, input_box, None)
+    cropping_box = None
+    if coarse_predictor is not None:
+        coarse = localize_coarse(pixels_uint8_rgba, coarse_predictor, guide_mask, guide_strength, input_points, input_labels, input_box,
+                                 source_image.name, bpy.context.scene.frame_current, selection)
+        if coarse is not None:
+            input_box, cropping_box = coarse
+    pixels_uint8_rgb, cropping_box, input_logits, input_box, input_points = get_cropped_image(pixels_uint8_rgba, guide_mask, input_points, input_box, None, cropping_box)
+    embedding_key = get_embedding_key(source_image.name, bpy.context.scene.frame_current, cropping_box, predictor, pixels_uint8_rgb)
     print('loaded image')
 
     print('predicting masks')
-    best_mask, best_logits = predict_mask(pixels_uint8_rgb, predictor, guide_mask, guide_strength, input_points, input_labels, input_box, input_logits)
+    if cropping_box is not None:
+        guide_mask = crop_array(guide_mask, cropping_box)
+    if tiled and input_box is not None and needs_tiling(pixels_uint8_rgb.shape[1], pixels_uint8_rgb.shape[0]):
+        best_mask, best_logits = predict_mask_tiled(pixels_uint8_rgb, predictor, guide_mask, guide_strength, input_points, input_labels, input_box, input_logits,
+                                                    source_image.name, bpy.context.scene.frame_current, cropping_box, selection)
+    else:
+        best_mask, best_logits = predict_mask(pixels_uint8_rgb, predictor, guide_mask, guide_strength, input_points, input_labels, input_box, input_logits, embedding_key, selection)
     print('predicted masks')
 
     print('saving mask')
@@ -241,6 +277,34 @@ def generate_mask(
 
 
 
+def prefetch_frame(
+    source_image,
+    frame,
+    pixels_uint8_rgba,
+    guide_mask,
+    input_box,
+    predictor,
+    prefetcher,
+    gate = None
+):
+    engine.prefetch_frame(pixels_uint8_rgba, source_image.name, frame, guide_mask, input_box, predictor, prefetcher, gate)
+
+
+def encode_frame_batch(
+    source_image,
+    frames,
+    pixels_uint8_rgba_list,
+    cropping_box,
+    predictor
+):
+    engine.encode_frame_batch(source_image.name, frames, pixels_uint8_rgba_list, cropping_box, predictor)
+
+
+
+
+
+
+
 def track_mask(
     source_image, 
     used_mask,
@@ -252,21 +316,143 @@ def track_mask(
     input_points = None,
     input_labels = None,
     input_box = None,
-    input_logits = None
+    input_logits = None,
+    pixels_uint8_rgba = None,
+    prefetcher = None,
+    prefetch_next = None,
+    cropping_box = None,
+    selection = 'AREA',
+    previous_mask = None,
+    mask_prompt = 'GUIDE_MASK',
+    previous_logits = None,
+    gate = None,
+    box_predictor = None,
+    propagator = None,
+    tiled = False,
+    coarse_predictor = None
 ):
+    frame = bpy.context.scene.frame_current
     
     #Process the frame
-    pixels_uint8_rgba = bpyimg_to_HWCuint8(source_image)
-    pixels_uint8_rgb, cropping_box, input_logits, input_box, input_points = get_cropped_image(pixels_uint8_rgba, guide_mask, input_points, input_box, input_logits)
+    if pixels_uint8_rgba is None:
+        pixels_uint8_rgba = bpyimg_to_HWCuint8(source_image)
     
-    best_mask, best_logits = predict_mask(pixels_uint8_rgb, predictor, guide_mask, guide_strength, input_points, input_labels, input_box, input_logits)
+    return engine.track_frame(pixels_uint8_rgba = pixels_uint8_rgba,
+                              source_name = source_image.name,
+                              frame = frame,
+                              mask_sink = BlenderMaskSink(source_image, used_mask),
+                              predictor = predictor,
+                              guide_mask = guide_mask,
+                              guide_strength = guide_strength,
+                              blur_radius = blur_radius,
+                              search_radius = search_radius,
+                              input_points = input_points,
+                              input_labels = input_labels,
+                              input_box = input_box,
+                              input_logits = input_logits,
+                              prefetcher = prefetcher,
+                              prefetch_next = prefetch_next,
+                              cropping_box = cropping_box,
+                              selection = selection,
+                              previous_mask = previous_mask,
+                              mask_prompt = mask_prompt,
+                              previous_logits = previous_logits,
+                              gate = gate,
+                              box_predictor = box_predictor,
+                              propagator = propagator,
+                              tiled = tiled,
+                              coarse_predictor = coarse_predictor)
+
+
+
+
+
+
+
+def track_masks_shared(
+    source_image,
+    layers,
+    predictor,
+    pixels_uint8_rgba = None
+):
+    # Tracks several layers with one encoder pass, see engine.track_frame_shared
+    # Each entry of layers also holds the used_mask the layer is saved to
+    frame = bpy.context.scene.frame_current
     
-    overlay_l = save_sequential_mask(source_image, used_mask, best_mask, cropping_box, blur_radius)
+    #Process the frame
+    if pixels_uint8_rgba is None:
+        pixels_uint8_rgba = bpyimg_to_HWCuint8(source_image)
     
-    #Set input data for next frame
-    input_box = calculate_bounding_box(best_mask)
-    input_box = np.array([input_box[0] - search_radius, input_box[1] - search_radius, input_box[2] + search_radius, input_box[3] + search_radius])
-    if cropping_box is not None:
-        input_box = np.array([input_box[0] + cropping_box[0], input_box[1] + cropping_box[1], input_box[2] + cropping_box[0], input_box[3] + cropping_box[1]])
-        
-    return best_mask, input_box, overlay_l, best_logits
+    mask_sinks = [BlenderMaskSink(source_image, layer['used_mask']) for layer in layers]
+    return engine.track_frame_shared(pixels_uint8_rgba, source_image.name, frame, layers, mask_sinks, predictor)
+
+
+
+
+
+
+
+class BothDirectionsTracking(MaskSink):
+    """
+    Tracks a layer forwards and backwards from a frame at the same time in a background thread,
+    see engine.track_both_directions. Everything that needs bpy is read on creation, on the main thread.
+    Only works for sequences read_sequence_frame can decode from disk
+    """
+
+    def __init__(self, source_image, image_user, used_mask, predictor, frame, first_frame, last_frame, **tracking_args):
+        self.frame = frame
+        self.total = last_frame - first_frame + 1
+        self.tracked = 0
+        self.error = None
+        self.stop = threading.Event()
+        self._lock = threading.Lock()
+        self._writing = threading.Lock() # Held while a mask is written, pause takes it to keep the folder still
+        self._mask_sink = get_maskseq_sink(source_image, used_mask)
+        self._sources = [SceneFrameSource(source_image, image_user), SceneFrameSource(source_image, image_user)]
+        self._thread = threading.Thread(target=self._run, name='RotoForge both directions', daemon=True,
+                                        args=(predictor, list(range(first_frame, last_frame + 1)), tracking_args))
+
+    def start(self):
+        self._thread.start()
+
+    @property
+    def running(self):
+        return self._thread.is_alive()
+
+    def cancel(self):
+        # Both passes stop after their current frame
+        self.stop.set()
+        self._thread.join()
+
+    def pause(self):
+        # Waits for the mask being written, the passes then block on their next write until resume
+        self._writing.acquire()
+
+    def resume(self):
+        self._writing.release()
+
+    def write(self, frame, best_mask, cropping_box, blur = 0.0):
+        # Called from both passes, they write different frames
+        with self._writing:
+            overlay_l = self._mask_sink.write(frame, best_mask, cropping_box, blur)
+        with self._lock:
+            self.tracked += 1
+        return overlay_l
+
+    def _run(self, predictor, frames, tracking_args):
+        claim_current_thread()
+        try:
+            engine.track_both_directions(frame_source = self._sources[0],
+                                         mask_sink = self,
+                                         predictor = predictor,
+                                         frames = frames,
+                                         frame = self.frame,
+                                         stop = self.stop,
+                                         backward_source = self._sources[1],
+                                         **tracking_args)
+        except Exception as e:
+            print('Tracking both directions failed:', e)
+            self.error = e
+        finally:
+            for frame_source in self._sources:
+                frame_source.shutdown()
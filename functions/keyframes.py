@@ -0,0 +1,262 @@
+import time
+
+import numpy as np
+
+from .prompt_utils import calculate_bounding_box, carry_logits
+from .optical_flow import bilinear_sample
+
+
+# Runs the model only on keyframes and fills the frames in between from the two neighboring keyframes, bpy-free.
+# INTERVAL takes every Nth frame, ADAPTIVE takes the next keyframe as far ahead as the box predicted from the last
+# keyframes moves less than a fraction of its size. In-between frames are a crossfade of the low res logits of both
+# keyframes, each moved to where the object is on that frame, so the edge moves instead of fading. Where both
+# moved keyframe masks agree, their full resolution edge is kept, the logits only decide where they disagree.
+# If two keyframes disagree too much (the object changed shape or got lost), the frame in the middle runs the model too.
+
+KEYFRAME_MODES = ('EVERY', 'INTERVAL', 'ADAPTIVE')
+MIN_AGREEMENT = 0.85 # IoU of two keyframe masks moved onto each other below which the frame in the middle runs the model
+REGION_MARGIN = 2 # Pixels around the interpolated box
+
+
+
+
+class Keyframe:
+    """Result of a frame the model ran on, mask is full frame, logits are (low res logits, crop box) or None"""
+
+    def __init__(self, frame, mask, logits):
+        self.frame = frame
+        self.mask = mask
+        self.logits = logits
+        box = calculate_bounding_box(mask) if mask is not None else None
+        self.box = None if box is None else np.array(box, dtype=np.float64)
+
+
+def _map_box(box, from_box, to_box):
+    # Moves and scales box the same way from_box maps onto to_box
+    scale_x = (to_box[2] - to_box[0]) / max(from_box[2] - from_box[0], 1.0)
+    scale_y = (to_box[3] - to_box[1]) / max(from_box[3] - from_box[1], 1.0)
+    return np.array([to_box[0] + (box[0] - from_box[0]) * scale_x,
+                     to_box[1] + (box[1] - from_box[1]) * scale_y,
+                     to_box[0] + (box[2] - from_box[0]) * scale_x,
+                     to_box[1] + (box[3] - from_box[1]) * scale_y])
+
+
+def _move_mask(keyframe, box, region):
+    # Soft mask (float 0-1) of region with the keyframe mask moved and scaled from its box onto box
+    x0, y0, x1, y1 = region
+    scale_x = (keyframe.box[2] - keyframe.box[0]) / max(box[2] - box[0], 1.0)
+    scale_y = (keyframe.box[3] - keyframe.box[1]) / max(box[3] - box[1], 1.0)
+    source_x = keyframe.box[0] + (np.arange(x0, x1) + 0.5 - box[0]) * scale_x - 0.5
+    source_y = keyframe.box[1] + (np.arange(y0, y1) + 0.5 - box[1]) * scale_y - 0.5
+    xx, yy = np.meshgrid(source_x, source_y)
+    return bilinear_sample(keyframe.mask.astype(np.float32), xx, yy)
+
+
+def _region(box, resolution):
+    width, height = resolution
+    x0, y0 = (int(np.floor(value)) - REGION_MARGIN for value in box[:2])
+    x1, y1 = (int(np.ceil(value)) + REGION_MARGIN for value in box[2:])
+    return max(x0, 0), max(y0, 0), min(x1, width), min(y1, height)
+
+
+def agreement(first, second):
+    # IoU of the first keyframe mask moved onto the box of the second one and the second one
+    if first.box is None or second.box is None:
+        return 0.0
+    height, width = second.mask.shape
+    x0, y0, x1, y1 = region = _region(second.box, (width, height))
+    moved = _move_mask(first, second.box, region) >= 0.5
+    target = second.mask[y0:y1, x0:x1]
+    union = np.count_nonzero(moved | target)
+    return np.count_nonzero(moved & target) / union if union else 1.0
+
+
+def interpolate_mask(first, second, weight):
+    # Mask between two keyframes (weight 0 = first, 1 = second), returns (mask of the region, region as cropping box)
+    height, width = first.mask.shape
+    box = first.box + (second.box - first.box) * weight
+    x0, y0, x1, y1 = region = _region(box, (width, height))
+    if x1 <= x0 or y1 <= y0:
+        return np.zeros((1, 1), dtype=bool), (0, 0, 1, 1)
+    moved_first = _move_mask(first, box, region) >= 0.5
+    moved_second = _move_mask(second, box, region) >= 0.5
+    mask = moved_first & moved_second
+    disagree = moved_first ^ moved_second
+    if not np.any(disagree):
+        return mask, region
+
+    if first.logits is None or second.logits is None or first.logits[0] is None or second.logits[0] is None:
+        # Without logits the nearer keyframe decides
+        mask[disagree] = (moved_second if weight >= 0.5 else moved_first)[disagree]
+        return mask, region
+
+    # Crossfade of both logits, moved like their masks, on a square around the region
+    side = max(x1 - x0, y1 - y0)
+    logits_box = (x0, y0, x0 + side, y0 + side)
+    blended = 0.0
+    for keyframe, keyframe_weight in ((first, 1 - weight), (second, weight)):
+        logits, box_of_logits = keyframe.logits
+        moved_box = _map_box(np.asarray(box_of_logits, dtype=np.float64), keyframe.box, box)
+        blended = blended + keyframe_weight * carry_logits(logits, moved_box, logits_box)
+
+    rows, columns = np.nonzero(disagree)
+    size = blended.shape[-1]
+    grid_x = (columns + 0.5) * size / side - 0.5
+    grid_y = (rows + 0.5) * size / side - 0.5
+    mask[rows, columns] = bilinear_sample(blended, grid_x, grid_y) > 0
+    return mask, region
+
+
+
+
+class KeyframeScheduler:
+    """
+    Picks the frames the model runs on and fills the frames in between. EVERY runs the model on every frame,
+    INTERVAL on every interval-th frame, ADAPTIVE up to interval frames apart, as long as the box predicted from
+    the last two keyframes moves less than motion_threshold (fraction of the box size) until the next one.
+    """
+
+    def __init__(self, mode='EVERY', interval=4, motion_threshold=0.1):
+        self.mode = mode
+        self.interval = interval
+        self.motion_threshold = motion_threshold
+        self.reset()
+
+    def reset(self):
+        # Forgets all keyframes, the next frame runs the model
+        self._keyframes = []
+        self._gaps = [] # (earlier keyframe, later keyframe) with frames in between the model has to run on
+        self._max_step = None
+        self.model_frames = 0
+        self.filled_frames = 0
+        self._model_time = 0.0
+        self._started = None
+        self._requested = None
+
+    def start(self):
+        # Call right before the model runs on the first frame, it times the model
+        self._started = self._requested = time.perf_counter()
+
+    @property
+    def enabled(self):
+        return self.mode != 'EVERY' and self.interval > 1
+
+    @property
+    def last(self):
+        # Furthest keyframe, the one tracking continues from
+        return self._keyframes[-1] if self._keyframes else None
+
+    def _velocity(self):
+        # Per frame change of (x0, y0, x1, y1) between the last two keyframes, also tells the direction
+        if len(self._keyframes) < 2 or self._keyframes[-2].box is None or self.last.box is None:
+            return np.zeros(4)
+        previous, last = self._keyframes[-2], self.last
+        return (last.box - previous.box) / (last.frame - previous.frame)
+
+    def _step(self):
+        if self.mode == 'INTERVAL':
+            step = self.interval
+        else:
+            # The largest step the predicted box edges move less than the threshold in
+            speed = np.max(np.abs(self._velocity()))
+            size = max(self.last.box[2] - self.last.box[0], self.last.box[3] - self.last.box[1], 1.0)
+            step = self.interval if speed == 0 else int(self.motion_threshold * size / speed)
+        if self._max_step is not None:
+            step = min(step, self._max_step)
+        return int(np.clip(step, 1, self.interval))
+
+    def next_frame(self, end_frame, direction=1):
+        # Frame the model runs on next, None when everything up to end_frame is tracked or the object got lost
+        if self._gaps:
+            earlier, later = self._gaps[-1]
+            frame = (earlier.frame + later.frame) // 2
+        elif self.last is None or self.last.box is None or self.last.frame == end_frame:
+            return None
+        else:
+            frame = self.last.frame + direction * self._step()
+            if (frame - end_frame) * direction > 0:
+                frame = end_frame
+        self._requested = time.perf_counter()
+        return frame
+
+    def prompt(self, frame, search_radius):
+        # (guide mask, input box, logits) to track frame with, the running state of the tracker doesn't fit jumps
+        if self._gaps:
+            # In between two keyframes, the interpolated mask is the prompt, the logits of either would be off
+            earlier, later = self._gaps[-1]
+            mask, region = interpolate_mask(earlier, later, (frame - earlier.frame) / (later.frame - earlier.frame))
+            guide_mask = np.zeros_like(earlier.mask)
+            guide_mask[region[1]:region[3], region[0]:region[2]] = mask
+            box, logits, frames_ahead = calculate_bounding_box(guide_mask), None, 1
+        else:
+            # Ahead of the last keyframe, its box and logits move on with the velocity of the last keyframes
+            guide_mask = self.last.mask
+            motion = self._velocity() * (frame - self.last.frame)
+            box = self.last.box + motion
+            logits = self.last.logits
+            if logits is not None and logits[0] is not None:
+                logits = (logits[0], np.asarray(logits[1], dtype=np.float64) + motion)
+            frames_ahead = max(abs(frame - self.last.frame), 1)
+        if box is None:
+            return guide_mask, None, logits
+
+        # The search radius is per frame
+        height, width = guide_mask.shape
+        padding = search_radius * frames_ahead
+        box = np.asarray(box, dtype=np.float64) + np.array([-padding, -padding, padding, padding])
+        return guide_mask, np.clip(box, 0, [width, height, width, height]), logits
+
+    def add(self, frame, mask, logits):
+        # Records the model result of frame, returns the filled in frames as [(frame, mask, cropping box)]
+        if self._requested is not None:
+            self._model_time += time.perf_counter() - self._requested
+            self._requested = None
+        self.model_frames += 1
+        keyframe = Keyframe(frame, mask, logits)
+
+        if self._gaps:
+            earlier, later = self._gaps.pop()
+            return self._close(earlier, keyframe) + self._close(keyframe, later)
+
+        previous = self.last
+        if previous is None or abs(frame - previous.frame) <= 1:
+            self._max_step = None
+            self._keyframes = self._keyframes[-1:] + [keyframe]
+            return []
+
+        if keyframe.box is None:
+            # Lost on a keyframe that skipped frames, try again closer to the last one
+            self._max_step = max(abs(frame - previous.frame) // 2, 1)
+            return []
+        self._max_step = None
+        self._keyframes = self._keyframes[-1:] + [keyframe]
+        return self._close(previous, keyframe)
+
+    def _close(self, earlier, later):
+        # Fills the frames between two keyframes, or queues the one in the middle if they don't agree
+        span = later.frame - earlier.frame
+        if abs(span) <= 1:
+            return []
+        if earlier.box is None or later.box is None or agreement(earlier, later) < MIN_AGREEMENT:
+            self._gaps.append((earlier, later))
+            return []
+        filled = []
+        direction = 1 if span > 0 else -1
+        for frame in range(earlier.frame + direction, later.frame, direction):
+            mask, region = interpolate_mask(earlier, later, (frame - earlier.frame) / span)
+            filled.append((frame, mask, region))
+        self.filled_frames += len(filled)
+        return filled
+
+    @property
+    def speedup(self):
+        # Time the model would have taken on every frame over the time it took
+        frames = self.model_frames + self.filled_frames
+        if not self.model_frames or self._started is None:
+            return 1.0
+        elapsed = time.perf_counter() - self._started
+        return (self._model_time / self.model_frames * frames) / max(elapsed, 1e-9)
+
+    def summary(self):
+        frames = self.model_frames + self.filled_frames
+        return f'Ran the model on {self.model_frames}/{frames} frames, {self.speedup:.1f}x faster than every frame'
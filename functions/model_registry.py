@@ -0,0 +1,142 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from .engine import empty_device_cache
+from .core_scheduler import claim_current_thread
+
+
+# Keeps several loaded predictors around, so switching between layers with different models
+# doesn't reload the checkpoint every time. bpy-free, the loader is passed in.
+
+def predictor_nbytes(predictor):
+    if getattr(predictor, 'backend', 'torch') != 'torch':
+        return predictor.nbytes
+    # The state dict also holds the packed weights of INT8 quantized layers, they aren't parameters
+    total = 0
+    for value in predictor.model.state_dict().values():
+        for tensor in (value if isinstance(value, tuple) else (value,)):
+            if tensor is not None and hasattr(tensor, 'nelement'):
+                total += tensor.element_size() * tensor.nelement()
+    return total
+
+
+
+
+class PredictorRegistry:
+    """RAM bounded LRU of loaded predictors"""
+
+    def __init__(self, loader, max_bytes=8 * 1024**3):
+        self.loader = loader # model_type -> predictor
+        self.max_bytes = max_bytes
+        self._predictors = OrderedDict() # model_type -> (predictor, size in bytes)
+        self._loading = {} # model_type -> Future of a load in progress
+        self._failed = {} # model_type -> error message of the last failed load
+        self._freed = set() # model_types freed while loading, their load is handed to the waiting callers but not kept
+        self._lock = threading.RLock()
+
+    def get(self, model_type, loader=None):
+        # Loads the model if needed, if it's already loading in another thread this waits for that load
+        with self._lock:
+            if model_type in self._predictors:
+                self._predictors.move_to_end(model_type)
+                return self._predictors[model_type][0]
+
+            future = self._loading.get(model_type)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._loading[model_type] = future
+                self._failed.pop(model_type, None)
+
+        if owner:
+            # Load outside of the lock, so drawing the UI doesn't block on a loading checkpoint
+            try:
+                predictor = (loader or self.loader)(model_type)
+            except Exception as e:
+                with self._lock:
+                    self._failed[model_type] = str(e)
+                    del self._loading[model_type]
+                    self._freed.discard(model_type)
+                future.set_exception(e)
+                raise
+            with self._lock:
+                del self._loading[model_type]
+                if model_type in self._freed:
+                    self._freed.discard(model_type)
+                else:
+                    self._predictors[model_type] = (predictor, predictor_nbytes(predictor))
+                    self._evict(keep=model_type)
+            future.set_result(predictor)
+            return predictor
+
+        return future.result()
+
+    def warm_up(self, model_type, loader=None):
+        # Starts loading the model in a background thread, returns False if there was nothing to do
+        with self._lock:
+            if model_type in self._predictors or model_type in self._loading:
+                return False
+
+        def load():
+            claim_current_thread()
+            try:
+                self.get(model_type, loader)
+            except Exception as e:
+                print(f'Warming up predictor {model_type} failed: {e}')
+
+        threading.Thread(target=load, name=f'RotoForge warm-up {model_type}', daemon=True).start()
+        return True
+
+    def is_loaded(self, model_type):
+        return model_type in self._predictors
+
+    def state(self, model_type):
+        # One of 'LOADED', 'LOADING', 'FAILED', 'UNLOADED'
+        with self._lock:
+            if model_type in self._predictors:
+                return 'LOADED'
+            if model_type in self._loading:
+                return 'LOADING'
+            if model_type in self._failed:
+                return 'FAILED'
+            return 'UNLOADED'
+
+    def is_loading(self):
+        return bool(self._loading)
+
+    def resident(self):
+        # [(model_type, size in bytes)], least recently used first
+        with self._lock:
+            return [(model_type, size) for model_type, (_, size) in self._predictors.items()]
+
+    def free(self, model_type=None):
+        # Frees one model, or all of them if no model_type is given. Loads in progress finish for whoever waits
+        # on them, but the model doesn't stay loaded
+        with self._lock:
+            if model_type is None:
+                self._predictors.clear()
+                self._freed.update(self._loading)
+            else:
+                self._predictors.pop(model_type, None)
+                if model_type in self._loading:
+                    self._freed.add(model_type)
+        empty_device_cache()
+
+    def set_max_bytes(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def _evict(self, keep=None):
+        # The model that is about to be used always stays, even if it alone exceeds the budget
+        evicted = False
+        while sum(size for _, size in self._predictors.values()) > self.max_bytes:
+            model_type = next((key for key in self._predictors if key != keep), None)
+            if model_type is None:
+                break
+            print(f'Unloading predictor {model_type} to stay inside the model memory budget')
+            del self._predictors[model_type]
+            evicted = True
+        if evicted:
+            empty_device_cache()
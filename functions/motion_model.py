@@ -0,0 +1,88 @@
+import numpy as np
+
+
+# Predicts the box of the next frame from the boxes of the tracked masks, bpy-free.
+# A Kalman filter with a constant velocity model over box center and size, the box gets padded by its
+# uncertainty, so fast or erratic objects get a larger search area and steady ones a tighter one.
+# The noise is relative to the box size, a box of 500 px may move more pixels per frame than one of 50 px.
+
+BOX_PREDICTIONS = ('FIXED', 'KALMAN')
+
+MEASUREMENT_STD = 0.01 # Noise of the mask box, fraction of the box size
+POSITION_STD = 0.002 # Process noise of center and size per frame
+VELOCITY_STD = 0.015 # Process noise of the velocities per frame
+SIGMAS = 3.0 # Padding in standard deviations of the prediction
+MIN_PADDING = 2.0 # Pixels
+
+
+
+
+class BoxKalmanFilter:
+    """
+    State is (cx, cy, w, h) and their velocities. update() takes the box of the tracked mask,
+    predict_box() returns the padded box to search the object in on the next frame.
+    """
+
+    def __init__(self, sigmas=SIGMAS, min_padding=MIN_PADDING):
+        self.sigmas = sigmas
+        self.min_padding = min_padding
+
+        self._transition = np.eye(8)
+        self._transition[:4, 4:] = np.eye(4)
+        self._observation = np.eye(4, 8)
+        self.reset()
+
+    def reset(self):
+        self.state = None
+        self.covariance = None
+
+    @property
+    def initialized(self):
+        return self.state is not None
+
+    def _size(self):
+        return max(self.state[2], self.state[3], 1.0)
+
+    def _process_noise(self):
+        size = self._size()
+        return np.diag(np.square([POSITION_STD * size] * 4 + [VELOCITY_STD * size] * 4))
+
+    def _measurement_noise(self):
+        return np.diag(np.square([max(MEASUREMENT_STD * self._size(), 1.0)] * 4))
+
+    def update(self, box):
+        # box is (x0, y0, x1, y1) of the tracked mask in frame coords
+        x0, y0, x1, y1 = box
+        measurement = np.array([(x0 + x1) / 2, (y0 + y1) / 2, x1 - x0, y1 - y0], dtype=np.float64)
+
+        if self.state is None:
+            self.state = np.concatenate([measurement, np.zeros(4)])
+            size = self._size()
+            self.covariance = np.diag(np.square([2 * MEASUREMENT_STD * size] * 4 + [10 * VELOCITY_STD * size] * 4))
+            return
+
+        # Predict this frame from the last one, then correct it with the measured box
+        self.state = self._transition @ self.state
+        self.covariance = self._transition @ self.covariance @ self._transition.T + self._process_noise()
+
+        innovation = measurement - self._observation @ self.state
+        innovation_covariance = self._observation @ self.covariance @ self._observation.T + self._measurement_noise()
+        gain = self.covariance @ self._observation.T @ np.linalg.inv(innovation_covariance)
+        self.state = self.state + gain @ innovation
+        self.covariance = (np.eye(8) - gain @ self._observation) @ self.covariance
+
+    def predict_box(self):
+        # Padded box of the next frame, None before the first update
+        if self.state is None:
+            return None
+        state = self._transition @ self.state
+        covariance = self._transition @ self.covariance @ self._transition.T + self._process_noise()
+        center_x, center_y, width, height = state[:4]
+        std_x, std_y, std_width, std_height = np.sqrt(np.diag(covariance)[:4])
+
+        # The edges move with the center and half of the size change
+        padding_x = max(self.sigmas * (std_x + std_width / 2), self.min_padding)
+        padding_y = max(self.sigmas * (std_y + std_height / 2), self.min_padding)
+        half_width = max(width, 1.0) / 2 + padding_x
+        half_height = max(height, 1.0) / 2 + padding_y
+        return np.array([center_x - half_width, center_y - half_height, center_x + half_width, center_y + half_height])
@@ -0,0 +1,312 @@
+import os
+import shutil
+import warnings
+
+import numpy as np
+import PIL.Image
+
+from .embedding_cache import ImageEmbedding, resize_longest_side
+from .quantization import split_model_type, quantize_onnx_encoder
+
+
+# ONNX Runtime CPU backend for SAM-HQ, bpy-free.
+# The image encoder and the prompt encoder + mask decoder of a sam_hq_*.pth are exported once
+# (needs torch and segment_anything), after that inference only needs onnxruntime and numpy.
+
+ENCODER_FILE = 'encoder.onnx'
+DECODER_FILE = 'decoder.onnx'
+OPSET_VERSION = 17
+EXTERNAL_DATA_MODELS = ('vit_h',) # Encoder over the 2 GB protobuf limit, its weights go into encoder.onnx.data
+
+IMG_SIZE = 1024
+LOW_RES_SIZE = 256
+PIXEL_MEAN = np.array([123.675, 116.28, 103.53], dtype=np.float32)
+PIXEL_STD = np.array([58.395, 57.12, 57.375], dtype=np.float32)
+
+
+
+
+def get_onnx_paths(onnx_dir, model_type):
+    # Every model gets its own folder, so the external weights of the EXTERNAL_DATA_MODELS stay next to their graph
+    model_dir = os.path.join(onnx_dir, model_type)
+    return os.path.join(model_dir, ENCODER_FILE), os.path.join(model_dir, DECODER_FILE)
+
+
+def get_preprocess_shape(old_h, old_w, long_side_length=IMG_SIZE):
+    # Same as ResizeLongestSide.get_preprocess_shape
+    scale = long_side_length * 1.0 / max(old_h, old_w)
+    return int(old_h * scale + 0.5), int(old_w * scale + 0.5)
+
+
+def apply_coords(coords, original_size):
+    # Same as ResizeLongestSide.apply_coords
+    old_h, old_w = original_size
+    new_h, new_w = get_preprocess_shape(old_h, old_w)
+    coords = np.array(coords, dtype=np.float32)
+    coords[..., 0] = coords[..., 0] * (new_w / old_w)
+    coords[..., 1] = coords[..., 1] * (new_h / old_h)
+    return coords
+
+
+def preprocess(pixels_uint8_rgb):
+    # Resize the long side to 1024, normalize and pad to the square encoder input, returns 1x3x1024x1024 float32
+    image = resize_longest_side(pixels_uint8_rgb, IMG_SIZE)
+    new_h, new_w = image.shape[:2]
+
+    input_image = np.zeros((IMG_SIZE, IMG_SIZE, 3), dtype=np.float32)
+    input_image[:new_h, :new_w] = (image.astype(np.float32) - PIXEL_MEAN) / PIXEL_STD
+    return input_image.transpose(2, 0, 1)[None], (new_h, new_w)
+
+
+def resize_logits(logits, size):
+    # Bilinear resize of a HxW float32 array, size is (height, width)
+    image = PIL.Image.fromarray(logits.astype(np.float32), mode='F')
+    return np.asarray(image.resize((size[1], size[0]), PIL.Image.BILINEAR))
+
+
+def postprocess_masks(low_res_masks, input_size, original_size):
+    # Same as Sam.postprocess_masks: upscale to the padded input, remove the padding, scale to the image size
+    masks = []
+    for low_res_mask in low_res_masks:
+        mask = resize_logits(low_res_mask, (IMG_SIZE, IMG_SIZE))
+        mask = mask[:input_size[0], :input_size[1]]
+        masks.append(resize_logits(mask, original_size))
+    return np.stack(masks)
+
+
+
+
+class OnnxSamPredictor:
+    """SamPredictor lookalike that runs the exported SAM-HQ model with ONNX Runtime on the CPU"""
+    backend = 'onnx'
+    device = None # Embeddings stay numpy arrays
+    mask_threshold = 0.0
+
+    def __init__(self, encoder_path, decoder_path, model_type, num_threads=0):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads > 0:
+            options.intra_op_num_threads = num_threads
+        providers = ['CPUExecutionProvider']
+        self.encoder = onnxruntime.InferenceSession(encoder_path, options, providers=providers)
+        self.decoder = onnxruntime.InferenceSession(decoder_path, options, providers=providers)
+
+        self.model_type = model_type
+        # Rough memory footprint for the model registry, the weights are loaded once by the sessions
+        model_dir = os.path.dirname(encoder_path)
+        self.nbytes = sum(os.path.getsize(os.path.join(model_dir, file)) for file in os.listdir(model_dir))
+        self.reset_image()
+
+    def reset_image(self):
+        self.is_image_set = False
+        self.features = None
+        self.interm_features = None
+        self.original_size = None
+        self.input_size = None
+
+    def compute_embeddings(self, pixels_uint8_rgb_list):
+        # The encoder is exported with a dynamic batch axis, so several images go through in one run
+        inputs = [preprocess(pixels_uint8_rgb) for pixels_uint8_rgb in pixels_uint8_rgb_list]
+        batch = np.concatenate([input_image for input_image, _ in inputs], axis=0)
+        features, interm_features = self.encoder.run(None, {'image': batch})
+
+        embeddings = []
+        for i, (pixels_uint8_rgb, (_, input_size)) in enumerate(zip(pixels_uint8_rgb_list, inputs)):
+            embeddings.append(ImageEmbedding(features[i:i+1].copy() if len(inputs) > 1 else features,
+                                             [interm_features[i:i+1].copy() if len(inputs) > 1 else interm_features],
+                                             pixels_uint8_rgb.shape[:2],
+                                             input_size))
+        return embeddings
+
+    def set_image(self, image, image_format='RGB'):
+        if image_format != 'RGB':
+            image = image[..., ::-1]
+        embedding = self.compute_embeddings([image])[0]
+        self.reset_image()
+        self.features = embedding.features
+        self.interm_features = embedding.interm_features
+        self.original_size = embedding.original_size
+        self.input_size = embedding.input_size
+        self.is_image_set = True
+
+    def predict(self, point_coords=None, point_labels=None, box=None, mask_input=None, multimask_output=True, return_logits=False):
+        if not self.is_image_set:
+            raise RuntimeError('An image must be set with .set_image(...) before mask prediction.')
+        if not multimask_output:
+            raise ValueError('The ONNX decoder is exported with multimask_output=True')
+
+        # Points first, then the box corners, like the torch prompt encoder concatenates them
+        coords = np.zeros((0, 2), dtype=np.float32)
+        labels = np.zeros((0,), dtype=np.float32)
+        if point_coords is not None:
+            coords = apply_coords(point_coords, self.original_size)
+            labels = np.array(point_labels, dtype=np.float32)
+        if box is not None:
+            coords = np.concatenate([coords, apply_coords(np.array(box).reshape(2, 2), self.original_size)], axis=0)
+            labels = np.concatenate([labels, np.array([2, 3], dtype=np.float32)])
+        else:
+            # Without a box the torch prompt encoder pads the points with a "not a point" entry
+            coords = np.concatenate([coords, np.zeros((1, 2), dtype=np.float32)], axis=0)
+            labels = np.concatenate([labels, np.array([-1], dtype=np.float32)])
+
+        if mask_input is not None:
+            mask_input = np.asarray(mask_input, dtype=np.float32).reshape(1, 1, LOW_RES_SIZE, LOW_RES_SIZE)
+            has_mask_input = np.ones(1, dtype=np.float32)
+        else:
+            mask_input = np.zeros((1, 1, LOW_RES_SIZE, LOW_RES_SIZE), dtype=np.float32)
+            has_mask_input = np.zeros(1, dtype=np.float32)
+
+        low_res_masks, iou_predictions = self.decoder.run(None, {
+            'image_embeddings': self.features,
+            'interm_embeddings': self.interm_features[0],
+            'point_coords': coords[None],
+            'point_labels': labels[None],
+            'mask_input': mask_input,
+            'has_mask_input': has_mask_input,
+        })
+
+        masks = postprocess_masks(low_res_masks[0], self.input_size, self.original_size)
+        if not return_logits:
+            masks = masks > self.mask_threshold
+        return masks, iou_predictions[0], low_res_masks[0]
+
+
+
+
+def save_external_data(exported_path, model_path):
+    # torch writes models over 2 GB with one weights file per tensor, this puts them all into <model file>.data
+    import onnx
+
+    model = onnx.load(exported_path)
+    onnx.save_model(model, model_path, save_as_external_data=True, all_tensors_to_one_file=True,
+                    location=os.path.basename(model_path) + '.data')
+
+
+def export_onnx(sam, encoder_path, decoder_path, multimask_output=True, hq_token_only=False, external_data=False):
+    # Exports the image encoder and the prompt encoder + mask decoder of a loaded torch Sam model,
+    # with external_data the encoder weights are saved next to the graph (see EXTERNAL_DATA_MODELS)
+    import torch
+
+    class EncoderWrapper(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.image_encoder = model.image_encoder
+
+        def forward(self, image):
+            features, interm_features = self.image_encoder(image)
+            # The HQ decoder only reads the first interm embedding
+            return features, interm_features[0]
+
+    class DecoderWrapper(torch.nn.Module):
+        # Same prompt embedding as segment_anything.utils.onnx.SamOnnxModel, but the decoder output is
+        # left untouched so it matches SamPredictor.predict
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def embed_points(self, point_coords, point_labels):
+            prompt_encoder = self.model.prompt_encoder
+            point_coords = (point_coords + 0.5) / IMG_SIZE
+            point_embedding = prompt_encoder.pe_layer._pe_encoding(point_coords)
+            point_labels = point_labels.unsqueeze(-1).expand_as(point_embedding)
+
+            point_embedding = point_embedding * (point_labels != -1)
+            point_embedding = point_embedding + prompt_encoder.not_a_point_embed.weight * (point_labels == -1)
+            for i in range(prompt_encoder.num_point_embeddings):
+                point_embedding = point_embedding + prompt_encoder.point_embeddings[i].weight * (point_labels == i)
+            return point_embedding
+
+        def embed_masks(self, mask_input, has_mask_input):
+            prompt_encoder = self.model.prompt_encoder
+            mask_embedding = has_mask_input * prompt_encoder.mask_downscaling(mask_input)
+            return mask_embedding + (1 - has_mask_input) * prompt_encoder.no_mask_embed.weight.reshape(1, -1, 1, 1)
+
+        def forward(self, image_embeddings, interm_embeddings, point_coords, point_labels, mask_input, has_mask_input):
+            low_res_masks, iou_predictions = self.model.mask_decoder(
+                image_embeddings=image_embeddings,
+                image_pe=self.model.prompt_encoder.get_dense_pe(),
+                sparse_prompt_embeddings=self.embed_points(point_coords, point_labels),
+                dense_prompt_embeddings=self.embed_masks(mask_input, has_mask_input),
+                multimask_output=multimask_output,
+                hq_token_only=hq_token_only,
+                interm_embeddings=[interm_embeddings],
+            )
+            return low_res_masks, iou_predictions
+
+    sam = sam.to('cpu').eval()
+    encoder = EncoderWrapper(sam)
+    decoder = DecoderWrapper(sam)
+
+    for path in [encoder_path, decoder_path]:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with warnings.catch_warnings(), torch.no_grad():
+        warnings.filterwarnings('ignore', category=torch.jit.TracerWarning)
+        warnings.filterwarnings('ignore', category=UserWarning)
+
+        dummy_image = torch.zeros(1, 3, IMG_SIZE, IMG_SIZE)
+        features, interm_features = encoder(dummy_image)
+
+        export_dir = encoder_path + '.tmp' if external_data else None
+        if export_dir is not None:
+            os.makedirs(export_dir, exist_ok=True)
+        torch.onnx.export(encoder, (dummy_image,), encoder_path if export_dir is None else os.path.join(export_dir, ENCODER_FILE),
+                          input_names=['image'],
+                          output_names=['image_embeddings', 'interm_embeddings'],
+                          dynamic_axes={'image': {0: 'batch'},
+                                        'image_embeddings': {0: 'batch'},
+                                        'interm_embeddings': {0: 'batch'}},
+                          opset_version=OPSET_VERSION,
+                          dynamo=False)
+        if export_dir is not None:
+            save_external_data(os.path.join(export_dir, ENCODER_FILE), encoder_path)
+            shutil.rmtree(export_dir)
+
+        dummy_inputs = (features,
+                        interm_features,
+                        torch.randint(0, IMG_SIZE, (1, 3, 2), dtype=torch.float),
+                        torch.tensor([[1, 2, 3]], dtype=torch.float),
+                        torch.zeros(1, 1, LOW_RES_SIZE, LOW_RES_SIZE),
+                        torch.ones(1))
+        torch.onnx.export(decoder, dummy_inputs, decoder_path,
+                          input_names=['image_embeddings', 'interm_embeddings', 'point_coords', 'point_labels', 'mask_input', 'has_mask_input'],
+                          output_names=['low_res_masks', 'iou_predictions'],
+                          dynamic_axes={'point_coords': {1: 'num_points'},
+                                        'point_labels': {1: 'num_points'}},
+                          opset_version=OPSET_VERSION,
+                          dynamo=False)
+
+
+def export_checkpoint(model_type, sam_checkpoint, onnx_dir):
+    import segment_anything
+
+    encoder_path, decoder_path = get_onnx_paths(onnx_dir, model_type)
+    base_model_type, quantized = split_model_type(model_type)
+    print(f'Exporting {model_type} to ONNX, this only happens once per model')
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', category=UserWarning)
+        sam = segment_anything.sam_model_registry[base_model_type](checkpoint=sam_checkpoint)
+    external_data = base_model_type in EXTERNAL_DATA_MODELS
+    export_onnx(sam, encoder_path, decoder_path, external_data=external_data)
+    if quantized:
+        # Quantize the exported fp32 graph, the decoder is cheap and stays fp32
+        quantize_onnx_encoder(encoder_path, external_data=external_data)
+    return encoder_path, decoder_path
+
+
+def load_onnx_predictor(model_type, sam_checkpoint, onnx_dir, num_threads=0):
+    encoder_path, decoder_path = get_onnx_paths(onnx_dir, model_type)
+
+    # Export on first use, and again if the checkpoint got replaced since the last export
+    exported = os.path.isfile(encoder_path) and os.path.isfile(decoder_path)
+    if exported and os.path.isfile(sam_checkpoint):
+        exported = min(os.path.getmtime(encoder_path), os.path.getmtime(decoder_path)) >= os.path.getmtime(sam_checkpoint)
+    if not exported:
+        export_checkpoint(model_type, sam_checkpoint, onnx_dir)
+
+    print(f'loading ONNX predictor {model_type}')
+    predictor = OnnxSamPredictor(encoder_path, decoder_path, f'{model_type}_onnx', num_threads=num_threads)
+    print('loaded ONNX predictor')
+    return predictor
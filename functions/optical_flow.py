@@ -0,0 +1,235 @@
+import numpy as np
+
+from .frame_gating import gray_region, estimate_shift
+from .prompt_utils import LOGITS_BACKGROUND
+
+
+# Block matching flow inside the search box and warping of masks and low res logits with it, bpy-free and numpy only.
+# The global motion of the box comes from phase correlation, every block then searches a few cells around it,
+# so large motions cost the same as small ones. Blocks without texture keep the global motion.
+# The mask isn't warped block by block, the blocks on the object are fitted with one affine motion (move, scale,
+# rotate, shear), which keeps the edge from dragging along with the background and the drift low.
+
+FLOW_STEP = 2 # Pixel stride of the subsampled gray images
+FLOW_BLOCK = 8 # Block size in cells
+FLOW_SEARCH = 3 # Cells searched around the global motion
+FLOW_MARGIN = 16 # Pixels added around the search box
+FLAT_LEVEL = 2.0 # Mean gray difference below which a block counts as without texture
+FLOW_MODES = ('NONE', 'PROMPT', 'PROPAGATE')
+
+
+
+
+class BlockFlow:
+    """Motion (dx, dy) in pixels of the blocks of a region: current frame at a block center = previous frame at center - motion"""
+
+    def __init__(self, origin, block_size, vectors):
+        self.origin = np.asarray(origin, dtype=np.float64) # (x, y) of the first block in frame pixels
+        self.block_size = block_size # Pixels
+        self.vectors = vectors # (blocks y, blocks x, 2)
+
+    def centers(self):
+        # Frame positions of the block centers, (blocks y, blocks x, 2)
+        blocks_y, blocks_x = self.vectors.shape[:2]
+        grid_x = self.origin[0] + (np.arange(blocks_x) + 0.5) * self.block_size
+        grid_y = self.origin[1] + (np.arange(blocks_y) + 0.5) * self.block_size
+        return np.stack(np.meshgrid(grid_x, grid_y), axis=-1)
+
+    def region(self):
+        blocks_y, blocks_x = self.vectors.shape[:2]
+        x0, y0 = self.origin
+        return x0, y0, x0 + blocks_x * self.block_size, y0 + blocks_y * self.block_size
+
+
+
+
+def _subpixel_offset(cost_low, cost_best, cost_high):
+    # Vertex of the parabola through three costs, in [-0.5, 0.5]
+    curvature = cost_low - 2 * cost_best + cost_high
+    offset = np.divide(cost_low - cost_high, 2 * curvature, out=np.zeros_like(curvature), where=curvature > 0)
+    return np.clip(offset, -0.5, 0.5)
+
+
+def estimate_flow(previous_pixels, current_pixels, search_box, previous_mask=None, step=FLOW_STEP, block=FLOW_BLOCK, search=FLOW_SEARCH):
+    # Block flow inside search_box (x0, y0, x1, y1 in frame pixels), None if the box is too small for a block.
+    # With the (soft) mask of the previous frame the global motion is the one of the object, not of the background
+    height, width = current_pixels.shape[:2]
+    x0, y0, x1, y1 = (int(value) // step for value in search_box)
+    x0, y0 = max(x0, 0), max(y0, 0)
+    x1, y1 = min(x1, width // step), min(y1, height // step)
+    blocks_x, blocks_y = (x1 - x0) // block, (y1 - y0) // block
+    if blocks_x < 1 or blocks_y < 1:
+        return None
+    x1, y1 = x0 + blocks_x * block, y0 + blocks_y * block
+
+    previous = gray_region(previous_pixels, (x0, y0, x1, y1), step)
+    current = gray_region(current_pixels, (x0, y0, x1, y1), step)
+    weights = None
+    if previous_mask is not None:
+        weights = previous_mask[y0 * step:y1 * step:step, x0 * step:x1 * step:step]
+        weights = weights if np.count_nonzero(weights) > 0 else None
+    global_dx, global_dy = estimate_shift(previous, current, weights)
+
+    # Cost of every candidate motion for every block, previous is edge padded so every shift has a full window
+    reach = search + max(abs(global_dx), abs(global_dy))
+    padded = np.pad(previous, reach, mode='edge')
+    size = 2 * search + 1
+    costs = np.empty((size, size, blocks_y, blocks_x), dtype=np.float32)
+    for j in range(size):
+        for i in range(size):
+            dx, dy = global_dx + i - search, global_dy + j - search
+            moved = padded[reach - dy:reach - dy + current.shape[0], reach - dx:reach - dx + current.shape[1]]
+            costs[j, i] = np.abs(current - moved).reshape(blocks_y, block, blocks_x, block).sum(axis=(1, 3))
+
+    flat_costs = costs.reshape(size * size, blocks_y, blocks_x)
+    best = np.argmin(flat_costs, axis=0)
+    best_y, best_x = np.divmod(best, size)
+    # Flat blocks match every motion about equally well (less than FLAT_LEVEL gray levels apart), they follow the global motion
+    flat = flat_costs.max(axis=0) - flat_costs.min(axis=0) < FLAT_LEVEL * block * block
+    best_x[flat] = search
+    best_y[flat] = search
+
+    # Sub-cell motion from the costs next to the minimum
+    rows, columns = np.mgrid[0:blocks_y, 0:blocks_x]
+    inner_x = np.clip(best_x, 1, size - 2)
+    inner_y = np.clip(best_y, 1, size - 2)
+    offset_x = _subpixel_offset(costs[best_y, inner_x - 1, rows, columns], costs[best_y, inner_x, rows, columns], costs[best_y, inner_x + 1, rows, columns])
+    offset_y = _subpixel_offset(costs[inner_y - 1, best_x, rows, columns], costs[inner_y, best_x, rows, columns], costs[inner_y + 1, best_x, rows, columns])
+    offset_x[(best_x != inner_x) | flat] = 0
+    offset_y[(best_y != inner_y) | flat] = 0
+
+    vectors = np.stack([global_dx + best_x - search + offset_x, global_dy + best_y - search + offset_y], axis=-1) * step
+    return BlockFlow((x0 * step, y0 * step), block * step, vectors.astype(np.float64))
+
+
+def bilinear_sample(image, x, y, outside=0.0):
+    # Samples a 2D array at pixel positions (pixel centers at integers)
+    height, width = image.shape
+    inside = (x >= -0.5) & (x <= width - 0.5) & (y >= -0.5) & (y <= height - 0.5)
+    x = np.clip(x, 0, width - 1)
+    y = np.clip(y, 0, height - 1)
+    x0 = np.floor(x).astype(np.int64)
+    y0 = np.floor(y).astype(np.int64)
+    x1 = np.minimum(x0 + 1, width - 1)
+    y1 = np.minimum(y0 + 1, height - 1)
+    wx = (x - x0).astype(np.float32)
+    wy = (y - y0).astype(np.float32)
+    top = image[y0, x0] * (1 - wx) + image[y0, x1] * wx
+    bottom = image[y1, x0] * (1 - wx) + image[y1, x1] * wx
+    sampled = (top * (1 - wy) + bottom * wy).astype(np.float32)
+    sampled[~inside] = outside
+    return sampled
+
+
+def fit_motion(flow, soft_mask):
+    # Affine map (2 x 3) from current frame positions to previous frame positions, fitted to the blocks on the object.
+    # Falls back to the median motion of those blocks (or of all blocks) if there are too few for a fit
+    centers = flow.centers().reshape(-1, 2)
+    vectors = flow.vectors.reshape(-1, 2)
+    sources = centers - vectors
+    on_object = bilinear_sample(soft_mask, sources[:, 0] - 0.5, sources[:, 1] - 0.5) >= 0.5
+    if np.count_nonzero(on_object) == 0:
+        on_object[:] = True
+
+    translation = np.median(vectors[on_object], axis=0)
+    affine = np.array([[1.0, 0.0, -translation[0]], [0.0, 1.0, -translation[1]]])
+    if np.count_nonzero(on_object) < 6:
+        return affine
+
+    # Least squares, refitted once without the blocks that matched something else
+    points = np.hstack([centers, np.ones((len(centers), 1))])
+    for _ in range(2):
+        solution, _, _, _ = np.linalg.lstsq(points[on_object], sources[on_object], rcond=None)
+        residuals = np.linalg.norm(points @ solution - sources, axis=1)
+        cutoff = max(2.5 * np.median(residuals[on_object]), flow.block_size / 8)
+        on_object &= residuals <= cutoff
+        if np.count_nonzero(on_object) < 6:
+            return affine
+    return solution.T
+
+
+def warp_mask(soft_mask, affine, region):
+    # Moves a full frame soft mask (float 0-1) of the previous frame into the region of the current frame
+    height, width = soft_mask.shape
+    warped = np.zeros((height, width), dtype=np.float32)
+    x0, y0, x1, y1 = (int(value) for value in region)
+    x0, y0, x1, y1 = max(x0, 0), max(y0, 0), min(x1, width), min(y1, height)
+    if x1 <= x0 or y1 <= y0:
+        return warped
+    yy, xx = np.mgrid[y0:y1, x0:x1].astype(np.float64)
+    # Pixel centers are at +0.5 in frame coords
+    source_x = affine[0, 0] * (xx + 0.5) + affine[0, 1] * (yy + 0.5) + affine[0, 2] - 0.5
+    source_y = affine[1, 0] * (xx + 0.5) + affine[1, 1] * (yy + 0.5) + affine[1, 2] - 0.5
+    warped[y0:y1, x0:x1] = bilinear_sample(soft_mask, source_x, source_y)
+    return warped
+
+
+def warp_logits(logits, logits_box, affine):
+    # Moves the low res logits of the previous frame, they keep their crop box
+    size = logits.shape[-1]
+    box_x0, box_y0, box_x1, box_y1 = (int(round(value)) for value in logits_box)
+    side = max(box_x1 - box_x0, box_y1 - box_y0, 1)
+    scale = side / size
+
+    centers = (np.arange(size) + 0.5) * scale
+    xx, yy = np.meshgrid(centers + box_x0, centers + box_y0)
+    source_x = affine[0, 0] * xx + affine[0, 1] * yy + affine[0, 2]
+    source_y = affine[1, 0] * xx + affine[1, 1] * yy + affine[1, 2]
+    logits = np.asarray(logits, dtype=np.float32).reshape(size, size)
+    return bilinear_sample(logits, (source_x - box_x0) / scale - 0.5, (source_y - box_y0) / scale - 0.5, LOGITS_BACKGROUND)
+
+
+
+
+class MaskPropagator:
+    """
+    Keeps the last tracked frame and moves its mask and low res logits to the next frame with block flow.
+    PROMPT uses the moved mask as guide, box and mask prompt of the model, PROPAGATE replaces the model with it.
+    """
+
+    def __init__(self, mode='PROMPT'):
+        self.mode = mode
+        self.reset()
+
+    def reset(self):
+        self._pixels = None
+        self._soft_mask = None
+        self._logits = None
+        self._propagated = None
+
+    @property
+    def ready(self):
+        return self.mode != 'NONE' and self._pixels is not None
+
+    def update(self, pixels_uint8, full_mask, low_res_logits):
+        # Frames are never written to after loading, so keeping a reference is enough
+        if self.mode == 'NONE':
+            self.reset()
+            return
+        self._pixels = pixels_uint8
+        self._soft_mask = full_mask.astype(np.float32)
+        self._logits = low_res_logits
+
+    def propagate(self, pixels_uint8, search_box):
+        # Returns (moved full frame mask, moved (logits, crop box) or None), None if the flow can't be estimated
+        if not self.ready or search_box is None or pixels_uint8.shape[:2] != self._pixels.shape[:2]:
+            return None
+        search_box = np.asarray(search_box) + np.array([-FLOW_MARGIN, -FLOW_MARGIN, FLOW_MARGIN, FLOW_MARGIN])
+        flow = estimate_flow(self._pixels, pixels_uint8, search_box, self._soft_mask)
+        if flow is None:
+            return None
+
+        affine = fit_motion(flow, self._soft_mask)
+        soft_mask = warp_mask(self._soft_mask, affine, flow.region())
+        logits = None
+        if self._logits is not None and self._logits[0] is not None:
+            logits = (warp_logits(self._logits[0], self._logits[1], affine), self._logits[1])
+        self._propagated = (soft_mask, logits)
+        return soft_mask >= 0.5, logits
+
+    def accept(self, pixels_uint8):
+        # Makes the last propagated frame the reference of the next one, its soft mask keeps the sub-pixel edge,
+        # which thresholded masks would lose a bit of on every frame
+        self._pixels = pixels_uint8
+        self._soft_mask, self._logits = self._propagated
+        self._propagated = None
@@ -6,47 +6,55 @@ import gpu_extras.batch
 from . import mask_rasterize
 from mathutils import Matrix
 
-vert_out = gpu.types.GPUStageInterfaceInfo("my_interface")
-vert_out.smooth('VEC2', "uvInterp")
-
-shader_info = gpu.types.GPUShaderCreateInfo()
-shader_info.push_constant('MAT4', "ModelViewProjectionMatrix")
-shader_info.push_constant('VEC4', "overlayColor")
-shader_info.sampler(0, 'FLOAT_2D', "image")
-shader_info.vertex_in(0, 'VEC2', "position")
-shader_info.vertex_in(1, 'VEC2', "uv")
-shader_info.vertex_out(vert_out)
-shader_info.fragment_out(0, 'VEC4', "FragColor")
-
-shader_info.vertex_source(
-    "void main()"
-    "{"
-    "  uvInterp = uv;"
-    "  gl_Position = ModelViewProjectionMatrix * vec4(position, 0.0, 1.0);"
-    "}"
-)
-
-shader_info.fragment_source(
-    "void main()"
-    "{"
-    "  vec2 texelSize = 1.0 / (textureSize(image, 0));"
-    "  vec2 nearestUV = floor(uvInterp / texelSize) * texelSize + texelSize * 0.5;"
-    "  vec4 texColor = texture(image, nearestUV);"
-    "  FragColor = texColor * vec4(overlayColor.rgb, overlayColor.a * (1.0 - texColor));"
-    "}"
-)
-
-shader = gpu.shader.create_from_info(shader_info)
-del vert_out
-del shader_info
-
-batch = gpu_extras.batch.batch_for_shader(
-    shader, 'TRI_FAN',
-    {
-        "position": ((0, 0), (1, 0), (1, 1), (0, 1)),
-        "uv": ((0, 0), (1, 0), (1, 1), (0, 1)),
-    },
-)
+# The shader is compiled on the first draw instead of on import, that keeps it out of the addon startup
+shader = None
+batch = None
+
+def get_shader():
+    global shader, batch
+    if shader is not None:
+        return shader, batch
+    
+    vert_out = gpu.types.GPUStageInterfaceInfo("my_interface")
+    vert_out.smooth('VEC2', "uvInterp")
+
+    shader_info = gpu.types.GPUShaderCreateInfo()
+    shader_info.push_constant('MAT4', "ModelViewProjectionMatrix")
+    shader_info.push_constant('VEC4', "overlayColor")
+    shader_info.sampler(0, 'FLOAT_2D', "image")
+    shader_info.vertex_in(0, 'VEC2', "position")
+    shader_info.vertex_in(1, 'VEC2', "uv")
+    shader_info.vertex_out(vert_out)
+    shader_info.fragment_out(0, 'VEC4', "FragColor")
+
+    shader_info.vertex_source(
+        "void main()"
+        "{"
+        "  uvInterp = uv;"
+        "  gl_Position = ModelViewProjectionMatrix * vec4(position, 0.0, 1.0);"
+        "}"
+    )
+
+    shader_info.fragment_source(
+        "void main()"
+        "{"
+        "  vec2 texelSize = 1.0 / (textureSize(image, 0));"
+        "  vec2 nearestUV = floor(uvInterp / texelSize) * texelSize + texelSize * 0.5;"
+        "  vec4 texColor = texture(image, nearestUV);"
+        "  FragColor = texColor * vec4(overlayColor.rgb, overlayColor.a * (1.0 - texColor));"
+        "}"
+    )
+
+    shader = gpu.shader.create_from_info(shader_info)
+
+    batch = gpu_extras.batch.batch_for_shader(
+        shader, 'TRI_FAN',
+        {
+            "position": ((0, 0), (1, 0), (1, 1), (0, 1)),
+            "uv": ((0, 0), (1, 0), (1, 1), (0, 1)),
+        },
+    )
+    return shader, batch
 
 def rotoforge_overlay_shader():
     context = bpy.context
@@ -124,6 +132,7 @@ def rotoforge_overlay_shader():
     
     gpu.matrix.load_matrix(Matrix(transform))
     
+    shader, batch = get_shader()
     shader.uniform_float("overlayColor", color)
     shader.uniform_sampler("image", texture)
     batch.draw(shader)
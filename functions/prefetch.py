@@ -0,0 +1,43 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from .embedding_cache import embedding_cache, get_embedding
+from .core_scheduler import claim_current_thread
+
+
+# Runs the image encoder for an upcoming frame in a worker thread.
+# The result lands in the embedding cache, so predict_mask picks it up like any other cache hit.
+# If the crop of the upcoming frame turns out to be different, its key won't match and
+# predict_mask simply encodes the frame itself.
+
+class EncoderPrefetcher:
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='RotoForgePrefetch', initializer=claim_current_thread)
+        self._pending = {} # embedding key -> future
+
+    def submit(self, predictor, pixels_uint8_rgb, key):
+        if key in embedding_cache or key in self._pending:
+            return
+        self._pending[key] = self._executor.submit(get_embedding, predictor, pixels_uint8_rgb, key)
+
+    def wait(self, key):
+        # Blocks until the prefetch for this key is done, drops all other (mispredicted) ones
+        future = self._pending.pop(key, None)
+        self.discard()
+        if future is None:
+            return False
+        try:
+            future.result()
+        except Exception as e:
+            # The caller falls back to a normal encode
+            print('Prefetching failed:', e)
+            return False
+        return True
+
+    def discard(self):
+        for future in self._pending.values():
+            future.cancel()
+        self._pending.clear()
+
+    def shutdown(self):
+        self.discard()
+        self._executor.shutdown(wait=False)
@@ -26,9 +26,48 @@ def fake_logits(img):
 
 
 
-def extract_prompt_points(mask, resolution):
+LOGITS_BACKGROUND = -20.0 # Logit for the parts of a new crop the previous logits don't cover
 
-    layer = mask.layers.active
+def _resample_taps(positions, size):
+    # Linear interpolation taps for sampling a row of size values at the given positions
+    inside = (positions >= -0.5) & (positions <= size - 0.5)
+    positions = np.clip(positions, 0, size - 1)
+    low = np.floor(positions).astype(np.int64)
+    high = np.minimum(low + 1, size - 1)
+    weight = (positions - low).astype(np.float32)
+    return low, high, weight, inside
+
+
+def carry_logits(logits, from_box, to_box):
+    # Re-aligns the low res logits of the decoder from one crop box to another (x0, y0, x1, y1 in frame coords).
+    # The logits cover the square of the long side of the crop from its top left corner, same as fake_logits.
+    # The move and scale between the crops is separable, so it's a linear resample of the rows and then the columns
+    size = logits.shape[-1]
+    from_x0, from_y0, from_x1, from_y1 = (int(round(value)) for value in from_box)
+    to_x0, to_y0, to_x1, to_y1 = (int(round(value)) for value in to_box)
+    from_side = max(from_x1 - from_x0, from_y1 - from_y0, 1)
+    to_side = max(to_x1 - to_x0, to_y1 - to_y0, 1)
+
+    # Pixel centers of the new logits in the pixel coords of the old ones
+    centers = (np.arange(size) + 0.5) * to_side / size
+    low, high, weight, rows_inside = _resample_taps((centers + to_y0 - from_y0) * size / from_side - 0.5, size)
+    logits = np.asarray(logits, dtype=np.float32).reshape(size, size)
+    carried = logits[low] * (1 - weight)[:, None] + logits[high] * weight[:, None]
+    low, high, weight, columns_inside = _resample_taps((centers + to_x0 - from_x0) * size / from_side - 0.5, size)
+    carried = carried[:, low] * (1 - weight) + carried[:, high] * weight
+
+    carried[~rows_inside, :] = LOGITS_BACKGROUND
+    carried[:, ~columns_inside] = LOGITS_BACKGROUND
+    return carried
+
+
+
+
+
+def extract_prompt_points(mask, resolution, layer=None):
+
+    if layer is None:
+        layer = mask.layers.active
     width, height = resolution
 
     scalar = max(width, height)
@@ -0,0 +1,74 @@
+import os
+import warnings
+
+
+# Dynamic INT8 quantization of the SAM-HQ image encoder for CPU inference, bpy-free.
+# Quantized models are selected with a model type like vit_b_int8, they use the checkpoint of vit_b
+# and keep the quantized weights next to it (sam_hq_vit_b_int8.pth), so quantization only runs once.
+
+QUANTIZED_SUFFIX = '_int8'
+
+
+
+
+def split_model_type(model_type):
+    # 'vit_b_int8' -> ('vit_b', True)
+    if model_type.endswith(QUANTIZED_SUFFIX):
+        return model_type[:-len(QUANTIZED_SUFFIX)], True
+    return model_type, False
+
+
+def get_quantized_path(sam_checkpoint):
+    return os.path.splitext(sam_checkpoint)[0] + QUANTIZED_SUFFIX + '.pth'
+
+
+def quantize_encoder(sam):
+    # Only the Linear layers (attention and MLP of the ViT blocks) carry the encoder cost, the convs stay fp32
+    import torch
+    sam.image_encoder = torch.ao.quantization.quantize_dynamic(sam.image_encoder, {torch.nn.Linear}, dtype=torch.qint8)
+    return sam
+
+
+def load_quantized_sam(model_type, sam_checkpoint):
+    # Builds the Sam model of model_type (without suffix) with a quantized image encoder, always on the CPU
+    import torch
+    import segment_anything
+
+    quantized_path = get_quantized_path(sam_checkpoint)
+    cached = os.path.isfile(quantized_path)
+    if cached and os.path.isfile(sam_checkpoint):
+        cached = os.path.getmtime(quantized_path) >= os.path.getmtime(sam_checkpoint)
+
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", category=UserWarning)
+        if cached:
+            # Build the quantized structure with random weights and fill in the cached ones
+            sam = quantize_encoder(segment_anything.sam_model_registry[model_type](checkpoint=None).eval())
+            # Our own file, the packed int8 weights can't be loaded with weights_only
+            sam.load_state_dict(torch.load(quantized_path, map_location='cpu', weights_only=False))
+            return sam
+
+        print(f'Quantizing {model_type} to INT8, this only happens once per model')
+        sam = quantize_encoder(segment_anything.sam_model_registry[model_type](checkpoint=sam_checkpoint).eval())
+
+    # Write to a temp file first so an interrupted save doesn't leave a broken cache behind
+    tmp_path = quantized_path + '.tmp'
+    torch.save(sam.state_dict(), tmp_path)
+    os.replace(tmp_path, quantized_path)
+    return sam
+
+
+def quantize_onnx_encoder(encoder_path, external_data=False):
+    # Same quantization for the ONNX backend, replaces the exported fp32 encoder.
+    # It's written into a temporary folder under the same name, so external weights (<name>.data) match their graph
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    model_dir, file_name = os.path.split(encoder_path)
+    tmp_dir = encoder_path + '.tmp'
+    os.makedirs(tmp_dir, exist_ok=True)
+    quantize_dynamic(encoder_path, os.path.join(tmp_dir, file_name), op_types_to_quantize=['MatMul', 'Gemm'],
+                     weight_type=QuantType.QInt8, use_external_data_format=external_data)
+    # The graph goes last, until then the old one still points at complete weights
+    for tmp_file in sorted(os.listdir(tmp_dir), key=lambda name: name == file_name):
+        os.replace(os.path.join(tmp_dir, tmp_file), os.path.join(model_dir, tmp_file))
+    os.rmdir(tmp_dir)
@@ -1,4 +1,6 @@
 import bpy
+import os
+import sys
 
 from time import process_time
 
@@ -8,9 +10,22 @@ from . import prompt_utils
 from . import overlay
 from . import mask_rasterize
 from . import data_manager
+from . import dependency_manager
+from .embedding_cache import embedding_cache, set_embedding_store
+from . import embedding_cache as embedding_cache_module
+from .embedding_store import EmbeddingStore
+from .prefetch import EncoderPrefetcher
+from .frame_cache import frame_cache
+from .frame_gating import FrameGate
+from .motion_model import BoxKalmanFilter
+from .optical_flow import MaskPropagator
+from .keyframes import KeyframeScheduler
+from .model_registry import PredictorRegistry
+from .cpu_profile import set_num_threads
+from .core_scheduler import schedule_cores, core_scheduler
 
-predictor = None
-used_model = None
+# All loaded predictors, least recently used ones get unloaded once the memory budget is exceeded
+predictor_registry = PredictorRegistry(lambda model_type: generate_masks.get_predictor(model_type=model_type))
 
 
 
@@ -26,13 +41,108 @@ def time_checkpoint(start, name):
     print(f"{name} finished in {minutes} min {seconds} sec")
 
 
-def free_predictor():
-    global predictor
-    predictor = None
-    from torch import cuda
-    if cuda.is_available:
-        cuda.empty_cache()
-    del cuda
+def apply_cache_settings(context):
+    # Returns the thread count of the models, so the cores only get scheduled once per Generate/Track
+    prefs = dependency_manager.get_addon_prefs(context)
+    predictor_registry.set_max_bytes(prefs.model_cache_size * 1024**2)
+    embedding_cache.set_max_bytes(prefs.embedding_cache_size * 1024**2)
+    frame_cache.set_max_bytes(prefs.frame_cache_size * 1024**2)
+    # Before torch is loaded the thread counts are applied by the loader
+    num_threads = get_num_threads(prefs)
+    if 'torch' in sys.modules:
+        set_num_threads(num_threads, prefs.cpu_interop_threads)
+    
+    # The store lives next to the masksequences, so it gets saved and loaded with the project
+    store_dir = data_manager.get_rotoforge_dir('embeddings')
+    store = embedding_cache_module.embedding_store
+    if prefs.embedding_store_size <= 0:
+        set_embedding_store(None)
+    elif store is None or store.root != store_dir:
+        set_embedding_store(EmbeddingStore(store_dir, prefs.embedding_store_size * 1024**2))
+    else:
+        store.set_max_bytes(prefs.embedding_store_size * 1024**2)
+    return num_threads
+
+
+def get_num_threads(prefs):
+    # With core scheduling CPU Threads is the budget of this instance, 0 shares the cores evenly with the other instances
+    return schedule_cores(prefs.core_scheduling, prefs.cpu_threads)
+
+
+def get_model_key(context, model_type):
+    # Key in the registry and the embedding caches, the backends don't share models or embeddings
+    prefs = dependency_manager.get_addon_prefs(context)
+    if prefs.inference_backend == 'onnx':
+        return f'{model_type}_onnx'
+    return model_type
+
+
+def get_model_loader(context, model_type, num_threads):
+    # Resolves everything that needs bpy on the main thread, the returned loader may run in a worker thread
+    prefs = dependency_manager.get_addon_prefs(context)
+    sam_checkpoint = generate_masks.get_checkpoint_path(model_type)
+    backend = prefs.inference_backend
+    onnx_dir = generate_masks.get_onnx_dir()
+    num_interop_threads = prefs.cpu_interop_threads
+
+    def loader(model_key):
+        return generate_masks.get_predictor(model_type, sam_checkpoint, backend=backend, onnx_dir=onnx_dir,
+                                            num_threads=num_threads, num_interop_threads=num_interop_threads)
+    return loader
+
+
+def get_predictor(context, model_type):
+    # Wake AI if not present
+    num_threads = apply_cache_settings(context)
+    model_key = get_model_key(context, model_type)
+    if not predictor_registry.is_loaded(model_key):
+        # Start the timer
+        fetching = process_time()
+        predictor = predictor_registry.get(model_key, loader=get_model_loader(context, model_type, num_threads))
+        time_checkpoint(fetching, 'Predictor fetching')
+        return predictor
+    return predictor_registry.get(model_key)
+
+
+def get_coarse_predictor(context, maskgencontrols):
+    # The small model for the coarse pass, None if it's off, the layer already uses it or it isn't downloaded
+    if not maskgencontrols.coarse_pass or maskgencontrols.used_model == generate_masks.COARSE_MODEL:
+        return None
+    if not os.path.exists(generate_masks.get_checkpoint_path(generate_masks.COARSE_MODEL)):
+        print(f'Coarse pass skipped, {generate_masks.COARSE_MODEL} is not downloaded')
+        return None
+    return get_predictor(context, generate_masks.COARSE_MODEL)
+
+
+def redraw_while_loading():
+    # Keeps the panels showing the load state until all background loads are done
+    for window in bpy.context.window_manager.windows:
+        for area in window.screen.areas:
+            if area.type == 'IMAGE_EDITOR':
+                area.tag_redraw()
+    if predictor_registry.is_loading():
+        return 0.5
+    return None
+
+
+def warm_up_predictor(context, model_type):
+    # Starts loading the model in the background, so the first Generate/Track click doesn't block the UI
+    sam_checkpoint = generate_masks.get_checkpoint_path(model_type)
+    if not os.path.isfile(sam_checkpoint):
+        return
+    num_threads = apply_cache_settings(context)
+    if predictor_registry.warm_up(get_model_key(context, model_type), loader=get_model_loader(context, model_type, num_threads)):
+        if not bpy.app.timers.is_registered(redraw_while_loading):
+            bpy.app.timers.register(redraw_while_loading, first_interval=0.5)
+
+
+def free_predictor(model_type=None):
+    # Frees one loaded model (by its registry key) or all of them
+    if model_type is None:
+        embedding_cache.clear()
+    else:
+        embedding_cache.remove_model(model_type)
+    predictor_registry.free(model_type)
 
 
 
@@ -59,16 +169,8 @@ class GenerateSingularMaskOperator(bpy.types.Operator):
         maskgencontrols = mask.rotoforge_maskgencontrols.get(layer.name)
         
         #Wake AI if not present
-        global predictor
-        global used_model
-        
-        
-        if predictor == None or used_model != maskgencontrols.used_model:
-            # Start the timer
-            fetching = process_time()
-            used_model = maskgencontrols.used_model
-            predictor = generate_masks.get_predictor(model_type=used_model)
-            time_checkpoint(fetching, 'Predictor fetching')
+        predictor = get_predictor(context, maskgencontrols.used_model)
+        coarse_predictor = get_coarse_predictor(context, maskgencontrols)
         
         # Start the timer
         start = process_time()
@@ -93,7 +195,10 @@ class GenerateSingularMaskOperator(bpy.types.Operator):
                                      input_points = prompt_points,
                                      input_labels = prompt_labels,
                                      input_box = bounding_box,
-                                     debug_logits = False)
+                                     debug_logits = False,
+                                     selection = maskgencontrols.mask_selection,
+                                     tiled = maskgencontrols.tiled_inference,
+                                     coarse_predictor = coarse_predictor)
         data_manager.update_maskseq(used_mask)
         
         self.report({'INFO'}, f'Saved mask layer as image: {used_mask}')
@@ -120,6 +225,18 @@ class TrackMaskOperator(bpy.types.Operator):
     _next_processed_frame = None
     _used_mask_dir = None
     _running = False
+    _prefetcher = None
+    _prefetched = None # (frame, pixels) of the already loaded next frame
+    _layer_states = None # Tracking state of every layer in all_layers mode
+    _batch = None # (frames, cropping_box, pixels per frame) of the currently encoded batch
+    _previous_mask = None # Full frame mask of the last tracked frame
+    _previous_logits = None # (low res logits, crop box) of the last tracked frame
+    _gate = None # Skips the model on unchanged frames of the active layer
+    _box_predictor = None # Motion model of the active layer
+    _propagator = None # Optical flow of the active layer
+    _keyframes = None # Picks the frames the model runs on for the active layer
+    _predictor = None
+    _coarse_predictor = None # Small model that localizes the object on the downscaled frame
     
     #Prompt data for the machine god
     guide_mask = None
@@ -133,6 +250,12 @@ class TrackMaskOperator(bpy.types.Operator):
         default=False
     ) # type: ignore
     
+    all_layers: bpy.props.BoolProperty(
+        name="All RotoForge Layers",
+        description="Tracks all RotoForge layers of the mask at once, sharing one encoder pass per frame",
+        default=False
+    ) # type: ignore
+    
     
     @classmethod
     def poll(self, context):
@@ -140,6 +263,8 @@ class TrackMaskOperator(bpy.types.Operator):
             return False
         if context.space_data.image.source not in ['SEQUENCE', 'MOVIE']:
             return False
+        if context.space_data.mask is not None and data_manager.is_tracking(context.space_data.mask):
+            return False
         return True
     
     def modal(self, context, event):
@@ -147,62 +272,44 @@ class TrackMaskOperator(bpy.types.Operator):
             
             space = context.space_data
             mask = space.mask
-            layer = mask.layers.active
-            image = space.image
-            maskgencontrols = mask.rotoforge_maskgencontrols.get(layer.name)
             
             # Apply frame
             context.scene.frame_current = self._next_processed_frame 
             space.image_user.frame_current = self._next_processed_frame
             
-            # Force-update the viewport for internal use
-            space.display_channels = space.display_channels
+            # Reuse the pixels if this frame got loaded by the prefetch stage, otherwise try to decode it from disk
+            pixels_uint8_rgba = None
+            if self._prefetched is not None and self._prefetched[0] == self._next_processed_frame:
+                pixels_uint8_rgba = self._prefetched[1]
+            self._prefetched = None
+            if pixels_uint8_rgba is None:
+                pixels_uint8_rgba = generate_masks.read_sequence_frame(space.image, space.image_user, self._next_processed_frame)
+            
+            # Force-update the viewport for internal use, so blender loads the frame
+            if pixels_uint8_rgba is None:
+                space.display_channels = space.display_channels
 
 
             print('----Info----')
             print('Frame: ', str(self._next_processed_frame))
-
-
-            #Wake AI if not present
-            global predictor
-            global used_model
-
-            if not maskgencontrols.tracking and self.prompt_points is None: # Run if tracking is disabled and it's not the 1st frame
-                #Get Prompt data to feed the machine god
-                resolution = tuple(image.size)
-                self.guide_mask = mask_rasterize.rasterize_layer_of_active_mask(layer, resolution)
-                self.prompt_points, self.prompt_labels = prompt_utils.extract_prompt_points(mask, resolution)
-                self.bounding_box = prompt_utils.calculate_bounding_box(self.guide_mask)
-
-            
-            guide_strength = maskgencontrols.guide_strength
-            search_radius = maskgencontrols.search_radius
-            blur_radius = maskgencontrols.feather_radius
-
-            used_mask = self._used_mask_dir
-
-            self.guide_mask, self.bounding_box, overlay_l, _ = generate_masks.track_mask(source_image = image, 
-                                                                                         used_mask = used_mask, 
-                                                                                         predictor = predictor, 
-                                                                                         guide_mask = self.guide_mask, 
-                                                                                         guide_strength = guide_strength, 
-                                                                                         blur_radius=blur_radius,
-                                                                                         search_radius = search_radius,
-                                                                                         input_points = self.prompt_points,
-                                                                                         input_labels = self.prompt_labels,
-                                                                                         input_box = self.bounding_box,
-                                                                                         input_logits = None)
-            
-            overlay.rotoforge_overlay_shader.custom_img = overlay_l
-
-            self.prompt_points = None
-            self.prompt_labels = None
             
             if not self.backwards:
                 endframe = mask.frame_end
             else:
                 endframe = mask.frame_start
             
+            if self.all_layers:
+                self.track_all_layers(context, pixels_uint8_rgba)
+            else:
+                self.track_active_layer(context, pixels_uint8_rgba, endframe)
+            
+            # Keyframes pick the next frame themselves, the frames in between are already saved
+            if not self.all_layers and self._keyframes.enabled:
+                if not self.next_keyframe(context, endframe):
+                    self.cancel(context)
+                    return {'CANCELLED'}
+                return {'PASS_THROUGH'}
+            
             if self._next_processed_frame  == endframe:
                 self.cancel(context)
                 return{'CANCELLED'}
@@ -219,6 +326,227 @@ class TrackMaskOperator(bpy.types.Operator):
             return {'CANCELLED'}
         
         return {'PASS_THROUGH'}
+    
+    def track_active_layer(self, context, pixels_uint8_rgba, endframe):
+        space = context.space_data
+        mask = space.mask
+        layer = mask.layers.active
+        image = space.image
+        maskgencontrols = mask.rotoforge_maskgencontrols.get(layer.name)
+
+        if not maskgencontrols.tracking and self.prompt_points is None: # Run if tracking is disabled and it's not the 1st frame
+            #Get Prompt data to feed the machine god
+            resolution = tuple(image.size)
+            self.guide_mask = mask_rasterize.rasterize_layer_of_active_mask(layer, resolution)
+            self.prompt_points, self.prompt_labels = prompt_utils.extract_prompt_points(mask, resolution)
+            self.bounding_box = prompt_utils.calculate_bounding_box(self.guide_mask)
+            # The user redrew the mask, don't carry the logits of the last frame over. Its mask stays
+            # the previous mask, PREVIOUS_IOU then compares against it instead of the redrawn guide
+            self._previous_logits = None
+            self._gate.reset()
+            self._box_predictor.reset()
+            self._propagator.reset()
+            self._keyframes.reset()
+
+        
+        guide_strength = maskgencontrols.guide_strength
+        search_radius = maskgencontrols.search_radius
+        blur_radius = maskgencontrols.feather_radius
+        self.configure_gate(self._gate, maskgencontrols)
+        box_predictor = self.get_box_predictor(self._box_predictor, maskgencontrols)
+        self._propagator.mode = maskgencontrols.flow_mode
+        keyframes = self.configure_keyframes(self._keyframes, maskgencontrols)
+        gate, propagator = self._gate, self._propagator
+        if keyframes is not None:
+            # Gate, motion model, flow, batches and prefetching all expect the next frame to be tracked next
+            gate, box_predictor, propagator = None, None, None
+            if keyframes.last is None:
+                keyframes.start()
+
+        used_mask = self._used_mask_dir
+        
+        # Range mode: encode the next frames in one batch
+        cropping_box = None
+        single = keyframes is not None or maskgencontrols.tiled_inference or self._coarse_predictor is not None
+        batch_size = maskgencontrols.encoder_batch_size if not single else 1
+        if batch_size > 1 and self.bounding_box is not None:
+            cropping_box, pixels_uint8_rgba = self.encode_batch(context, pixels_uint8_rgba, endframe, batch_size, search_radius)
+        
+        prefetch_next = None
+        if maskgencontrols.prefetch and batch_size == 1 and not single and self._next_processed_frame != endframe:
+            next_frame = self._next_processed_frame + (-1 if self.backwards else 1)
+            def prefetch_next(best_mask, next_input_box):
+                self.prefetch_frame(context, next_frame, best_mask, next_input_box)
+
+        self.guide_mask, self.bounding_box, overlay_l, self._previous_logits = generate_masks.track_mask(source_image = image, 
+                                                                                     used_mask = used_mask, 
+                                                                                     predictor = self._predictor, 
+                                                                                     guide_mask = self.guide_mask, 
+                                                                                     guide_strength = guide_strength, 
+                                                                                     blur_radius=blur_radius,
+                                                                                     search_radius = search_radius,
+                                                                                     input_points = self.prompt_points,
+                                                                                     input_labels = self.prompt_labels,
+                                                                                     input_box = self.bounding_box,
+                                                                                     input_logits = None,
+                                                                                     pixels_uint8_rgba = pixels_uint8_rgba,
+                                                                                     prefetcher = self._prefetcher,
+                                                                                     prefetch_next = prefetch_next,
+                                                                                     cropping_box = cropping_box,
+                                                                                     selection = maskgencontrols.mask_selection,
+                                                                                     previous_mask = self._previous_mask,
+                                                                                     mask_prompt = maskgencontrols.mask_prompt,
+                                                                                     previous_logits = self._previous_logits,
+                                                                                     gate = gate,
+                                                                                     box_predictor = box_predictor,
+                                                                                     propagator = propagator,
+                                                                                     tiled = maskgencontrols.tiled_inference,
+                                                                                     coarse_predictor = self._coarse_predictor)
+        self._previous_mask = self.guide_mask
+        
+        # Fill in the frames between this keyframe and its neighbors
+        if keyframes is not None:
+            for frame, best_mask, cropping_box in keyframes.add(self._next_processed_frame, self.guide_mask, self._previous_logits):
+                data_manager.save_sequential_mask(image, used_mask, best_mask, cropping_box, blur_radius, frame)
+        
+        overlay.rotoforge_overlay_shader.custom_img = overlay_l
+
+        self.prompt_points = None
+        self.prompt_labels = None
+    
+    def encode_batch(self, context, pixels_uint8_rgba, endframe, batch_size, search_radius):
+        frame = self._next_processed_frame
+        
+        # Keep using the current batch as long as the object stays inside its crop
+        if self._batch is not None and frame in self._batch[0] and generate_masks.box_inside(self.bounding_box, self._batch[1]):
+            return self._batch[1], self._batch[2].pop(frame, pixels_uint8_rgba)
+        
+        space = context.space_data
+        image = space.image
+        step = -1 if self.backwards else 1
+        frames = [frame + i * step for i in range(batch_size) if (frame + i * step - endframe) * step <= 0]
+        width, height = image.size
+        cropping_box = generate_masks.get_batch_cropping_box(width, height, self.bounding_box, search_radius, len(frames))
+        
+        # Loading frames has to happen on the main thread, only the encoder is batched
+        pixels_per_frame = {}
+        for batch_frame in frames:
+            if batch_frame == frame and pixels_uint8_rgba is not None:
+                pixels_per_frame[batch_frame] = pixels_uint8_rgba
+                continue
+            pixels_per_frame[batch_frame] = self.load_frame(context, batch_frame)
+        
+        # Go back to the frame that is tracked right now
+        if context.scene.frame_current != frame:
+            context.scene.frame_current = frame
+            space.image_user.frame_current = frame
+            space.display_channels = space.display_channels
+        
+        generate_masks.encode_frame_batch(source_image = image,
+                                          frames = frames,
+                                          pixels_uint8_rgba_list = [pixels_per_frame[batch_frame] for batch_frame in frames],
+                                          cropping_box = cropping_box,
+                                          predictor = self._predictor)
+        
+        self._batch = (set(frames), cropping_box, pixels_per_frame)
+        return cropping_box, pixels_per_frame.pop(frame)
+    
+    def track_all_layers(self, context, pixels_uint8_rgba):
+        space = context.space_data
+        mask = space.mask
+        image = space.image
+        resolution = tuple(image.size)
+        
+        for layer_state in self._layer_states:
+            layer = mask.layers.get(layer_state['name'])
+            maskgencontrols = mask.rotoforge_maskgencontrols.get(layer_state['name'])
+            
+            if not maskgencontrols.tracking and layer_state['input_points'] is None: # Run if tracking is disabled and it's not the 1st frame
+                layer_state['guide_mask'] = mask_rasterize.rasterize_layer_of_active_mask(layer, resolution)
+                layer_state['input_points'], layer_state['input_labels'] = prompt_utils.extract_prompt_points(mask, resolution, layer)
+                layer_state['input_box'] = prompt_utils.calculate_bounding_box(layer_state['guide_mask'])
+                layer_state['logits'] = None
+                layer_state['gate'].reset()
+                layer_state['motion_model'].reset()
+            
+            layer_state['guide_strength'] = maskgencontrols.guide_strength
+            layer_state['search_radius'] = maskgencontrols.search_radius
+            layer_state['blur_radius'] = maskgencontrols.feather_radius
+            layer_state['selection'] = maskgencontrols.mask_selection
+            layer_state['mask_prompt'] = maskgencontrols.mask_prompt
+            self.configure_gate(layer_state['gate'], maskgencontrols)
+            layer_state['box_predictor'] = self.get_box_predictor(layer_state['motion_model'], maskgencontrols)
+        
+        overlays = generate_masks.track_masks_shared(source_image = image,
+                                                     layers = self._layer_states,
+                                                     predictor = self._predictor,
+                                                     pixels_uint8_rgba = pixels_uint8_rgba)
+        
+        # Show the active layer if it's tracked, otherwise the first one
+        overlay_l = overlays[0]
+        for layer_state, layer_overlay in zip(self._layer_states, overlays):
+            if layer_state['name'] == mask.layers.active.name:
+                overlay_l = layer_overlay
+        overlay.rotoforge_overlay_shader.custom_img = overlay_l
+    
+    def load_frame(self, context, frame):
+        # Decodes a frame of the sequence from disk, or switches blender to it and loads it on the main thread
+        # (bpy isn't thread safe) if the image can't be read directly
+        space = context.space_data
+        pixels_uint8_rgba = generate_masks.read_sequence_frame(space.image, space.image_user, frame)
+        if pixels_uint8_rgba is not None:
+            return pixels_uint8_rgba
+        
+        context.scene.frame_current = frame
+        space.image_user.frame_current = frame
+        space.display_channels = space.display_channels
+        return generate_masks.bpyimg_to_HWCuint8(space.image)
+    
+    def prefetch_frame(self, context, frame, best_mask, next_input_box):
+        # Loads the next frame and encodes it in the background, while the current mask is still being saved
+        space = context.space_data
+        pixels_uint8_rgba = self.load_frame(context, frame)
+        self._prefetched = (frame, pixels_uint8_rgba)
+        generate_masks.prefetch_frame(source_image = space.image,
+                                      frame = frame,
+                                      pixels_uint8_rgba = pixels_uint8_rgba,
+                                      guide_mask = best_mask,
+                                      input_box = next_input_box,
+                                      predictor = self._predictor,
+                                      prefetcher = self._prefetcher,
+                                      gate = self._gate)
+    
+    def configure_gate(self, gate, maskgencontrols):
+        # Follows changes of the layer settings while tracking
+        gate.threshold = maskgencontrols.skip_threshold
+        gate.max_skip = maskgencontrols.skip_max_frames
+        gate.shift = maskgencontrols.skip_follow_motion
+    
+    def configure_keyframes(self, keyframes, maskgencontrols):
+        # Returns the scheduler if keyframes are on for the layer, settings changes apply from the next keyframe on
+        keyframes.mode = maskgencontrols.keyframe_mode
+        keyframes.interval = maskgencontrols.keyframe_interval
+        keyframes.motion_threshold = maskgencontrols.keyframe_motion
+        return keyframes if keyframes.enabled else None
+    
+    def next_keyframe(self, context, endframe):
+        # Moves on to the next frame the model runs on and prompts it from the keyframes, False when done or lost
+        mask = context.space_data.mask
+        maskgencontrols = mask.rotoforge_maskgencontrols.get(mask.layers.active.name)
+        frame = self._keyframes.next_frame(endframe, -1 if self.backwards else 1)
+        if frame is None:
+            return False
+        self.guide_mask, self.bounding_box, self._previous_logits = self._keyframes.prompt(frame, maskgencontrols.search_radius)
+        self._previous_mask = self.guide_mask
+        self._next_processed_frame = frame
+        return True
+    
+    def get_box_predictor(self, box_predictor, maskgencontrols):
+        # The motion model only gets used with its box prediction, it starts over when that gets switched on again
+        if maskgencontrols.box_prediction == 'KALMAN':
+            return box_predictor
+        box_predictor.reset()
+        return None
 
     def execute(self, context):
         if not self._running:
@@ -229,12 +557,8 @@ class TrackMaskOperator(bpy.types.Operator):
             maskgencontrols = mask.rotoforge_maskgencontrols.get(layer.name)
 
             #Wake AI if not present
-            global predictor
-            global used_model
-
-            if predictor == None or used_model != maskgencontrols.used_model:
-                used_model = maskgencontrols.used_model
-                predictor = generate_masks.get_predictor(model_type=used_model)
+            self._predictor = get_predictor(context, maskgencontrols.used_model)
+            self._coarse_predictor = get_coarse_predictor(context, maskgencontrols)
 
             #Get Prompt data to feed the machine god
             resolution = tuple(image.size)
@@ -247,8 +571,41 @@ class TrackMaskOperator(bpy.types.Operator):
             used_mask = f"{mask.name}/MaskLayers/{layer.name}"
             self._used_mask_dir = used_mask
             
+            # Collect the prompt data of all RotoForge layers, they share the model of the active layer
+            self._layer_states = None
+            if self.all_layers:
+                self._layer_states = []
+                for rf_layer in mask.layers:
+                    rf_controls = mask.rotoforge_maskgencontrols.get(rf_layer.name)
+                    if rf_controls is None or not rf_controls.is_rflayer or rf_layer.hide:
+                        continue
+                    guide_mask = mask_rasterize.rasterize_layer_of_active_mask(rf_layer, resolution)
+                    prompt_points, prompt_labels = prompt_utils.extract_prompt_points(mask, resolution, rf_layer)
+                    self._layer_states.append({
+                        'name': rf_layer.name,
+                        'used_mask': f"{mask.name}/MaskLayers/{rf_layer.name}",
+                        'guide_mask': guide_mask,
+                        'input_points': prompt_points,
+                        'input_labels': prompt_labels,
+                        'input_box': prompt_utils.calculate_bounding_box(guide_mask),
+                        'gate': FrameGate(),
+                        'motion_model': BoxKalmanFilter(),
+                    })
+                if self._layer_states == []:
+                    self.report({'WARNING'}, 'No visible RotoForge layers to track')
+                    return {'CANCELLED'}
+            
             
             self._next_processed_frame = context.scene.frame_current # Set last processed frame
+            self._prefetcher = EncoderPrefetcher()
+            self._prefetched = None
+            self._batch = None
+            self._previous_mask = None
+            self._previous_logits = None
+            self._gate = FrameGate()
+            self._box_predictor = BoxKalmanFilter()
+            self._propagator = MaskPropagator()
+            self._keyframes = KeyframeScheduler()
             self._running = True
             context.window_manager.modal_handler_add(self)
             self._timer = context.window_manager.event_timer_add(0.1, window=context.window)
@@ -261,11 +618,25 @@ class TrackMaskOperator(bpy.types.Operator):
         context.window_manager.event_timer_remove(self._timer)
         self._running = False
         
+        if self._prefetcher is not None:
+            self._prefetcher.shutdown()
+            self._prefetcher = None
+        self._prefetched = None
+        self._batch = None
+        self._previous_mask = None
+        self._previous_logits = None
+        self._predictor = None
+        self._coarse_predictor = None
+        
         overlay.rotoforge_overlay_shader.custom_img = None
         data_manager.update_maskseq(self._used_mask_dir)
         overlaycontrols = context.scene.rotoforge_overlaycontrols
         overlaycontrols.used_mask = self._used_mask_dir
         
+        if self._layer_states is not None:
+            for layer_state in self._layer_states:
+                data_manager.update_maskseq(layer_state['used_mask'])
+        
         
         # Stop on the last done frame
         context.scene.frame_current = self._next_processed_frame
@@ -275,11 +646,142 @@ class TrackMaskOperator(bpy.types.Operator):
         self.prompt_points, self.prompt_labels = None, None
         self.bounding_box = None
         
-        self.report({'INFO'}, f'Saved mask layer as image sequence: {self._used_mask_dir}')
+        # Skipped frame ratio of the frame gates
+        gates = [self._gate] if self._layer_states is None else [layer_state['gate'] for layer_state in self._layer_states]
+        skipped = sum(gate.skipped for gate in gates)
+        frames = sum(gate.frames for gate in gates)
+        gate_info = ''
+        if skipped > 0:
+            gate_info = f', skipped the model on {skipped}/{frames} frames'
+            print(f'Skipped the model on {skipped}/{frames} frames')
+        self._gate = None
+        self._box_predictor = None
+        self._propagator = None
+        if self._keyframes is not None and self._keyframes.model_frames > 0 and self._keyframes.filled_frames > 0:
+            print(self._keyframes.summary())
+            gate_info += f', {self._keyframes.summary().lower()}'
+        self._keyframes = None
+        
+        if self._layer_states is not None:
+            self.report({'INFO'}, f'Saved {len(self._layer_states)} mask layers as image sequences{gate_info}')
+            self._layer_states = None
+        else:
+            self.report({'INFO'}, f'Saved mask layer as image sequence: {self._used_mask_dir}{gate_info}')
         print("Quitting...")
         
         
 
+class TrackBothDirectionsOperator(bpy.types.Operator):
+    """Tracks a mask forwards and backwards from the current frame at the same time"""
+    bl_idname = "rotoforge.track_both_directions"
+    bl_label = "Track Both Directions"
+    bl_options = {'REGISTER', 'UNDO'}
+    
+    _timer = None
+    _used_mask_dir = None
+    _job = None # generate_masks.BothDirectionsTracking, runs both passes in worker threads
+    
+    @classmethod
+    def poll(self, context):
+        if context.space_data.image is None:
+            return False
+        if context.space_data.image.source != 'SEQUENCE':
+            return False
+        if context.space_data.mask is not None and data_manager.is_tracking(context.space_data.mask):
+            return False
+        return True
+    
+    def modal(self, context, event):
+        if event.type == 'TIMER':
+            if self._job.running:
+                context.workspace.status_text_set(f'RotoForge: tracked {self._job.tracked}/{self._job.total} frames in both directions (Esc to stop)')
+                return {'PASS_THROUGH'}
+            self.cancel(context)
+            return {'CANCELLED'}
+        
+        if event.type in ['ESC', 'RIGHTMOUSE']:
+            self.cancel(context)
+            return {'CANCELLED'}
+        
+        return {'PASS_THROUGH'}
+    
+    def execute(self, context):
+        space = context.space_data
+        mask = space.mask
+        layer = mask.layers.active
+        image = space.image
+        maskgencontrols = mask.rotoforge_maskgencontrols.get(layer.name)
+        frame = context.scene.frame_current
+        
+        # Both passes run in worker threads, they can neither rasterize the prompts of other frames nor let blender load frames
+        if not maskgencontrols.tracking:
+            self.report({'WARNING'}, 'Tracking both directions needs Automatic Tracking')
+            return {'CANCELLED'}
+        if generate_masks.read_sequence_frame(image, space.image_user, frame) is None:
+            self.report({'WARNING'}, 'Tracking both directions needs an unpacked 8 bit or EXR image sequence')
+            return {'CANCELLED'}
+        
+        #Wake AI if not present, both passes share it
+        predictor = get_predictor(context, maskgencontrols.used_model)
+        coarse_predictor = get_coarse_predictor(context, maskgencontrols)
+        
+        #Get Prompt data to feed the machine god
+        resolution = tuple(image.size)
+        guide_mask = mask_rasterize.rasterize_layer_of_active_mask(layer, resolution)
+        prompt_points, prompt_labels = prompt_utils.extract_prompt_points(mask, resolution)
+        
+        self._used_mask_dir = f"{mask.name}/MaskLayers/{layer.name}"
+        self._job = generate_masks.BothDirectionsTracking(source_image = image,
+                                                         image_user = space.image_user,
+                                                         used_mask = self._used_mask_dir,
+                                                         predictor = predictor,
+                                                         frame = frame,
+                                                         first_frame = mask.frame_start,
+                                                         last_frame = mask.frame_end,
+                                                         guide_mask = guide_mask,
+                                                         guide_strength = maskgencontrols.guide_strength,
+                                                         blur_radius = maskgencontrols.feather_radius,
+                                                         search_radius = maskgencontrols.search_radius,
+                                                         input_points = prompt_points,
+                                                         input_labels = prompt_labels,
+                                                         input_box = prompt_utils.calculate_bounding_box(guide_mask),
+                                                         prefetch = maskgencontrols.prefetch and not maskgencontrols.tiled_inference and coarse_predictor is None,
+                                                         progress = print,
+                                                         selection = maskgencontrols.mask_selection,
+                                                         mask_prompt = maskgencontrols.mask_prompt,
+                                                         gate = FrameGate(maskgencontrols.skip_threshold, maskgencontrols.skip_max_frames, maskgencontrols.skip_follow_motion),
+                                                         box_predictor = BoxKalmanFilter() if maskgencontrols.box_prediction == 'KALMAN' else None,
+                                                         propagator = MaskPropagator(maskgencontrols.flow_mode) if maskgencontrols.flow_mode != 'NONE' else None,
+                                                         keyframes = KeyframeScheduler(maskgencontrols.keyframe_mode, maskgencontrols.keyframe_interval, maskgencontrols.keyframe_motion),
+                                                         tiled = maskgencontrols.tiled_inference,
+                                                         coarse_predictor = coarse_predictor)
+        data_manager.running_jobs[self._used_mask_dir] = self._job
+        self._job.start()
+        context.window_manager.modal_handler_add(self)
+        self._timer = context.window_manager.event_timer_add(0.1, window=context.window)
+        return {'RUNNING_MODAL'}
+    
+    def cancel(self, context):
+        context.window_manager.event_timer_remove(self._timer)
+        
+        # Waits for both passes to finish their current frame
+        self._job.cancel()
+        data_manager.running_jobs.pop(self._used_mask_dir, None)
+        context.workspace.status_text_set(None)
+        
+        data_manager.update_maskseq(self._used_mask_dir)
+        overlaycontrols = context.scene.rotoforge_overlaycontrols
+        overlaycontrols.used_mask = self._used_mask_dir
+        
+        if self._job.error is not None:
+            self.report({'ERROR'}, f'Tracking both directions failed: {self._job.error}')
+        else:
+            self.report({'INFO'}, f'Saved mask layer as image sequence: {self._used_mask_dir}, tracked {self._job.tracked}/{self._job.total} frames')
+        self._job = None
+        print("Quitting...")
+
+
+
 class MergeMaskOperator(bpy.types.Operator):
     """Rasterizes all masks down to image"""
     bl_idname = "rotoforge.merge_mask"
@@ -466,14 +968,24 @@ class MaskRangeToSceneOperator(bpy.types.Operator):
 
 
 class FreePredictorOperator(bpy.types.Operator):
-    """Frees the predictor from GPU memory"""
+    """Frees the loaded models and the cached image embeddings from memory"""
     bl_idname = "rotoforge.free_predictor"
     bl_label = "Free Cache"
     bl_options = {'REGISTER', 'UNDO'}
     
+    model_type: bpy.props.StringProperty(
+        name="Model",
+        description="Model to free, frees all models if empty",
+        default=""
+    ) # type: ignore
 
     def execute(self, context):
-        free_predictor()
+        if self.model_type == "":
+            free_predictor()
+            self.report({'INFO'}, 'Freed all models')
+        else:
+            free_predictor(self.model_type)
+            self.report({'INFO'}, f'Freed model: {self.model_type}')
         return {'FINISHED'}
 
 
@@ -578,9 +1090,21 @@ class RotoForgeMaskPanel(bpy.types.Panel):
         # Global Settings
         global_settings = layout.box()
         global_settings.label(text="Global Settings")
-        global_settings.prop(rotoforge_props, "used_model")
+        row = global_settings.row()
+        row.prop(rotoforge_props, "used_model")
+        model_state = predictor_registry.state(get_model_key(context, rotoforge_props.used_model))
+        if model_state == 'LOADED':
+            row.label(text="", icon='CHECKMARK')
+        elif model_state == 'LOADING':
+            row.label(text="Loading...", icon='SORTTIME')
+        elif model_state == 'FAILED':
+            row.label(text="Load failed", icon='ERROR')
         global_settings.prop(rotoforge_props, "guide_strength")
+        global_settings.prop(rotoforge_props, "mask_selection")
+        global_settings.prop(rotoforge_props, "mask_prompt")
         global_settings.prop(rotoforge_props, "feather_radius")
+        global_settings.prop(rotoforge_props, "coarse_pass")
+        global_settings.prop(rotoforge_props, "tiled_inference")
         layout.separator()
         
         
@@ -588,7 +1112,21 @@ class RotoForgeMaskPanel(bpy.types.Panel):
         tracking_settings = layout.box()
         tracking_settings.label(text="Tracking Settings")
         tracking_settings.prop(rotoforge_props, "tracking")
-        tracking_settings.prop(rotoforge_props, "search_radius")
+        tracking_settings.prop(rotoforge_props, "flow_mode")
+        tracking_settings.prop(rotoforge_props, "box_prediction")
+        if rotoforge_props.box_prediction == 'FIXED' or rotoforge_props.keyframe_mode != 'EVERY':
+            tracking_settings.prop(rotoforge_props, "search_radius")
+        tracking_settings.prop(rotoforge_props, "keyframe_mode")
+        if rotoforge_props.keyframe_mode != 'EVERY':
+            tracking_settings.prop(rotoforge_props, "keyframe_interval")
+        if rotoforge_props.keyframe_mode == 'ADAPTIVE':
+            tracking_settings.prop(rotoforge_props, "keyframe_motion")
+        tracking_settings.prop(rotoforge_props, "skip_threshold")
+        if rotoforge_props.skip_threshold > 0:
+            tracking_settings.prop(rotoforge_props, "skip_max_frames")
+            tracking_settings.prop(rotoforge_props, "skip_follow_motion")
+        tracking_settings.prop(rotoforge_props, "prefetch")
+        tracking_settings.prop(rotoforge_props, "encoder_batch_size")
         layout.separator()
         
         
@@ -607,8 +1145,19 @@ class RotoForgeMaskPanel(bpy.types.Panel):
         row.scale_x = 2.0
         op = row.operator("rotoforge.track_mask", text="", icon='TRACKING_BACKWARDS')
         op.backwards = True
+        row.operator("rotoforge.track_both_directions", text="", icon='ARROW_LEFTRIGHT')
         op = row.operator("rotoforge.track_mask", text="", icon='TRACKING_FORWARDS')
         op.backwards = False
+        #   Animated Mask (all layers)
+        row = box.row(align=True)
+        row.label(text="All RF Layers:")
+        row.scale_x = 2.0
+        op = row.operator("rotoforge.track_mask", text="", icon='TRACKING_BACKWARDS')
+        op.backwards = True
+        op.all_layers = True
+        op = row.operator("rotoforge.track_mask", text="", icon='TRACKING_FORWARDS')
+        op.backwards = False
+        op.all_layers = True
         
         layout.separator()
         
@@ -633,7 +1182,17 @@ class RotoForgeMaskPanel(bpy.types.Panel):
         
         # Free Cache button
         layout.operator("rotoforge.resync_masksequence", icon='FILE_REFRESH')
-        layout.operator("rotoforge.free_predictor", text="Free Cache", icon='TRASH')
+        layout.operator("rotoforge.free_predictor", text="Free Cache", icon='TRASH').model_type = ""
+        
+        # Loaded models
+        resident = predictor_registry.resident()
+        if resident:
+            models_box = layout.box()
+            models_box.label(text="Loaded Models")
+            for model_type, size in reversed(resident):
+                row = models_box.row(align=True)
+                row.label(text=f"{model_type} ({size / 1024**3:.2f} GB)")
+                row.operator("rotoforge.free_predictor", text="", icon='X').model_type = model_type
 
 
 
@@ -684,6 +1243,7 @@ class RotoForgeNodePanel(bpy.types.Panel):
 classes = [NodeImportControls,
            GenerateSingularMaskOperator,
            TrackMaskOperator,
+           TrackBothDirectionsOperator,
            MergeMaskOperator,
            ImportMaskNodeOperator,
            MaskRangeToSceneOperator,
@@ -700,6 +1260,8 @@ def register():
     return {'REGISTERED'}
 
 def unregister():
+    core_scheduler.release()
+    generate_masks.free_disk_frame_sources()
     for cls in classes:
         try:
             bpy.utils.unregister_class(cls)
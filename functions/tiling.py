@@ -0,0 +1,107 @@
+import math
+
+import numpy as np
+
+from .prompt_utils import carry_logits, LOGITS_BACKGROUND
+
+
+# Tiled inference for crops that are much larger than the encoder input, bpy-free.
+# Instead of downscaling the whole crop to the encoder resolution, it's split into overlapping tiles that are
+# encoded at native resolution, each tile is decoded with the prompt clipped to it and the tile masks are blended
+# with weights that fade out towards the inner tile edges. Only tiles that touch the object are encoded,
+# so the cost grows with the number of tiles the object covers, and they're encoded a few at a time.
+
+TILE_SIZE = 1024 # Encoder input resolution, tiles of this size aren't resized
+TILE_OVERLAP = 128 # Minimum overlap of neighboring tiles in pixels, also the length of the blend ramps
+TILE_BATCH = 4 # Tiles per encoder pass, bounds the memory of the encoder activations
+MIN_DOWNSCALE = 1.5 # Crops downscaled less than this by the encoder don't get tiled
+
+
+
+
+def needs_tiling(width, height, tile_size=TILE_SIZE):
+    return max(width, height) > tile_size * MIN_DOWNSCALE
+
+
+def tile_starts(length, tile_size=TILE_SIZE, overlap=TILE_OVERLAP):
+    # Evenly spread tile starts along one axis, neighbors overlap by at least overlap
+    if length <= tile_size:
+        return [0]
+    count = math.ceil((length - overlap) / (tile_size - overlap))
+    return [int(round(i * (length - tile_size) / (count - 1))) for i in range(count)]
+
+
+def tile_boxes(width, height, tile_size=TILE_SIZE, overlap=TILE_OVERLAP):
+    # (x0, y0, x1, y1) of all tiles of a width x height image, row by row
+    tiles = []
+    for y0 in tile_starts(height, tile_size, overlap):
+        for x0 in tile_starts(width, tile_size, overlap):
+            tiles.append((x0, y0, min(x0 + tile_size, width), min(y0 + tile_size, height)))
+    return tiles
+
+
+def _ramp(start, end, length, overlap):
+    # Weights along one axis of a tile: 1 inside, fading to 0 towards edges that are inside the image
+    positions = np.arange(start, end, dtype=np.float32) + 0.5
+    weights = np.ones(end - start, dtype=np.float32)
+    if start > 0:
+        weights = np.minimum(weights, (positions - start) / overlap)
+    if end < length:
+        weights = np.minimum(weights, (end - positions) / overlap)
+    return np.clip(weights, 0.0, 1.0)
+
+
+def tile_prompt(tile, input_box, input_points, input_labels, guide_mask=None):
+    # Box and points of the image clipped to a tile and moved into its coords, None if the tile doesn't touch the object.
+    # A tile the box only reaches with its padding (no guide mask and no positive point in it) is left out as well
+    x0, y0, x1, y1 = tile
+    points, labels = None, None
+    if input_points is not None:
+        inside = (input_points[:, 0] >= x0) & (input_points[:, 0] < x1) & (input_points[:, 1] >= y0) & (input_points[:, 1] < y1)
+        if np.any(inside):
+            points = input_points[inside] - [x0, y0]
+            labels = input_labels[inside]
+    has_positive_point = labels is not None and np.any(labels == 1)
+
+    box = None
+    if input_box is not None:
+        box = np.array([max(input_box[0], x0), max(input_box[1], y0), min(input_box[2], x1), min(input_box[3], y1)]) - [x0, y0, x0, y0]
+        if box[2] - box[0] < 1 or box[3] - box[1] < 1:
+            return None
+    elif not has_positive_point:
+        return None
+
+    if not has_positive_point and guide_mask is not None and not np.any(guide_mask[y0:y1, x0:x1]):
+        return None
+    return box, points, labels
+
+
+
+
+class TileBlend:
+    """Accumulates the masks and low res logits of the tiles of a width x height image"""
+
+    def __init__(self, width, height, overlap=TILE_OVERLAP):
+        self.width = width
+        self.height = height
+        self.overlap = overlap
+        self._weighted = np.zeros((height, width), dtype=np.float32)
+        self._weights = np.zeros((height, width), dtype=np.float32)
+        self._logits = None
+
+    def add(self, tile, mask, logits=None):
+        x0, y0, x1, y1 = tile
+        weights = np.outer(_ramp(y0, y1, self.height, self.overlap), _ramp(x0, x1, self.width, self.overlap))
+        self._weighted[y0:y1, x0:x1] += weights * mask
+        self._weights[y0:y1, x0:x1] += weights
+
+        # The logits of a tile cover the square of its long side, moved into the square of the image, the most confident tile wins
+        if logits is not None:
+            carried = carry_logits(logits, tile, (0, 0, self.width, self.height))
+            self._logits = carried if self._logits is None else np.maximum(self._logits, carried)
+
+    def result(self):
+        # (mask, low res logits of the square of the long side of the image) like a single decoder pass
+        mask = self._weighted > self._weights * 0.5
+        logits = self._logits if self._logits is not None else np.full((256, 256), LOGITS_BACKGROUND, dtype=np.float32)
+        return mask, logits
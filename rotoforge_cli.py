@@ -0,0 +1,201 @@
+"""
+Headless RotoForge tracking, runs without blender (farm nodes, CI benchmarks).
+
+Example:
+    python rotoforge_cli.py plate/plate.####.png out_masks --checkpoint sam_hq_vit_tiny.pth --box 410 220 780 650
+    python rotoforge_cli.py plate/ out_masks --checkpoint sam_hq_vit_l.pth --model vit_l --seed-mask seed.png --backwards
+    python rotoforge_cli.py plate/ out_masks --checkpoint sam_hq_vit_b.pth --model vit_b --box 410 220 780 650 --backend onnx
+    python rotoforge_cli.py plate/ out_masks --checkpoint sam_hq_vit_l.pth --model vit_l --seed-mask seed.png --start 1040 --both-directions
+
+Needs numpy, pillow, torch and segment_anything (and OpenEXR for .exr plates).
+The onnx backend needs onnxruntime, torch and segment_anything are only used to export each model once.
+"""
+
+import os
+import sys
+import argparse
+import time
+
+import numpy as np
+
+# Import the bpy-free modules as a plain package, without the blender addon around it
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from functions import engine
+from functions.frame_io import ImageSequenceSource, DirectoryMaskSink, read_image
+from functions.prompt_utils import calculate_bounding_box
+from functions.prefetch import EncoderPrefetcher
+from functions.frame_cache import CachedFrameSource
+from functions.mask_selection import SELECTION_STRATEGIES
+from functions.frame_gating import FrameGate
+from functions.motion_model import BoxKalmanFilter, BOX_PREDICTIONS
+from functions.optical_flow import MaskPropagator, FLOW_MODES
+from functions.keyframes import KeyframeScheduler, KEYFRAME_MODES
+from functions.core_scheduler import schedule_cores, core_scheduler, claim_threads, list_threads
+
+
+MODEL_TYPES = ['vit_tiny', 'vit_b', 'vit_l', 'vit_h', 'vit_tiny_int8', 'vit_b_int8', 'vit_l_int8', 'vit_h_int8']
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Track a mask through a PNG/EXR image sequence with SAM-HQ')
+    parser.add_argument('frames', help='Folder of the image sequence or a pattern like plate.####.png / plate.%%04d.png')
+    parser.add_argument('output', help='Folder the mask sequence is written to (<frame>.png)')
+    parser.add_argument('--checkpoint', required=True, help='Path to the sam_hq_<model>.pth file')
+    parser.add_argument('--model', default='vit_tiny', choices=MODEL_TYPES, help='*_int8 quantizes the encoder for CPU inference, uses the checkpoint of the fp32 model')
+    parser.add_argument('--backend', default='torch', choices=['torch', 'onnx'], help='onnx runs ONNX Runtime on the CPU')
+    parser.add_argument('--threads', type=int, default=0, help='CPU threads of the model (default: one per core)')
+    parser.add_argument('--core-scheduling', default='OFF', type=str.upper, choices=['OFF', 'SHARE', 'PIN'],
+                        help='SHARE splits the cores with other RotoForge processes on this host (--threads is the budget, 0 = even share), PIN also pins the process to them (Linux)')
+    parser.add_argument('--interop-threads', type=int, default=0, help='PyTorch inter-op threads (default: PyTorch default)')
+    parser.add_argument('--onnx-dir', help='Folder for the exported ONNX models (default: onnx/ next to the checkpoint)')
+
+    seed = parser.add_mutually_exclusive_group(required=True)
+    seed.add_argument('--box', type=float, nargs=4, metavar=('X0', 'Y0', 'X1', 'Y1'), help='Seed box on the start frame in pixels')
+    seed.add_argument('--seed-mask', help='Seed mask image for the start frame (white = object)')
+
+    parser.add_argument('--start', type=int, help='Frame to start tracking on (default: first frame, or last with --backwards)')
+    parser.add_argument('--end', type=int, help='Frame to stop tracking on')
+    direction = parser.add_mutually_exclusive_group()
+    direction.add_argument('--backwards', action='store_true', help='Track towards lower frame numbers')
+    direction.add_argument('--both-directions', action='store_true',
+                           help='Track from --start to both ends of the sequence, the forward and backward passes run at the same time')
+    parser.add_argument('--guide-strength', type=float, default=10)
+    parser.add_argument('--selection', default='AREA', type=str.upper, choices=list(SELECTION_STRATEGIES),
+                        help='How one of the proposed masks is picked, SINGLE lets the model output a single mask (fastest)')
+    parser.add_argument('--mask-prompt', default='GUIDE_MASK', type=str.upper, choices=list(engine.MASK_PROMPTS),
+                        help='Build the mask prompt of the next frame from the previous mask or reuse the previous low res logits')
+    parser.add_argument('--flow', default='NONE', type=str.upper, choices=list(FLOW_MODES),
+                        help='Move the previous mask with optical flow to prompt the model (PROMPT) or instead of the model (PROPAGATE)')
+    parser.add_argument('--box-prediction', default='FIXED', type=str.upper, choices=list(BOX_PREDICTIONS),
+                        help='Pad the next box by --search-radius or predict it with a motion model (KALMAN)')
+    parser.add_argument('--skip-threshold', type=float, default=0,
+                        help='Reuse the last mask while the search area changed less than this (mean pixel difference 0-1), 0 runs the model on every frame')
+    parser.add_argument('--skip-max-frames', type=int, default=10, help='Run the model at least every this many frames (0 = no limit)')
+    parser.add_argument('--no-skip-motion', action='store_true', help="Don't move reused masks along with the estimated motion")
+    parser.add_argument('--keyframes', default='EVERY', type=str.upper, choices=list(KEYFRAME_MODES),
+                        help='Run the model on every frame, every --keyframe-interval frames (INTERVAL) or more often on faster motion (ADAPTIVE) and interpolate the rest')
+    parser.add_argument('--keyframe-interval', type=int, default=4, help='Frames from one keyframe to the next (at most with ADAPTIVE)')
+    parser.add_argument('--keyframe-motion', type=float, default=0.1, help='ADAPTIVE: motion between two keyframes as a fraction of the object size')
+    parser.add_argument('--tiled', action='store_true', help='Encode crops much larger than the encoder input as overlapping tiles at native resolution')
+    parser.add_argument('--coarse-checkpoint', default=None,
+                        help=f'Checkpoint of {engine.COARSE_MODEL}, localizes the object on the downscaled frame before the selected model runs on the tight crop')
+    parser.add_argument('--search-radius', type=float, default=10)
+    parser.add_argument('--feather', type=float, default=0.2, help='Blur radius applied to the saved masks')
+    parser.add_argument('--no-prefetch', action='store_true', help='Disable encoding the next frame in a worker thread')
+    parser.add_argument('--read-ahead', type=int, default=4, help='Frames decoded ahead in worker threads (0 disables)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    frame_source = CachedFrameSource(ImageSequenceSource(args.frames), read_ahead=args.read_ahead)
+    all_frames = frame_source.frames()
+    if args.both_directions and args.start not in all_frames:
+        print('--both-directions needs --start on a frame of the sequence')
+        return 1
+    if args.both_directions and args.end is not None:
+        print('--both-directions tracks to both ends of the sequence, --end only applies to one direction')
+        return 1
+    start = args.start if args.start is not None else (all_frames[-1] if args.backwards else all_frames[0])
+    end = args.end if args.end is not None else (all_frames[0] if args.backwards else all_frames[-1])
+    if args.both_directions:
+        frames = all_frames
+    elif args.backwards:
+        frames = [frame for frame in reversed(all_frames) if end <= frame <= start]
+    else:
+        frames = [frame for frame in all_frames if start <= frame <= end]
+    if not frames:
+        print('No frames in the given range')
+        return 1
+
+    # Seed prompt
+    if args.seed_mask is not None:
+        seed_pixels = read_image(args.seed_mask)
+        guide_mask = seed_pixels[:, :, 0] > 127
+        input_box = calculate_bounding_box(guide_mask)
+        if input_box is None:
+            print('The seed mask is empty')
+            return 1
+        input_box = np.array(input_box)
+        guide_mask = guide_mask.astype(np.float32)
+    else:
+        input_box = np.array(args.box)
+        width, height = frame_source.resolution
+        guide_mask = np.zeros((height, width), dtype=np.float32)
+        x0, y0, x1, y1 = [int(round(value)) for value in input_box]
+        guide_mask[max(y0, 0):max(y1, 0), max(x0, 0):max(x1, 0)] = 1.0
+
+    onnx_dir = args.onnx_dir or os.path.join(os.path.dirname(os.path.abspath(args.checkpoint)), 'onnx')
+    # Every thread of the CLI is RotoForge's, pinning can take the whole process
+    claim_threads(list_threads())
+    num_threads = schedule_cores(args.core_scheduling, args.threads)
+    predictor = engine.load_predictor(args.model, args.checkpoint, backend=args.backend, onnx_dir=onnx_dir,
+                                      num_threads=num_threads, num_interop_threads=args.interop_threads)
+    coarse_predictor = None
+    if args.coarse_checkpoint is not None and args.model != engine.COARSE_MODEL:
+        coarse_predictor = engine.load_predictor(engine.COARSE_MODEL, args.coarse_checkpoint, backend=args.backend, onnx_dir=onnx_dir,
+                                                 num_threads=num_threads, num_interop_threads=args.interop_threads)
+    mask_sink = DirectoryMaskSink(args.output, frame_source.resolution)
+    prefetch = not args.no_prefetch and not args.tiled and coarse_predictor is None
+    prefetcher = EncoderPrefetcher() if prefetch and not args.both_directions else None
+    # The backward pass reads ahead in its own direction, both share the decoded frames
+    backward_source = CachedFrameSource(frame_source.frame_source, read_ahead=args.read_ahead) if args.both_directions else None
+
+    start_time = time.perf_counter()
+    try:
+        if args.both_directions:
+            engine.track_both_directions(frame_source = frame_source,
+                                         mask_sink = mask_sink,
+                                         predictor = predictor,
+                                         frames = frames,
+                                         frame = start,
+                                         guide_mask = guide_mask,
+                                         guide_strength = args.guide_strength,
+                                         blur_radius = args.feather,
+                                         search_radius = args.search_radius,
+                                         input_box = input_box,
+                                         prefetch = prefetch,
+                                         selection = args.selection,
+                                         mask_prompt = args.mask_prompt,
+                                         gate = FrameGate(args.skip_threshold, args.skip_max_frames, not args.no_skip_motion),
+                                         box_predictor = BoxKalmanFilter() if args.box_prediction == 'KALMAN' else None,
+                                         propagator = MaskPropagator(args.flow) if args.flow != 'NONE' else None,
+                                         keyframes = KeyframeScheduler(args.keyframes, args.keyframe_interval, args.keyframe_motion),
+                                         tiled = args.tiled,
+                                         coarse_predictor = coarse_predictor,
+                                         backward_source = backward_source)
+        else:
+            engine.track_sequence(frame_source = frame_source,
+                                  mask_sink = mask_sink,
+                                  predictor = predictor,
+                                  frames = frames,
+                                  guide_mask = guide_mask,
+                                  guide_strength = args.guide_strength,
+                                  blur_radius = args.feather,
+                                  search_radius = args.search_radius,
+                                  input_box = input_box,
+                                  prefetcher = prefetcher,
+                                  selection = args.selection,
+                                  mask_prompt = args.mask_prompt,
+                                  gate = FrameGate(args.skip_threshold, args.skip_max_frames, not args.no_skip_motion),
+                                  box_predictor = BoxKalmanFilter() if args.box_prediction == 'KALMAN' else None,
+                                  propagator = MaskPropagator(args.flow) if args.flow != 'NONE' else None,
+                                  keyframes = KeyframeScheduler(args.keyframes, args.keyframe_interval, args.keyframe_motion),
+                                  tiled = args.tiled,
+                                  coarse_predictor = coarse_predictor)
+    finally:
+        if prefetcher is not None:
+            prefetcher.shutdown()
+        core_scheduler.release()
+        frame_source.shutdown()
+        if backward_source is not None:
+            backward_source.shutdown()
+
+    elapsed = time.perf_counter() - start_time
+    print(f'Tracked {len(frames)} frames in {elapsed:.1f} sec ({elapsed / len(frames):.2f} sec/frame)')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())